@@ -0,0 +1,99 @@
+# engines.py
+
+"""
+Ensemble check of the hybrid engine against the vectorized engine.
+
+Runs --replicates seeded models of each engine from the same parameters
+(the susceptible matrix multiplied by --scale, so that the epidemic spreads
+through cells the hybrid engine holds as counts) and compares the mean total
+SEIR counts of every step. A difference is reported as a failure when it is
+both larger than --z standard errors and larger than --tolerance of the
+vectorized mean, so that the check flags real drifts of the hybrid engine
+and not its known bias (see the docstring of covid_19_model.hybrid) or
+sampling noise.
+
+Usage (from the repository root):
+    python benchmarks/engines.py --replicates 200
+    python benchmarks/engines.py --replicates 200 --boundary clamp
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.replicates import extinct
+from covid_19_model.utils import parse_json
+import numpy as np
+import argparse
+
+COMPARTMENTS = ("S", "E", "I", "R")
+
+def trajectories(engine, variable_params, fixed_params, replicates, steps, seed):
+    """
+    Returns the (replicates, steps, compartments) total SEIR counts of an
+    engine's ensemble, the counts of an extinct replicate staying constant
+    """
+    counts = np.zeros((replicates, steps, len(COMPARTMENTS)))
+
+    for replicate in range(replicates):
+        model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed + replicate)
+        for step in range(steps):
+            if model.running and not extinct(model):
+                model.step()
+            counts[replicate, step] = [model.SEIR["total"][compartment] for compartment in COMPARTMENTS]
+
+    return counts
+
+def compare(reference, candidate, z, tolerance):
+    """
+    Returns the mean difference, its standard error and the failing
+    (step, compartment) pairs of two ensembles
+    """
+    difference = candidate.mean(axis = 0) - reference.mean(axis = 0)
+    error = np.sqrt(
+        reference.var(axis = 0, ddof = 1) / len(reference)
+        + candidate.var(axis = 0, ddof = 1) / len(candidate))
+    failing = (np.abs(difference) > z * error) & (np.abs(difference) > tolerance * np.abs(reference.mean(axis = 0)))
+    return difference, error, np.argwhere(failing)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Ensemble check of the hybrid engine against the vectorized engine")
+    parser.add_argument("--replicates", type = int, default = 200)
+    parser.add_argument("--steps", type = int, default = 30)
+    parser.add_argument("--scale", type = float, default = 20,
+        help = "multiplier of the susceptible matrix")
+    parser.add_argument("--boundary", choices = ("none", "clamp", "reflect"),
+        help = "city_boundary (default: the fixed parameters')")
+    parser.add_argument("--seed", type = int, default = 1000)
+    parser.add_argument("--z", type = float, default = 4)
+    parser.add_argument("--tolerance", type = float, default = 0.15,
+        help = "relative difference allowed on top of --z standard errors")
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    args = parser.parse_args(argv)
+
+    variable_params = parse_json(args.variable)
+    variable_params["susceptible"] = np.round(np.array(variable_params["susceptible"]) * args.scale).astype(int).tolist()
+    fixed_params = parse_json(args.fixed)
+    if args.boundary is not None:
+        fixed_params["city_boundary"] = args.boundary
+
+    reference = trajectories("vectorized", variable_params, fixed_params, args.replicates, args.steps, args.seed)
+    candidate = trajectories("hybrid", variable_params, fixed_params, args.replicates, args.steps, args.seed)
+    difference, error, failing = compare(reference, candidate, args.z, args.tolerance)
+
+    for step in range(args.steps):
+        print("step %3d " % (step + 1) + " ".join(
+            "%s=%.1f%+.1f(%.1f)" % (compartment, reference[:, step, index].mean(), difference[step, index], error[step, index])
+            for index, compartment in enumerate(COMPARTMENTS)))
+
+    for step, index in failing:
+        print("MISMATCH step %d %s: vectorized %.2f, hybrid %.2f (standard error %.2f)" % (
+            step + 1, COMPARTMENTS[index], reference[:, step, index].mean(),
+            candidate[:, step, index].mean(), error[step, index]))
+    if len(failing):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# scaling.py
+
+"""
+Scaling benchmarks of Covid19Model.
+
+Builds models from synthetic variable_parameters-shaped inputs for several
+population sizes and infection prevalences, and times separately:
+    build: Covid19Model construction
+    step: one whole model.step(), on a second model with the same seed
+    status: the status transitions due at the step
+    interact, move: each phase of a step run over every agent
+    refresh: materialization and collapse of the hybrid engine's counts
+    index_rebuild: full rebuild of the person spatial index (the object
+        engine's replacement for the per-step _recreate_rtree)
+    collect: one SEIR recorder collection
+
+Each phase is timed over --steps steps and the median is reported.
+
+Usage (from the repository root):
+    python benchmarks/scaling.py --output bench.json
+    python benchmarks/scaling.py --output new.json --compare bench.json
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.utils import parse_json
+import numpy as np
+import argparse
+import platform
+import time
+import json
+
+PHASES = ("build", "step", "status", "refresh", "interact", "move", "index_rebuild", "collect")
+
+def synthetic_params(population, prevalence, template):
+    """
+    Returns variable parameters with the given total population, spread over
+    the age group x district cells like the template's susceptible matrix.
+    A prevalence fraction is split evenly between exposed and infected.
+    """
+    weights = np.array(template["susceptible"], dtype = float)
+    weights /= weights.sum()
+
+    def matrix(total):
+        return np.round(weights * total).astype(int).tolist()
+
+    infected = population * prevalence / 2
+    return {
+        "susceptible": matrix(population - 2 * infected),
+        "exposed": matrix(infected),
+        "infected": matrix(infected),
+        "removed": matrix(0),
+    }
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def object_phase(model, phase):
+    """
+    Runs one phase of PersonAgent.step over every active agent
+    """
+    for agent in model.schedule.active_buffer():
+        getattr(agent, phase)()
+
+def benchmark(engine, population, prevalence, steps, template, fixed_params, seed):
+    """
+    Returns the median time of every phase for one configuration. The
+    phases are timed one at a time on one model and whole steps on a
+    second model built with the same seed, each advanced once per step.
+    """
+    variable_params = synthetic_params(population, prevalence, template)
+    timings = {phase: [] for phase in PHASES}
+
+    models = []
+    timings["build"].append(timed(lambda: models.append(
+        Covid19Model(variable_params, fixed_params, engine = engine, seed = seed))))
+    model = models[0]
+    stepped = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed)
+
+    for _ in range(steps):
+        timings["step"].append(timed(stepped.step))
+
+        # Status transitions fall due against the model's step counter
+        model.steps += 1
+        timings["collect"].append(timed(model.recorder.collect))
+        if model.population is not None:
+            people = model.population
+            for phase in people.PHASES:
+                timings[phase].append(timed(getattr(people, phase)))
+        else:
+            timings["status"].append(timed(model.process_transitions))
+            for phase in ("interact", "move"):
+                timings[phase].append(timed(lambda: object_phase(model, phase)))
+            timings["index_rebuild"].append(timed(model.grid.reindex))
+
+    return {
+        "engine": engine,
+        "population": population,
+        "prevalence": prevalence,
+        "agents": len(model.population) if model.population is not None else model.schedule.get_agent_count(),
+        "seconds": {phase: float(np.median(values)) for phase, values in timings.items() if values},
+    }
+
+def result_key(result):
+    return (result["engine"], result["population"], result["prevalence"])
+
+def compare(results, baseline, tolerance, minimum):
+    """
+    Returns the phases that are slower than in the baseline by more than
+    tolerance (relative) and minimum seconds (absolute)
+    """
+    reference = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        old = reference.get(result_key(result))
+        if old is None:
+            continue
+        for phase, seconds in result["seconds"].items():
+            old_seconds = old["seconds"].get(phase)
+            if (
+                old_seconds is not None
+                and seconds > old_seconds * (1 + tolerance)
+                and seconds - old_seconds > minimum
+            ):
+                regressions.append(dict(
+                    zip(("engine", "population", "prevalence"), result_key(result)),
+                    phase = phase,
+                    baseline = old_seconds,
+                    seconds = seconds))
+
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Scaling benchmarks of Covid19Model")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 10000, 100000, 1000000])
+    parser.add_argument("--prevalences", type = float, nargs = "+", default = [0.001, 0.01, 0.1])
+    parser.add_argument("--engines", nargs = "+", choices = Covid19Model.ENGINES, default = list(Covid19Model.ENGINES))
+    parser.add_argument("--max-object-population", type = int, default = 100000,
+        help = "skip the object engine above this population")
+    parser.add_argument("--steps", type = int, default = 3)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--output", default = "bench.json")
+    parser.add_argument("--compare", help = "baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type = float, default = 0.25)
+    parser.add_argument("--minimum", type = float, default = 0.001,
+        help = "ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args(argv)
+
+    template = parse_json(args.variable)
+    fixed_params = parse_json(args.fixed)
+    results = []
+
+    for engine in args.engines:
+        for population in args.sizes:
+            if engine == "object" and population > args.max_object_population:
+                continue
+            for prevalence in args.prevalences:
+                result = benchmark(
+                    engine, population, prevalence, args.steps,
+                    template, fixed_params, args.seed)
+                results.append(result)
+                print(engine, population, prevalence, " ".join(
+                    "%s=%.4fs" % item for item in result["seconds"].items()))
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "steps": args.steps,
+            "results": results,
+        }, file, indent = 2)
+
+    if args.compare:
+        regressions = compare(results, parse_json(args.compare), args.tolerance, args.minimum)
+        for regression in regressions:
+            print("REGRESSION %(engine)s population=%(population)s prevalence=%(prevalence)s "
+                  "%(phase)s: %(baseline).4fs -> %(seconds).4fs" % regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# startup.py
+
+"""
+Cold start benchmark of Covid19Model.
+
+Times, in fresh interpreter processes (as a batch or job worker starts):
+    import: importing covid_19_model.model
+    parameters: parsing the parameter files
+    build: Covid19Model construction
+    first_step: the first model.step()
+    total: from the first import to the end of the first step
+
+with the district geometry file (see covid_19_model.space.QuezonCity.
+district_geometry) missing, so that the GeoJSON is parsed and reprojected,
+and present. Each child also lists the visualization and server modules it
+imported, which should be none.
+
+Usage (from the repository root):
+    python benchmarks/startup.py --output startup.json
+"""
+
+import subprocess
+import statistics
+import argparse
+import platform
+import tempfile
+import time
+import json
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ("import", "parameters", "build", "first_step", "total")
+
+# Modules that a headless run must not import
+VISUALIZATION_MODULES = (
+    "covid_19_model.visualization",
+    "covid_19_model.server",
+    "mesa.visualization",
+    "mesa_geo.visualization",
+    "tornado",
+)
+
+def measure(engine, variable, fixed, seed, geometry):
+    """
+    Returns the timings of one cold start (run in a fresh process)
+    """
+    start = time.perf_counter()
+    from covid_19_model.model import Covid19Model
+    from covid_19_model.space import QuezonCity
+    from covid_19_model.utils import parse_json
+    imported = time.perf_counter()
+
+    if geometry:
+        QuezonCity.quezon_city_districts_geometry = geometry
+    variable_params = parse_json(variable)
+    fixed_params = parse_json(fixed)
+    parsed = time.perf_counter()
+
+    model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed)
+    built = time.perf_counter()
+    model.step()
+    stepped = time.perf_counter()
+
+    return {
+        "seconds": {
+            "import": imported - start,
+            "parameters": parsed - imported,
+            "build": built - parsed,
+            "first_step": stepped - built,
+            "total": stepped - start,
+        },
+        "visualization_modules": sorted(
+            name for name in sys.modules
+            if any(name == module or name.startswith(module + ".") for module in VISUALIZATION_MODULES)),
+    }
+
+def cold_start(args, engine, geometry):
+    """
+    Runs measure in a fresh interpreter and returns its result
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child",
+        "--engine", engine, "--variable", args.variable, "--fixed", args.fixed,
+        "--seed", str(args.seed), "--geometry", geometry]
+    output = subprocess.run(command, cwd = ROOT, check = True, capture_output = True, text = True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def benchmark(args, engine, cached):
+    """
+    Returns the median timings of --repeats cold starts of an engine, with
+    or without the district geometry file
+    """
+    runs = []
+    for _ in range(args.repeats):
+        if cached:
+            runs.append(cold_start(args, engine, ""))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                runs.append(cold_start(args, engine, os.path.join(directory, "districts.npz")))
+
+    return {
+        "engine": engine,
+        "geometry_cached": cached,
+        "seconds": {phase: statistics.median(run["seconds"][phase] for run in runs) for phase in PHASES},
+        "visualization_modules": sorted({name for run in runs for name in run["visualization_modules"]}),
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Cold start benchmark of Covid19Model")
+    parser.add_argument("--engines", nargs = "+", default = ["object", "vectorized", "hybrid", "compartmental"])
+    parser.add_argument("--repeats", type = int, default = 5)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--output", default = "startup.json")
+    parser.add_argument("--child", action = "store_true", help = argparse.SUPPRESS)
+    parser.add_argument("--engine", help = argparse.SUPPRESS)
+    parser.add_argument("--geometry", default = "", help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        print(json.dumps(measure(args.engine, args.variable, args.fixed, args.seed, args.geometry)))
+        return
+
+    # Builds the district geometry file once, for the cached runs
+    cold_start(args, args.engines[0], "")
+
+    results = []
+    for engine in args.engines:
+        for cached in (False, True):
+            result = benchmark(args, engine, cached)
+            results.append(result)
+            print(engine, "cached" if cached else "parsed", " ".join(
+                "%s=%.4fs" % item for item in result["seconds"].items()),
+                "visualization_modules=%s" % (",".join(result["visualization_modules"]) or "none"))
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeats": args.repeats,
+            "results": results,
+        }, file, indent = 2)
+
+if __name__ == "__main__":
+    main()
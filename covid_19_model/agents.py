@@ -1,8 +1,8 @@
 # agents.py
 
-from covid_19_model.enum.immunity import Immunity
 from covid_19_model.enum.state import State
-from covid_19_model.utils import coin_toss
+from covid_19_model.schedule import NEVER
+from covid_19_model.utils import susceptibility
 from mesa_geo.geoagent import GeoAgent
 from shapely.geometry import Point
 
@@ -14,12 +14,18 @@ class PersonAgent(GeoAgent):
         unique_id: Agent's unique identification string
         model: Model which the agent belongs to
         shape: Agent's shapely.geometry shape
-        district: Agent's home district
+        district: Agent's district (its home district unless the model
+            tracks districts, see move)
         state: Agents current state: S, E, I, or R
         age: Agent's age
         wearing_mask: True if agent is wearing a mask; else, False
         physical_distancing: True if agent is observing physical distance; else, False
         mobile_worker: True if agent is a mobile worker; else, False
+        susceptibility: Probability that a contact with transmission rate 1
+            exposes the agent (see update_susceptibility)
+        transition_step: Step at which the agent's next status transition
+            (E -> I or I -> R) is due (see covid_19_model.schedule)
+        activated_step: Last step at which the agent was stepped
     """
 
     def __init__(
@@ -46,82 +52,131 @@ class PersonAgent(GeoAgent):
         self.mobile_worker = mobile_worker
         self.days_infected = 0
         self.days_incubating = 0
+        self.transition_step = NEVER
+        self.activated_step = -1
+        self.update_susceptibility()
 
     def step(self):
         """
-        Advances agent by a step
+        Advances agent by a step. Status transitions are applied by
+        Covid19Model.process_transitions when they fall due.
         """
-        self.status()
+        self.activated_step = self.model.steps
         self.interact()
         self.move()
 
     def status(self):
         """
-        Checks agent's status
+        Applies the agent's status transition if it is due at this step
         """
+        model = self.model
+        if self.transition_step > model.steps:
+            return
+
         if self.state == State.EXPOSED:
-            if coin_toss(self.model.as_infection_probability[self.district]):
-                self.transition(
-                    district = self.district,
-                    prev_state = self.state,
-                    next_state = State.INFECTED,
-                    update_summary = True,
-                    summary_key = "max_infected")
+            self.transition(
+                district = self.district,
+                prev_state = self.state,
+                next_state = State.INFECTED,
+                update_summary = True,
+                summary_key = "max_infected")
+            self.schedule_status(model.steps + 1)
 
         elif self.state == State.INFECTED:
             # Case: Agent is removed
-            if coin_toss(self.model.removal_rate[self.district]):
-                self.transition(
-                    district = self.district,
-                    prev_state = self.state,
-                    next_state = State.REMOVED)
-                self.model.grid.remove_agent(self)
-                self.model.schedule.remove(self)
-                del self
+            self.transition(
+                district = self.district,
+                prev_state = self.state,
+                next_state = State.REMOVED)
+            model.events.cancel(self)
+            model.grid.remove_agent(self)
+            model.schedule.remove(self)
+            del self
+
+    def schedule_status(self, first_step):
+        """
+        Draws the step of the agent's next status transition: the first
+        success of one coin toss per step, from first_step on, with
+        as_infection_probability if exposed or removal_rate if infected
+        """
+        model = self.model
+        if self.state == State.EXPOSED:
+            ptrue = model.as_infection_probability[self.district]
+        elif self.state == State.INFECTED:
+            ptrue = model.removal_rate[self.district]
+        else:
+            model.events.cancel(self)
+            return
+        model.events.schedule(self, first_step - 1 + model.streams.waiting_time("status", ptrue))
 
     def interact(self):
         """
         Agent interacts with other agents
         """
         if self.state == State.INFECTED:
-            neighbors = self.get_neighbors()
-            for neighbor in neighbors:
+            # One draw per contact, with the same probability as the
+            # independent transmission, low immunity, mask and physical
+            # distancing tosses
+            steps = self.model.steps
+            transmission_rate = min(self.model.transmission_rate[self.district], 1)
+            coin_toss = self.model.streams.coin_toss
+            for neighbor in self.get_neighbors():
                 if (
                     isinstance(neighbor, PersonAgent)
                     and neighbor.state == State.SUSCEPTIBLE
-                    and coin_toss(self.model.transmission_rate[self.district])
+                    and coin_toss("interact", transmission_rate * neighbor.susceptibility)
                 ):
-                    if neighbor.with_low_immunity():
-                        if (
-                            not neighbor.protected_by_wearing_mask()
-                            and not neighbor.protected_by_physical_distancing()
-                        ):
-                    # if coin_toss(neighbor.model.localized_immunity[neighbor.district]):
-
-                    # if (
-                        # not neighbor.protected_by_wearing_mask()
-                        # and not neighbor.protected_by_physical_distancing()
-                    # ):
-                            neighbor.transition(
-                                district = neighbor.district,
-                                prev_state = neighbor.state,
-                                next_state = State.EXPOSED,
-                                update_summary = True,
-                                summary_key = "max_exposed")
+                    neighbor.transition(
+                        district = neighbor.district,
+                        prev_state = neighbor.state,
+                        next_state = State.EXPOSED,
+                        update_summary = True,
+                        summary_key = "max_exposed")
+
+                    # A neighbor not yet stepped would have tossed its
+                    # E -> I coin later in this step
+                    neighbor.schedule_status(steps + self.model.schedule.activated(neighbor))
+                    if neighbor.transition_step == steps:
+                        neighbor.status()
 
     def move(self):
         """
-        Agent moves in a random position
+        Agent moves in a random position. Returns whether it moved.
         """
         if self.state != "R" and self.allowed_to_move():
-            new_x = self.shape.x + self.random.randint(
-                -self.mobility_range(),
-                self.mobility_range())
-            new_y = self.shape.y + self.random.randint(
-                -self.mobility_range(),
-                self.mobility_range())
-            self.shape = Point(new_x, new_y)
-            # self.district = self.model.grid.get_district(self.shape, self.district)
+            mobility_range = self.mobility_range()
+            uniform = self.model.streams.uniform
+            x, y = self.shape.x, self.shape.y
+            new_x = x + int(uniform("move") * (2 * mobility_range + 1)) - mobility_range
+            new_y = y + int(uniform("move") * (2 * mobility_range + 1)) - mobility_range
+
+            grid = self.model.grid
+            track_districts = self.model.track_districts
+            new_x, new_y, district = grid.confine_one(
+                x, y, new_x, new_y, self.model.city_boundary, track_districts)
+            grid.move_agent(self, Point(new_x, new_y))
+            # The district of the destination was located by confine_one
+            if track_districts and district >= 0 and grid.DISTRICTS[district] != self.district:
+                self.relocate(grid.DISTRICTS[district])
+            return True
+        return False
+
+    def relocate(self, district):
+        """
+        Moves the agent's count to the district it entered, whose immunity
+        and rates apply to the agent from now on
+        """
+        model = self.model
+        model.relocate(self.district, district, self.state)
+        self.district = district
+        self.update_susceptibility()
+
+        if self.state == State.EXPOSED:
+            model.update_summary(district, "max_exposed", self.state)
+            self.schedule_status(model.steps + 1)
+        elif self.state == State.INFECTED:
+            model.update_summary(district, "max_infected", self.state)
+            self.schedule_status(model.steps + 1)
 
     def allowed_to_move(self):
         """
@@ -142,18 +197,18 @@ class PersonAgent(GeoAgent):
             return self.model.agent_mobility_range * 2
         return self.model.agent_mobility_range
 
-    def protected_by_physical_distancing(self):
+    def update_susceptibility(self):
         """
-        Checks if agent is protected by social distancing
+        Precomputes the agent's susceptibility from its district's immunity
+        and its mask and physical distancing factors. Called again by
+        Covid19Model.update_parameters.
         """
-        if self.physical_distancing:
-            return coin_toss(self.model.physical_distancing_protection)
-        return False
-
-    def protected_by_wearing_mask(self):
-        if self.wearing_mask:
-            return coin_toss(self.model.wearing_mask_protection)
-        return False
+        self.susceptibility = susceptibility(
+            self.model.localized_immunity[self.district],
+            self.wearing_mask,
+            self.model.wearing_mask_protection,
+            self.physical_distancing,
+            self.model.physical_distancing_protection)
 
     def set_state(self, state):
         """
@@ -166,6 +221,7 @@ class PersonAgent(GeoAgent):
         Change's agent's state
         """
         self.set_state(next_state)
+        self.model.schedule.update(self)
         self.model.add_one(district, next_state)
         self.model.remove_one(district, prev_state)
 
@@ -173,9 +229,5 @@ class PersonAgent(GeoAgent):
             self.model.update_summary(district, summary_key, next_state)
             self.model.update_summary("total", summary_key, next_state)
 
-    def with_low_immunity(self):
-        return coin_toss(1 - self.model.localized_immunity[self.district])
-        # return self.immunity == Immunity.LOW and self.is_senior_citizen()
-
     def is_senior_citizen(self):
         return self.age >= 60
\ No newline at end of file
@@ -0,0 +1,184 @@
+# batch.py
+
+"""
+Headless batch runner.
+
+Runs a grid of parameter overrides (the sweep) x replicates over a process
+pool, without importing the visualization stack, and writes the results to
+an output directory:
+    runs.json: parameter overrides of every run
+    series.csv: run, replicate, step, district, S, E, I, R
+    summary.csv: run, replicate, seed, district, peaks of E and I
+    ensemble.json: with --ensemble, streaming statistics of each run's
+        replicates (see covid_19_model.ensemble) instead of series.csv
+    cache.json: with --result-cache, the number of runs read from the
+        result cache (hits) and simulated (misses)
+
+A sweep spec is a JSON object mapping fixed_parameters.json keys to either a
+list of values or a range ({"start", "stop", "num"} for evenly spaced values,
+including stop). Per-district parameters accept a "key.districtN" entry for
+a single district, or a plain key to set all six districts at once:
+    {
+        "wearing_mask_percentage": [0.3, 0.5, 0.7],
+        "min_age_restriction": [15, 18],
+        "transmission_rate.district1": {"start": 0.5, "stop": 1.0, "num": 3}
+    }
+
+Usage:
+    python -m covid_19_model.batch --sweep sweep.json --replicates 10 --steps 120
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from covid_19_model.model import Covid19Model
+from covid_19_model.cache import PopulationCache, ResultCache
+from covid_19_model.ensemble import EnsembleStatistics
+from covid_19_model.recorder import RECORDED_DISTRICTS
+from covid_19_model.replicates import run_model, seeds_for
+from covid_19_model.utils import parse_json, apply_overrides, expand_sweep
+import contextlib
+import argparse
+import json
+import csv
+import os
+
+def run_task(task):
+    """
+    Builds and runs the model of one (run, replicate) pair
+    """
+    run, replicate, seed, variable_params, fixed_params, steps, engine, population_cache, result_cache = task
+    population_cache = PopulationCache(population_cache) if population_cache else None
+    if result_cache:
+        directory, max_bytes = result_cache
+        result = ResultCache(directory, max_bytes).run(
+            variable_params, fixed_params, steps, engine, seed, population_cache = population_cache)
+    else:
+        model = Covid19Model(
+            variable_params,
+            fixed_params,
+            engine = engine,
+            seed = seed,
+            population_cache = population_cache)
+        result = run_model(model, steps)
+    result.update(run = run, replicate = replicate, seed = seed)
+    return result
+
+def write_result(series_writer, summary_writer, result):
+    """
+    Writes the SEIR series (unless series_writer is None) and summary peaks
+    of one result
+    """
+    run, replicate = result["run"], result["replicate"]
+
+    if series_writer is not None:
+        for step, counts in enumerate(result["history"]):
+            for district, (S, E, I, R) in zip(RECORDED_DISTRICTS, counts):
+                series_writer.writerow([run, replicate, step, district, S, E, I, R])
+
+    for district in RECORDED_DISTRICTS:
+        max_exposed, max_exposed_step = result["summary"][district]["max_exposed"]
+        max_infected, max_infected_step = result["summary"][district]["max_infected"]
+        summary_writer.writerow([
+            run, replicate, result["seed"], len(result["history"]) - 1, district,
+            max_exposed, max_exposed_step, max_infected, max_infected_step])
+
+def run_batch(
+    variable_params,
+    fixed_params,
+    sweep,
+    replicates,
+    steps,
+    output,
+    engine = "object",
+    seed = None,
+    workers = None,
+    population_cache = None,
+    ensemble = False,
+    result_cache = None,
+):
+    """
+    Runs every (run, replicate) pair of the sweep and writes the results.
+    With ensemble, the SEIR series of each run's replicates are aggregated
+    as they finish rather than written. result_cache is a
+    (directory, max_bytes) pair of a covid_19_model.cache.ResultCache.
+    """
+    runs = expand_sweep(sweep)
+    seeds = iter(seeds_for(seed, len(runs) * replicates))
+    tasks = [
+        (run, replicate, next(seeds), variable_params,
+         apply_overrides(fixed_params, overrides), steps, engine, population_cache, result_cache)
+        for run, overrides in enumerate(runs)
+        for replicate in range(replicates)
+    ]
+
+    os.makedirs(output, exist_ok = True)
+    with open(os.path.join(output, "runs.json"), "w") as file:
+        json.dump([dict(overrides, run = run) for run, overrides in enumerate(runs)], file, indent = 2)
+
+    ensembles = [EnsembleStatistics(steps) for _ in runs] if ensemble else None
+    cache = {"hits": 0, "misses": 0}
+
+    with contextlib.ExitStack() as files:
+        summary_writer = csv.writer(files.enter_context(
+            open(os.path.join(output, "summary.csv"), "w", newline = "")))
+        series_writer = None
+        if ensembles is None:
+            series_writer = csv.writer(files.enter_context(
+                open(os.path.join(output, "series.csv"), "w", newline = "")))
+            series_writer.writerow(["run", "replicate", "step", "district", "S", "E", "I", "R"])
+        summary_writer.writerow([
+            "run", "replicate", "seed", "steps", "district",
+            "max_exposed", "max_exposed_step", "max_infected", "max_infected_step"])
+
+        with ProcessPoolExecutor(workers) as executor:
+            # Only as_completed holds the futures, which it drops once
+            # yielded, so finished results are not kept
+            for future in as_completed([executor.submit(run_task, task) for task in tasks]):
+                result = future.result()
+                if result_cache:
+                    cache["hits" if result["cached"] else "misses"] += 1
+                if ensembles is not None:
+                    ensembles[result["run"]].add_result(result)
+                write_result(series_writer, summary_writer, result)
+
+    if ensembles is not None:
+        with open(os.path.join(output, "ensemble.json"), "w") as file:
+            json.dump([dict(ensemble.to_dict(), run = run) for run, ensemble in enumerate(ensembles)], file)
+
+    if result_cache:
+        with open(os.path.join(output, "cache.json"), "w") as file:
+            json.dump(cache, file)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Headless batch runs of the COVID-19 model")
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--sweep", help = "JSON sweep spec; omit for a single run")
+    parser.add_argument("--replicates", type = int, default = 1)
+    parser.add_argument("--steps", type = int, default = 100)
+    parser.add_argument("--engine", choices = Covid19Model.ENGINES, default = "object")
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--workers", type = int)
+    parser.add_argument("--output", default = "results")
+    parser.add_argument("--population-cache", help = "directory of the synthesized population cache")
+    parser.add_argument("--ensemble", action = "store_true",
+        help = "write streaming statistics of each run's replicates instead of series.csv")
+    parser.add_argument("--result-cache", help = "directory of the run result cache (seeded runs only)")
+    parser.add_argument("--result-cache-mb", type = float, default = 2048, help = "size budget of the result cache")
+    args = parser.parse_args(argv)
+
+    run_batch(
+        variable_params = parse_json(args.variable),
+        fixed_params = parse_json(args.fixed),
+        sweep = parse_json(args.sweep) if args.sweep else {},
+        replicates = args.replicates,
+        steps = args.steps,
+        output = args.output,
+        engine = args.engine,
+        seed = args.seed,
+        workers = args.workers,
+        population_cache = args.population_cache,
+        ensemble = args.ensemble,
+        result_cache = (args.result_cache, int(args.result_cache_mb * 1024 ** 2)) if args.result_cache else None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# cache.py
+
+"""
+Content-addressed on-disk caches.
+
+DiskCache stores each entry as a directory named after the hash of its key
+and evicts the least recently used entries once the cache exceeds its size
+budget. Entries are written to a temporary directory and renamed into place,
+so concurrent processes never see half-written entries.
+
+PopulationCache keeps synthesized populations (see covid_19_model.population)
+as one .npy file per column, loaded memory-mapped on later launches with
+identical inputs.
+
+ResultCache keeps the results of whole runs (SEIR history and summary
+peaks) keyed by the parameters, engine, seed, horizon and code version, so
+that rerunning a seeded scenario only reads a small .npz file.
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.population import synthesize_population
+from covid_19_model.recorder import RECORDED_DISTRICTS
+from covid_19_model.replicates import run_model
+import numpy as np
+import hashlib
+import shutil
+import json
+import time
+import os
+
+def content_hash(*parts):
+    """
+    Returns the SHA-256 of the canonical JSON of the given parts
+    """
+    canonical = json.dumps(parts, sort_keys = True, separators = (",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def file_hash(filename):
+    """
+    Returns the SHA-256 of a file's content
+    """
+    with open(filename, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+# SHA-256 of the package's code and resources, computed once per process
+_code_version = None
+
+def code_version():
+    """
+    Returns the hash of every source and resource file of the package, so
+    that cached results do not outlive a change of the model
+    """
+    global _code_version
+    if _code_version is None:
+        package = os.path.dirname(os.path.abspath(__file__))
+        files = sorted(
+            os.path.relpath(os.path.join(root, name), package)
+            for root, _, names in os.walk(package)
+            for name in names
+            if name.endswith((".py", ".geojson")))
+        _code_version = content_hash([[name, file_hash(os.path.join(package, name))] for name in files])
+    return _code_version
+
+class DiskCache:
+    """
+    Directory of content-addressed entries with size-based LRU eviction.
+
+    Properties:
+        directory: Root of the cache
+        max_bytes: Size budget; once a put exceeds it, least recently used
+            entries are evicted until the cache fits LOW_WATER of it
+        size: Running total of the entries' bytes, as of the last scan of
+            the directory plus the entries put since (None before the first
+            put). Entries put by other processes are only counted at the
+            next scan, which happens whenever the total exceeds max_bytes.
+        hits, misses: Lookup counters of this instance
+    """
+
+    # Fraction of max_bytes left after an eviction, so that the directory
+    # is scanned once per burst of puts rather than on every put
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, max_bytes = 2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Returns the directory of an entry, or None if it is not cached
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+
+        # Marks the entry as recently used
+        os.utime(path)
+        self.hits += 1
+        return path
+
+    def put(self, key, write):
+        """
+        Creates an entry by calling write(directory) on a temporary directory
+        and returns the entry's directory
+        """
+        path = self.path(key)
+        temporary = "%s.tmp.%d.%d" % (path, os.getpid(), time.monotonic_ns())
+        os.makedirs(temporary)
+
+        try:
+            write(temporary)
+            os.replace(temporary, path)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(temporary, ignore_errors = True)
+            if not os.path.isdir(path):
+                raise
+        else:
+            if self.size is not None:
+                self.size += self.entry_size(path)
+
+        # Only lists the directory on the first put and when over budget
+        if self.size is None or self.size > self.max_bytes:
+            self.evict(keep = key)
+        return path
+
+    def entry_size(self, path):
+        """
+        Returns the size in bytes of the files of an entry
+        """
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names)
+
+    def entries(self):
+        """
+        Returns (last use, size in bytes, key) of every entry
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.path(key)
+            if ".tmp." in key or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), self.entry_size(path), key))
+        return entries
+
+    def evict(self, keep = None):
+        """
+        Removes least recently used entries, if the cache exceeds max_bytes,
+        until it fits LOW_WATER of it
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes if total <= self.max_bytes else self.LOW_WATER * self.max_bytes
+
+        for _, size, key in entries:
+            if total <= target:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors = True)
+            total -= size
+
+        self.size = total
+
+class PopulationCache(DiskCache):
+    """
+    Cache of synthesized populations keyed by the age group x district
+    matrices, the behavior percentages, the seed and the district geometry.
+    """
+
+    VERSION = 1
+
+    def key(self, model, variable_params):
+        seed = model.streams.seed_sequence
+        return content_hash(
+            "population",
+            self.VERSION,
+            [variable_params[compartment] for compartment in ("susceptible", "exposed", "infected")],
+            model.wearing_mask_percentage,
+            model.physical_distancing_percentage,
+            model.mobile_worker_percentage,
+            str(seed.entropy),
+            list(seed.spawn_key),
+            file_hash(model.grid.quezon_city_districts_geojson))
+
+    def population(self, model, variable_params):
+        """
+        Returns the model's population columns, memory-mapped from the cache
+        or synthesized (with the model's "population" stream) and stored
+        """
+        key = self.key(model, variable_params)
+        path = self.get(key)
+
+        if path is None:
+            population = synthesize_population(
+                variable_params,
+                model.grid,
+                model.streams["population"],
+                model.wearing_mask_percentage,
+                model.physical_distancing_percentage,
+                model.mobile_worker_percentage)
+
+            def write(directory):
+                for name, column in population.items():
+                    np.save(os.path.join(directory, name + ".npy"), column)
+
+            self.put(key, write)
+            return population
+
+        return {
+            name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode = "r")
+            for name in os.listdir(path)
+            if name.endswith(".npy")
+        }
+
+class ResultCache(DiskCache):
+    """
+    Cache of run results keyed by the variable and fixed parameters, the
+    engine, the seed, the horizon and the code version (see code_version).
+    An entry is a result.npz holding the (steps + 1, 7, 4) int32 SEIR
+    history and the (7, 2, 2) summary peaks (max_exposed, max_infected;
+    height, step). Runs without a seed are not reproducible and never
+    cached.
+    """
+
+    VERSION = 1
+
+    # Summary peaks, in the order of the stored array
+    PEAKS = ("max_exposed", "max_infected")
+
+    def __init__(self, directory, max_bytes = 2 * 1024 ** 3):
+        super().__init__(directory, max_bytes)
+        self.code_version = code_version()
+
+    def key(self, variable_params, fixed_params, engine, seed, steps):
+        return content_hash(
+            "result",
+            self.VERSION,
+            self.code_version,
+            variable_params,
+            fixed_params,
+            engine,
+            seed,
+            steps)
+
+    def load(self, key):
+        """
+        Returns the cached result of a key (see covid_19_model.replicates.run_model),
+        or None
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+
+        with np.load(os.path.join(path, "result.npz")) as data:
+            history = data["history"].astype(np.int64)
+            peaks = data["summary"].tolist()
+        summary = {
+            district: {peak: tuple(peaks[i][k]) for k, peak in enumerate(self.PEAKS)}
+            for i, district in enumerate(RECORDED_DISTRICTS)
+        }
+        return {"history": history, "summary": summary}
+
+    def store(self, key, result):
+        """
+        Stores the result of run_model under a key
+        """
+        summary = np.array(
+            [[result["summary"][district][peak] for peak in self.PEAKS] for district in RECORDED_DISTRICTS],
+            dtype = np.int64)
+
+        def write(directory):
+            np.savez_compressed(
+                os.path.join(directory, "result.npz"),
+                history = np.asarray(result["history"], dtype = np.int32),
+                summary = summary)
+
+        self.put(key, write)
+
+    def run(self, variable_params, fixed_params, steps, engine = "object", seed = None, **kwargs):
+        """
+        Returns the result of run_model for a model built with these
+        arguments (kwargs are passed to Covid19Model), from the cache when
+        the same run has been stored, with "cached" telling which
+        """
+        key = None if seed is None else self.key(variable_params, fixed_params, engine, seed, steps)
+        result = None if key is None else self.load(key)
+        if result is not None:
+            result["cached"] = True
+            return result
+
+        model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed, **kwargs)
+        result = run_model(model, steps)
+        if key is not None:
+            self.store(key, result)
+        result["cached"] = False
+        return result
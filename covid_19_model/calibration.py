@@ -0,0 +1,424 @@
+# calibration.py
+
+"""
+Calibration of fixed parameters against observed district series.
+
+Approximate Bayesian computation with a sequence of shrinking thresholds
+(ABC-SMC): round 0 samples candidate parameter sets from uniform priors,
+later rounds perturb the accepted sets of the previous round with a
+Gaussian kernel and importance weights. A candidate is accepted if the
+distance between its simulated series and the observed ones is at most the
+round's threshold; the threshold of each round after the first is a
+quantile of the previous round's accepted distances.
+
+The distance is the root mean square error over every observed
+(step, district, compartment) value. Since the sum of squared errors only
+grows with the steps, a run is cut short as soon as its partial sum
+exceeds what the threshold allows, which makes most rejected candidates
+cost a few steps instead of a whole run.
+
+As in covid_19_model.replicates, the model is built once in the parent
+process and every candidate runs in a process forked from it, with its own
+parameters and seed. Calibrated parameters cannot include the behavior
+percentages that shape the synthesized population, nor the distances that
+size the spatial indexes built with the model.
+
+Observed series are a CSV file with step, district and compartment columns
+(the layout of covid_19_model.batch's series.csv, any subset of S, E, I, R,
+empty cells for missing values) or a JSON object
+{"district1": {"I": [...], ...}, ..., "total": {...}} of series from step 0.
+
+Priors are a JSON object mapping fixed_parameters.json keys to [low, high].
+A per-district key samples every district independently; "key.districtN"
+samples a single district.
+
+Output directory:
+    fixed_parameters.json: fixed parameters at the weighted posterior mean
+    accepted/fixed_parameters_<k>.json: every accepted parameter set
+    particles.csv: particle, weight, distance and calibrated values
+    rounds.json: threshold, candidates, acceptances and simulated steps of
+        every round
+
+Usage:
+    python -m covid_19_model.calibration --observed observed.csv --particles 100 --rounds 4
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.recorder import RECORDED_DISTRICTS, COMPARTMENTS
+from covid_19_model.replicates import record, extinct
+from covid_19_model.space import QuezonCity
+from covid_19_model.utils import parse_json, apply_overrides
+from scipy.special import ndtr
+import multiprocessing
+import numpy as np
+import argparse
+import logging
+import json
+import csv
+import gc
+import os
+
+logger = logging.getLogger(__name__)
+
+# Priors of the rates fitted outside the model so far
+DEFAULT_PRIORS = {
+    "transmission_rate": [0.1, 1.5],
+    "removal_rate": [0.05, 0.5],
+}
+
+# Parameters read when the population is synthesized
+POPULATION_PARAMETERS = (
+    "wearing_mask_percentage",
+    "physical_distancing_percentage",
+    "mobile_worker_percentage",
+)
+
+# Parameters that size the spatial hash of QuezonCity and the cells of the
+# hybrid engine, which are built with the model
+SPATIAL_PARAMETERS = (
+    "agent_exposure_distance",
+    "agent_mobility_range",
+)
+
+# Model and observed series shared with the forked workers
+_parent_model = None
+_observed = None
+
+def load_observed(filename):
+    """
+    Returns observed series as a (steps + 1, 7, 4) array (see
+    covid_19_model.recorder), nan where nothing was observed
+    """
+    if filename.endswith(".csv"):
+        with open(filename, newline = "") as file:
+            rows = list(csv.DictReader(file))
+        series = {}
+        for row in rows:
+            for compartment in COMPARTMENTS:
+                if row.get(compartment, "") != "":
+                    series.setdefault(row["district"], {}).setdefault(compartment, {})[int(row["step"])] = float(row[compartment])
+        series = {
+            district: {
+                compartment: [values.get(step) for step in range(max(values) + 1)]
+                for compartment, values in compartments.items()
+            }
+            for district, compartments in series.items()
+        }
+    else:
+        series = parse_json(filename)
+
+    steps = max(len(values) for compartments in series.values() for values in compartments.values())
+    observed = np.full((steps, len(RECORDED_DISTRICTS), len(COMPARTMENTS)), np.nan)
+    for district, compartments in series.items():
+        for compartment, values in compartments.items():
+            column = [np.nan if value is None else value for value in values]
+            observed[:len(column), RECORDED_DISTRICTS.index(district), COMPARTMENTS.index(compartment)] = column
+    return observed
+
+def expand_priors(priors, fixed_params):
+    """
+    Returns the prior bounds as (keys, lows, highs), with one key per
+    calibrated value ("key" or "key.districtN")
+    """
+    keys, lows, highs = [], [], []
+    for key, (low, high) in sorted(priors.items()):
+        name, _, district = key.partition(".")
+        if name not in fixed_params:
+            raise KeyError("Unknown parameter: %s" % name)
+        if name in POPULATION_PARAMETERS:
+            raise ValueError("%s shapes the synthesized population and cannot be calibrated" % name)
+        if name in SPATIAL_PARAMETERS:
+            raise ValueError("%s sizes the spatial index of the model and cannot be calibrated" % name)
+
+        if not district and isinstance(fixed_params[name], dict):
+            expanded = ["%s.%s" % (name, district) for district in QuezonCity.DISTRICTS]
+        else:
+            expanded = [key]
+        keys += expanded
+        lows += [low] * len(expanded)
+        highs += [high] * len(expanded)
+    return keys, np.array(lows, dtype = float), np.array(highs, dtype = float)
+
+def apply_parameters(model, fixed_params):
+    """
+    Sets fixed parameters on a built model and refreshes the values derived
+    from them
+    """
+    for key, value in fixed_params.items():
+        setattr(model, key, value)
+    model.fixed_params = fixed_params
+    model.as_infection_probability = model.compute_as_infection_probability(
+        model.as_infection_expectation,
+        model.incubation_rate)
+    model.localized_immunity = model.compute_localized_immunity(
+        model.district_poverty_score,
+        model.natural_immunity,
+        model.preexisting_conditions,
+        model.exercise)
+    model.update_parameters()
+
+def distance_budget(epsilon, observed):
+    """
+    Returns the sum of squared errors above which a run's distance exceeds
+    epsilon
+    """
+    return epsilon ** 2 * np.count_nonzero(~np.isnan(observed))
+
+def simulate_distance(model, observed, epsilon):
+    """
+    Runs a model along the observed steps and returns its distance to the
+    observed series and the number of steps simulated. The run is cut
+    short, with an infinite distance, once the distance must exceed epsilon.
+    """
+    budget = distance_budget(epsilon, observed)
+    total = 0.0
+    for step, counts in enumerate(observed):
+        if step > 0 and model.running and not extinct(model):
+            model.step()
+        error = np.array(record(model)) - counts
+        total += np.nansum(error * error)
+        if total > budget:
+            return np.inf, step
+
+    return float(np.sqrt(total / np.count_nonzero(~np.isnan(observed)))), len(observed) - 1
+
+def _evaluate(args):
+    """
+    Runs one candidate on the forked copy of the parent model
+    """
+    candidate, fixed_params, seed, epsilon = args
+    model = _parent_model
+    model.reseed(seed)
+    apply_parameters(model, fixed_params)
+    distance, steps = simulate_distance(model, _observed, epsilon)
+    return candidate, distance, steps
+
+class Calibration:
+    """
+    Calibration runs the ABC-SMC rounds of one set of observed series.
+
+    Properties:
+        keys: Calibrated values ("key" or "key.districtN")
+        lows, highs: Uniform prior bounds of each key
+        particles: Accepted parameter vectors of the last round (particles x keys)
+        weights: Normalized importance weights of the particles
+        distances: Distances of the particles
+        rounds: Statistics of every round
+    """
+
+    def __init__(self, fixed_params, observed, priors = DEFAULT_PRIORS, seed = None):
+        self.fixed_params = fixed_params
+        self.observed = observed
+        self.keys, self.lows, self.highs = expand_priors(priors, fixed_params)
+        self.rng = np.random.default_rng(seed)
+        self.particles = self.weights = self.distances = self.scale = None
+        self.rounds = []
+
+    def parameters(self, values):
+        """
+        Returns the fixed parameters of a parameter vector
+        """
+        return apply_overrides(self.fixed_params, dict(zip(self.keys, values.tolist())))
+
+    def propose(self, n):
+        """
+        Returns n candidate vectors: from the priors in the first round,
+        then perturbed particles of the previous round inside the priors
+        """
+        if self.particles is None:
+            return self.rng.uniform(self.lows, self.highs, (n, len(self.keys)))
+
+        candidates = np.empty((0, len(self.keys)))
+        while len(candidates) < n:
+            chosen = self.rng.choice(len(self.particles), n, p = self.weights)
+            perturbed = self.particles[chosen] + self.rng.normal(0, self.scale, (n, len(self.keys)))
+            inside = np.all((self.lows <= perturbed) & (perturbed <= self.highs), axis = 1)
+            candidates = np.vstack([candidates, perturbed[inside]])
+        return candidates[:n]
+
+    def importance_weights(self, accepted):
+        """
+        Returns the normalized weights of accepted vectors: the (uniform)
+        prior over the density of the perturbation of the previous round.
+        The kernel of each particle is truncated to the prior bounds (see
+        propose), so it is divided by its mass inside them.
+        """
+        if self.particles is None:
+            return np.full(len(accepted), 1 / len(accepted))
+
+        mass = np.prod(
+            ndtr((self.highs - self.particles) / self.scale) - ndtr((self.lows - self.particles) / self.scale),
+            axis = 1)
+        z = (accepted[:, None, :] - self.particles[None, :, :]) / self.scale
+        density = (self.weights / mass * np.exp(-0.5 * (z * z).sum(axis = 2))).sum(axis = 1)
+        weights = 1 / density
+        return weights / weights.sum()
+
+    def run_round(self, evaluate, n, epsilon, batch_size, max_candidates = None):
+        """
+        Evaluates batches of candidates until n are accepted at epsilon
+        and makes them the particles. evaluate(tasks) returns the
+        (candidate, distance, steps) of each (candidate, fixed_params, seed,
+        epsilon) task.
+        """
+        accepted, distances = [], []
+        candidates = steps = 0
+
+        while len(accepted) < n:
+            if max_candidates is not None and candidates >= max_candidates:
+                break
+            proposals = self.propose(batch_size)
+            seeds = self.rng.integers(0, 2 ** 63, len(proposals))
+            tasks = [
+                (candidates + i, self.parameters(proposal), int(seed), epsilon)
+                for i, (proposal, seed) in enumerate(zip(proposals, seeds))
+            ]
+
+            # Sorted by candidate, so that the result does not depend on
+            # the order in which the workers finish
+            for candidate, distance, simulated in sorted(evaluate(tasks)):
+                steps += simulated
+                if distance <= epsilon and len(accepted) < n:
+                    accepted.append(proposals[candidate - candidates])
+                    distances.append(distance)
+            candidates += len(proposals)
+
+        if len(accepted) < n:
+            logger.warning("round %d: %d of %d particles accepted after %d candidates",
+                len(self.rounds), len(accepted), n, candidates)
+        if not accepted:
+            raise RuntimeError("No candidate accepted at epsilon = %s" % epsilon)
+
+        accepted = np.array(accepted)
+        self.weights = self.importance_weights(accepted)
+        self.particles = accepted
+        self.distances = np.array(distances)
+
+        # Perturbation kernel of the next round: twice the weighted variance
+        mean = self.weights @ accepted
+        self.scale = np.sqrt(2 * (self.weights @ (accepted - mean) ** 2))
+        self.scale = np.where(self.scale > 0, self.scale, 1e-3 * (self.highs - self.lows))
+
+        self.rounds.append({
+            "epsilon": epsilon,
+            "candidates": candidates,
+            "accepted": len(accepted),
+            "steps_simulated": steps,
+            "steps_full": candidates * (len(self.observed) - 1),
+        })
+        logger.info("round %d: epsilon=%s accepted %d/%d, %d of %d steps simulated",
+            len(self.rounds) - 1, epsilon, len(accepted), candidates, steps, candidates * (len(self.observed) - 1))
+
+    def posterior_mean(self):
+        """
+        Returns the fixed parameters at the weighted mean of the particles
+        """
+        return self.parameters(self.weights @ self.particles)
+
+    def write(self, output):
+        """
+        Writes the accepted parameter sets, the posterior mean and the rounds
+        """
+        os.makedirs(os.path.join(output, "accepted"), exist_ok = True)
+        with open(os.path.join(output, "fixed_parameters.json"), "w") as file:
+            json.dump(self.posterior_mean(), file, indent = 4)
+        for k, particle in enumerate(self.particles):
+            with open(os.path.join(output, "accepted", "fixed_parameters_%d.json" % k), "w") as file:
+                json.dump(self.parameters(particle), file, indent = 4)
+
+        with open(os.path.join(output, "particles.csv"), "w", newline = "") as file:
+            writer = csv.writer(file)
+            writer.writerow(["particle", "weight", "distance"] + self.keys)
+            for k, (particle, weight, distance) in enumerate(zip(self.particles, self.weights, self.distances)):
+                writer.writerow([k, weight, distance] + particle.tolist())
+
+        with open(os.path.join(output, "rounds.json"), "w") as file:
+            json.dump(self.rounds, file, indent = 2)
+
+def calibrate(
+    variable_params,
+    fixed_params,
+    observed,
+    priors = DEFAULT_PRIORS,
+    particles = 100,
+    rounds = 3,
+    epsilon = np.inf,
+    quantile = 0.5,
+    engine = "object",
+    seed = None,
+    workers = None,
+    max_candidates = None,
+):
+    """
+    Runs the ABC-SMC rounds in forked workers and returns the Calibration.
+
+    epsilon: Threshold of the first round (inf accepts the first
+    candidates); each later round uses the given quantile of the previous
+    round's distances
+    max_candidates: Candidates evaluated per round at most
+    """
+    global _parent_model, _observed
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("calibrate requires the fork start method")
+
+    calibration = Calibration(fixed_params, observed, priors, seed)
+    _parent_model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed)
+    _observed = observed
+    workers = workers or os.cpu_count()
+
+    # See covid_19_model.replicates
+    gc.collect()
+    gc.freeze()
+
+    try:
+        # One task per worker: each candidate starts from a fresh fork of the
+        # untouched parent model
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, maxtasksperchild = 1) as pool:
+            evaluate = lambda tasks: pool.imap_unordered(_evaluate, tasks, chunksize = 1)
+            for _ in range(rounds):
+                calibration.run_round(evaluate, particles, epsilon, max(particles, workers), max_candidates)
+                epsilon = float(np.quantile(calibration.distances, quantile))
+    finally:
+        gc.unfreeze()
+        _parent_model = _observed = None
+
+    return calibration
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "ABC-SMC calibration of the COVID-19 model")
+    parser.add_argument("--observed", required = True, help = "observed series (.csv or .json)")
+    parser.add_argument("--priors", help = "JSON priors; default: transmission_rate and removal_rate")
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--particles", type = int, default = 100)
+    parser.add_argument("--rounds", type = int, default = 3)
+    parser.add_argument("--epsilon", type = float, default = np.inf, help = "threshold of the first round")
+    parser.add_argument("--quantile", type = float, default = 0.5,
+        help = "quantile of the previous distances used as the next threshold")
+    parser.add_argument("--max-candidates", type = int, help = "candidates per round at most")
+    parser.add_argument("--engine", choices = Covid19Model.ENGINES, default = "object")
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--workers", type = int)
+    parser.add_argument("--output", default = "calibration")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO)
+    calibration = calibrate(
+        variable_params = parse_json(args.variable),
+        fixed_params = parse_json(args.fixed),
+        observed = load_observed(args.observed),
+        priors = parse_json(args.priors) if args.priors else DEFAULT_PRIORS,
+        particles = args.particles,
+        rounds = args.rounds,
+        epsilon = args.epsilon,
+        quantile = args.quantile,
+        engine = args.engine,
+        seed = args.seed,
+        workers = args.workers,
+        max_candidates = args.max_candidates)
+    calibration.write(args.output)
+
+if __name__ == "__main__":
+    main()
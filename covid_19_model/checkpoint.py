@@ -0,0 +1,145 @@
+# checkpoint.py
+
+"""
+Checkpoint and restore of a running Covid19Model.
+
+A checkpoint is a .npz file holding the population as typed columns (no
+pickled PersonAgent or shapely objects) and a JSON document with the rest of
+the model's state:
+    columns: unique_id, x, y, district, state, age, wearing_mask,
+        physical_distancing, mobile_worker, days_incubating, days_infected,
+        transition_step (and grid_order and event_order, the spatial hash and
+        timing wheel insertion orders of the object engine)
+    recorder_counts, recorder_transitions, recorder_relocated: SEIRRecorder
+        history and the relocations not recorded yet
+    meta: engine, parameters, SEIR, summary, step counters and the state
+        of every random number generator
+
+Restoring continues the run exactly where it was saved. Parameter overrides
+given to load_checkpoint branch a scenario from the saved state, e.g.
+load_checkpoint("day60.npz", min_age_restriction = 18).
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.output import agent_columns
+from covid_19_model.parallel import ParallelPopulation
+from covid_19_model.utils import apply_overrides
+import numpy as np
+import json
+
+COLUMNS = (
+    "unique_id", "x", "y", "district", "state", "age",
+    "wearing_mask", "physical_distancing", "mobile_worker",
+    "days_incubating", "days_infected", "transition_step",
+)
+
+# Insertion orders of the object engine
+ORDERS = ("grid_order", "event_order")
+
+def population_columns(model):
+    """
+    Returns the columns of the model's population
+    """
+    population = model.population
+    if population is not None:
+        columns = agent_columns(model)
+        for name in COLUMNS[5:]:
+            columns[name] = getattr(population, name)
+        return columns
+
+    agents = model.schedule.agents
+    columns = agent_columns(model)
+    columns["age"] = np.array([agent.age for agent in agents], dtype = np.int8)
+    for name in ("wearing_mask", "physical_distancing", "mobile_worker"):
+        columns[name] = np.array([getattr(agent, name) for agent in agents], dtype = bool)
+    for name in ("days_incubating", "days_infected"):
+        columns[name] = np.array([getattr(agent, name) for agent in agents], dtype = np.int32)
+    columns["transition_step"] = np.array([agent.transition_step for agent in agents], dtype = np.int64)
+
+    # Insertion order of the spatial hash, which decides the order of
+    # neighbor queries and thus of the interact draws
+    index = {agent: i for i, agent in enumerate(agents)}
+    columns["grid_order"] = np.array(
+        [index[agent] for bucket in model.grid.buckets.values() for agent in bucket],
+        dtype = np.int64)
+
+    # Order of the timing wheel's buckets, which decides the order of the
+    # status draws
+    columns["event_order"] = np.array([index[agent] for agent in model.events.agents()], dtype = np.int64)
+    return columns
+
+def current_fixed_params(model):
+    """
+    Returns the model's fixed parameters with their current values
+    """
+    return {key: getattr(model, key, value) for key, value in model.fixed_params.items()}
+
+def save_checkpoint(model, filename, compressed = False):
+    """
+    Saves the full state of a model to a .npz file
+    """
+    if model.engine in ("hybrid", "compartmental"):
+        raise ValueError("Checkpoints of the %s engine are not supported" % model.engine)
+    if isinstance(model.population, ParallelPopulation):
+        raise ValueError("Checkpoints of a parallelized model are not supported")
+
+    meta = {
+        "engine": model.engine,
+        "variable_params": model.variable_params,
+        "fixed_params": current_fixed_params(model),
+        "SEIR": model.SEIR,
+        "summary": model.summary,
+        "steps": model.steps,
+        "running": model.running,
+        "schedule": {"steps": model.schedule.steps, "time": model.schedule.time},
+        "random": model.random.getstate(),
+        "streams": model.streams.get_state(),
+    }
+
+    arrays = population_columns(model)
+    arrays["recorder_counts"] = model.recorder.counts
+    arrays["recorder_transitions"] = model.recorder.transitions
+    arrays["recorder_relocated"] = model.recorder.relocated
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    save = np.savez_compressed if compressed else np.savez
+    save(filename, **arrays)
+
+def load_checkpoint(filename, **overrides):
+    """
+    Restores a model saved by save_checkpoint. Keyword arguments override
+    fixed parameters (see covid_19_model.utils.apply_overrides for per-district keys)
+    """
+    with np.load(filename) as data:
+        meta = json.loads(data["meta"].item())
+        population = {name: data[name] for name in data.files if name in COLUMNS or name in ORDERS}
+        counts = data["recorder_counts"]
+        transitions = data["recorder_transitions"]
+        relocated = data["recorder_relocated"] if "recorder_relocated" in data.files else None
+
+    model = Covid19Model(
+        meta["variable_params"],
+        apply_overrides(meta["fixed_params"], overrides),
+        engine = meta["engine"],
+        population = population)
+
+    model.SEIR = meta["SEIR"]
+    model.summary = {
+        district: {key: tuple(value) for key, value in peaks.items()}
+        for district, peaks in meta["summary"].items()
+    }
+    model.steps = meta["steps"]
+    model.running = meta["running"]
+    model.schedule.steps = meta["schedule"]["steps"]
+    model.schedule.time = meta["schedule"]["time"]
+
+    version, internal_state, gauss_next = meta["random"]
+    model.random.setstate((version, tuple(internal_state), gauss_next))
+    model.streams.set_state(meta["streams"])
+    model.recorder.restore(counts, transitions, relocated)
+
+    # Pending status transitions were drawn with the saved parameters (or
+    # not saved, by earlier versions)
+    if overrides or "transition_step" not in population:
+        model.update_parameters()
+    return model
@@ -0,0 +1,324 @@
+# compartmental.py
+
+"""
+Stochastic compartmental engine of Covid19Model.
+
+The six districts are patches of a chain-binomial SEIR model advanced with
+tau-leaping, one leap per model step. No person is simulated: each district
+holds S, E, I and R counts, the susceptible counts split into the four
+behavior classes (wearing_mask, physical_distancing) so that mask and
+distancing protection act as in the ABM. Select it with
+Covid19Model(..., engine = "compartmental"), or advance thousands of
+parameter sets at once with CompartmentalSEIR (see covid_19_model.screening).
+
+A step draws, as the vectorized engine applies:
+    I -> R: Binomial(I, removal_rate)
+    E -> I: Binomial(E, as_infection_probability)
+    S -> E: Binomial(S, 1 - exp(-susceptibility * sum_j K[d, j] * beta_j * I_j))
+where beta_j is the transmission rate of district j (at most 1) and
+susceptibility the one of the class (see covid_19_model.utils.susceptibility).
+The E -> I and I -> R draws are the geometric waiting times of the ABM
+applied to whole compartments, and the S -> E draw is the probability of
+escaping a Poisson number of contacts, each one tossed as in
+PersonAgent.interact.
+
+K[d, j] is the expected number of persons of district j within
+agent_exposure_distance r of a person of district d, per person of d and j,
+for persons spread uniformly over their districts (as synthesized). It is
+the volume of pairs closer than r, divided by the two areas; near a border
+of length L the pairs across are about 2/3 r^3 L (see contact_volumes).
+
+Differences with the ABM:
+    - Districts are well mixed: there is no spatial clustering of the
+      infections within a district, so epidemics grow faster than in the
+      ABM when contacts are local.
+    - Movement does not change the mixing: min_age_restriction,
+      max_age_restriction, mobile_worker_percentage, agent_mobility_range,
+      track_districts and city_boundary have no effect.
+"""
+
+from covid_19_model.enum.state import StateCode
+from covid_19_model.space import QuezonCity
+from covid_19_model.vectorized import district_array, report_transitions
+from covid_19_model.utils import susceptibility
+import numpy as np
+import math
+
+SUSCEPTIBLE = StateCode.SUSCEPTIBLE
+EXPOSED = StateCode.EXPOSED
+INFECTED = StateCode.INFECTED
+REMOVED = StateCode.REMOVED
+
+# Behavior classes of the susceptible counts: (wearing_mask, physical_distancing)
+CLASSES = ((False, False), (False, True), (True, False), (True, True))
+WEARING_MASK = np.array([wearing_mask for wearing_mask, _ in CLASSES])
+PHYSICAL_DISTANCING = np.array([physical_distancing for _, physical_distancing in CLASSES])
+
+# Mixing matrices by exposure distance, shared by every model of the process
+_mixing = {}
+
+def contact_volumes(shapes, distance):
+    """
+    Returns the (6, 6) measures of the pairs of points of districts d and j
+    closer than distance. Within a district: pi r^2 A_d, less the pairs cut
+    off by its border; across districts: the pairs within the strip of
+    width r along the shared border (2/3 r^2 per unit of strip area, exact
+    for straight borders).
+    """
+    r = distance
+    edge = 2 / 3 * r ** 2
+    buffers = [shape.buffer(r) for shape in shapes]
+    volumes = np.zeros((len(shapes), len(shapes)))
+
+    for d, shape in enumerate(shapes):
+        for j, other in enumerate(shapes):
+            if d == j:
+                volumes[d, j] = math.pi * r ** 2 * shape.area - edge * buffers[d].difference(shape).area
+            else:
+                volumes[d, j] = edge * buffers[d].intersection(other).area
+
+    # The strips of d in j and of j in d measure the same pairs
+    return (volumes + volumes.T) / 2
+
+def mixing_matrix(grid, distance):
+    """
+    Returns K (see above) of the districts of a QuezonCity for an exposure
+    distance, computed once per process
+    """
+    if distance not in _mixing:
+        shapes = [grid.districts[district].shape for district in QuezonCity.DISTRICTS]
+        areas = np.array([shape.area for shape in shapes])
+        _mixing[distance] = contact_volumes(shapes, distance) / np.outer(areas, areas)
+    return _mixing[distance]
+
+def district_parameters(params):
+    """
+    Returns the per-district arrays used by a step, from an object with the
+    attributes of Covid19Model (the model itself or any namespace holding
+    the same fixed and derived parameters)
+    """
+    localized_immunity = district_array(params.localized_immunity)
+    return {
+        "transmission_rate": np.minimum(district_array(params.transmission_rate), 1.0),
+        "as_infection_probability": district_array(params.as_infection_probability),
+        "removal_rate": district_array(params.removal_rate),
+        "susceptibility": susceptibility(
+            localized_immunity[:, None],
+            WEARING_MASK,
+            params.wearing_mask_protection,
+            PHYSICAL_DISTANCING,
+            params.physical_distancing_protection),
+    }
+
+def class_probabilities(params):
+    """
+    Returns the probabilities of the behavior classes of a person
+    (independent mask and distancing flags, as synthesized)
+    """
+    mask = np.where(WEARING_MASK, params.wearing_mask_percentage, 1 - params.wearing_mask_percentage)
+    distancing = np.where(
+        PHYSICAL_DISTANCING,
+        params.physical_distancing_percentage,
+        1 - params.physical_distancing_percentage)
+    return mask * distancing
+
+class CompartmentalSEIR:
+    """
+    CompartmentalSEIR advances a batch of independent runs (scenarios or
+    replicates) of the district SEIR model at once.
+
+    Properties:
+        grid: QuezonCity whose districts are the patches
+        streams: RandomStreams of the draws (phases "population", "status"
+            and "interact")
+        S: (runs, 6, 4) susceptible persons by district and behavior class
+            (see CLASSES)
+        E, I, R: (runs, 6) exposed, infected and removed persons
+        mixing: (runs, 6, 6) K of every run
+        transmission_rate, as_infection_probability, removal_rate: (runs, 6)
+        susceptibility: (runs, 6, 4)
+    """
+
+    def __init__(self, counts, params, grid, streams):
+        """
+        counts: (runs, 6, 4) initial S, E, I, R counts (or (6, 4) shared by
+        every run)
+        params: One object with the attributes of Covid19Model per run
+        (see district_parameters); the susceptible persons are split into
+        behavior classes with its percentages
+        """
+        self.grid = grid
+        self.streams = streams
+        counts = np.broadcast_to(np.asarray(counts, dtype = np.int64), (len(params), len(QuezonCity.DISTRICTS), 4))
+
+        probabilities = {id(run): class_probabilities(run) for run in params}
+        probabilities = np.array([probabilities[id(run)] for run in params])
+        self.S = streams["population"].multinomial(counts[:, :, SUSCEPTIBLE], probabilities[:, None, :])
+        self.E = counts[:, :, EXPOSED].copy()
+        self.I = counts[:, :, INFECTED].copy()
+        self.R = counts[:, :, REMOVED].copy()
+        self.set_parameters(params)
+
+    def __len__(self):
+        return len(self.E)
+
+    def set_parameters(self, params):
+        """
+        Reads the parameters of every run. Waiting times are memoryless, so
+        new rates apply from the next step on without any redraw.
+        """
+        # Replicates usually share their parameter object
+        arrays = {}
+        for run in params:
+            if id(run) not in arrays:
+                arrays[id(run)] = district_parameters(run)
+                arrays[id(run)]["mixing"] = mixing_matrix(self.grid, run.agent_exposure_distance)
+        for name in ("transmission_rate", "as_infection_probability", "removal_rate", "susceptibility", "mixing"):
+            setattr(self, name, np.array([arrays[id(run)][name] for run in params]))
+
+    def counts(self):
+        """
+        Returns the (runs, 6, 4) S, E, I, R counts
+        """
+        return np.stack([self.S.sum(axis = 2), self.E, self.I, self.R], axis = 2)
+
+    def status(self):
+        """
+        Draws the I -> R and E -> I transitions of a step and returns their
+        (runs, 6) counts. Only the runs with exposed or infected persons
+        draw.
+        """
+        rng = self.streams["status"]
+        runs = np.flatnonzero(self.E.any(axis = 1) | self.I.any(axis = 1))
+        removals = np.zeros_like(self.I)
+        onsets = np.zeros_like(self.E)
+        removals[runs] = rng.binomial(self.I[runs], self.removal_rate[runs])
+        onsets[runs] = rng.binomial(self.E[runs], self.as_infection_probability[runs])
+        self.I += onsets - removals
+        self.E -= onsets
+        self.R += removals
+        return removals, onsets
+
+    def interact(self):
+        """
+        Draws the S -> E transitions of a step and returns their (runs, 6)
+        counts. Only the runs with infected persons draw.
+        """
+        runs = np.flatnonzero(self.I.any(axis = 1))
+        force = np.einsum("rdj,rj->rd", self.mixing[runs], self.transmission_rate[runs] * self.I[runs])
+        probability = -np.expm1(-force[:, :, None] * self.susceptibility[runs])
+        exposures = self.streams["interact"].binomial(self.S[runs], probability)
+        self.S[runs] -= exposures
+
+        exposed = np.zeros_like(self.E)
+        exposed[runs] = exposures.sum(axis = 2)
+        self.E += exposed
+        return exposed
+
+class CompartmentalPopulation:
+    """
+    CompartmentalPopulation steps a single run of CompartmentalSEIR as the
+    population of a Covid19Model, reporting its transitions to the model's
+    SEIR counts, summary, recorder and charts like the other engines.
+
+    Properties:
+        model: Model which the population belongs to
+        seir: CompartmentalSEIR of one run
+        interacting, candidates_examined, contacts, moved: Counters of the
+            last step (infected persons; no contacts are examined and no
+            person moves)
+    """
+
+    # Phases of a step, in order
+    PHASES = ("status", "interact")
+
+    def __init__(self, model):
+        self.model = model
+        counts = [model.get_SEIR(district) for district in QuezonCity.DISTRICTS]
+        self.seir = CompartmentalSEIR(counts, [model], model.grid, model.streams)
+        self.interacting = self.candidates_examined = self.contacts = self.moved = 0
+
+    def __len__(self):
+        return int(self.seir.counts().sum())
+
+    def update_parameters(self):
+        """
+        Reads the parameters and the random streams of the model again
+        after changing any of them (e.g. after Covid19Model.reseed)
+        """
+        self.seir.streams = self.model.streams
+        self.seir.set_parameters([self.model])
+
+    def redraw_transitions(self):
+        """
+        Draws the next transitions from the model's current streams (the
+        counts have no pending transitions to redraw)
+        """
+        self.seir.streams = self.model.streams
+
+    def step(self):
+        """
+        Advances the population by a step
+        """
+        for phase in self.PHASES:
+            getattr(self, phase)()
+
+    def status(self):
+        """
+        E -> I and I -> R transitions of every district
+        """
+        removals, onsets = self.seir.status()
+        report_transitions(self.model, removals[0], INFECTED, REMOVED)
+        report_transitions(self.model, onsets[0], EXPOSED, INFECTED, "max_infected")
+
+    def interact(self):
+        """
+        Susceptible persons of every district become exposed
+        """
+        self.interacting = int(self.seir.I.sum())
+        exposed = self.seir.interact()
+        report_transitions(self.model, exposed[0], SUSCEPTIBLE, EXPOSED, "max_exposed")
+
+def recorded(counts):
+    """
+    Returns (runs, 6, ...) counts with the city total appended as a seventh
+    district (see covid_19_model.recorder.RECORDED_DISTRICTS)
+    """
+    return np.concatenate([counts, counts.sum(axis = 1, keepdims = True)], axis = 1)
+
+def run_seir(seir, steps, history = False):
+    """
+    Advances every run of a CompartmentalSEIR by at most the given number of
+    steps (the batch stops early once every epidemic has died out, after
+    which the counts no longer change) and returns:
+        peaks, peak_steps: (runs, 7, 2) heights and steps of the summary
+            peaks of Covid19Model, max_exposed then max_infected
+        counts: (runs, 7, 4) final S, E, I, R counts
+        history: (runs, steps + 1, 7, 4) counts of every step, if history
+    """
+    counts = recorded(seir.counts())
+    peaks = counts[:, :, [EXPOSED, INFECTED]].copy()
+    peak_steps = np.zeros_like(peaks)
+    series = [counts] if history else None
+
+    for step in range(1, steps + 1):
+        if not (seir.E.any() or seir.I.any()):
+            break
+
+        # Peaks are updated after the phase that raises them, and only on
+        # strict increases, as Covid19Model.update_summary does
+        for phase, compartment, peak in ((seir.status, "I", 1), (seir.interact, "E", 0)):
+            phase()
+            values = recorded(getattr(seir, compartment))
+            higher = values > peaks[:, :, peak]
+            peaks[:, :, peak][higher] = values[higher]
+            peak_steps[:, :, peak][higher] = step
+
+        if history:
+            series.append(recorded(seir.counts()))
+
+    result = {"peaks": peaks, "peak_steps": peak_steps, "counts": recorded(seir.counts())}
+    if history:
+        padding = [series[-1]] * (steps + 1 - len(series))
+        result["history"] = np.stack(series + padding, axis = 1)
+    return result
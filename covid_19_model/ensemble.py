@@ -0,0 +1,297 @@
+# ensemble.py
+
+"""
+Streaming statistics of an ensemble of replicates.
+
+EnsembleStatistics folds the SEIR counts of replicates into running
+statistics as they arrive, one step or one replicate at a time, instead of
+keeping every replicate's history. Its memory only depends on the horizon
+(steps) and on the number of tracked quantiles, not on the number of
+replicates, and every statistic can be queried at any time:
+    series: count, mean, variance (Welford's algorithm) and approximate
+        quantiles (the P-square algorithm of Jain and Chlamtac, five
+        markers per quantile) of the (steps + 1, 7, 4) SEIR counts
+    peaks: the same statistics of the summary peak heights, (7, 2) for
+        max_exposed and max_infected
+    peak_times: exact histogram of the summary peak steps, (7, 2, steps + 1)
+
+Usage:
+    ensemble = run_ensemble(variable_params, fixed_params, 1000, 120)
+    ensemble.band("total", "I")
+"""
+
+from covid_19_model.recorder import RECORDED_DISTRICTS, COMPARTMENTS
+from covid_19_model.replicates import iterate_replicates
+import numpy as np
+import json
+
+# Quantiles tracked by default
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# Summary peaks, in the order of the peaks and peak_times arrays
+PEAKS = ("max_exposed", "max_infected")
+
+# Observations kept before the quantile markers are initialized
+MARKERS = 5
+
+class RunningStatistics:
+    """
+    Running count, mean, variance and quantile estimates of every element
+    of a fixed-shape array of observations.
+
+    Properties:
+        shape: Shape of an observation
+        quantiles: Probabilities of the tracked quantiles
+        count, mean, m2: Per-element number of observations, mean and sum of
+            squared deviations from the mean (flattened)
+        heights, positions: P-square markers (quantiles x 5 x elements)
+    """
+
+    def __init__(self, shape, quantiles = QUANTILES):
+        self.shape = tuple(shape)
+        self.quantiles = tuple(quantiles)
+        size = int(np.prod(self.shape))
+        self.count = np.zeros(size, dtype = np.int64)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.first = np.full((MARKERS, size), np.nan)
+        self.heights = np.zeros((len(self.quantiles), MARKERS, size))
+        self.positions = np.zeros((len(self.quantiles), MARKERS, size))
+
+        # Desired marker positions after n observations: 1 + (n - 1) * increments
+        p = np.array(self.quantiles)[:, None]
+        self.increments = np.hstack([0 * p, p / 2, p, (1 + p) / 2, 0 * p + 1])[:, :, None]
+        self.index = np.arange(size).reshape(self.shape)
+
+    def add(self, values, index = Ellipsis):
+        """
+        Adds one observation of the elements selected by index (all of them
+        by default); values is broadcast to their shape
+        """
+        cells = self.index[index].ravel()
+        x = np.broadcast_to(np.asarray(values, dtype = float), self.index[index].shape).ravel()
+
+        # Welford's update
+        count = self.count[cells] + 1
+        delta = x - self.mean[cells]
+        mean = self.mean[cells] + delta / count
+        self.m2[cells] += delta * (x - mean)
+        self.mean[cells] = mean
+        self.count[cells] = count
+
+        # The first observations are kept to initialize the markers
+        starting = count <= MARKERS
+        if starting.any():
+            self.first[count[starting] - 1, cells[starting]] = x[starting]
+            full = cells[starting & (count == MARKERS)]
+            self.heights[:, :, full] = np.sort(self.first[:, full], axis = 0)
+            self.positions[:, :, full] = np.arange(1, MARKERS + 1)[:, None]
+
+        updating = ~starting
+        if updating.any():
+            cells = cells[updating]
+            heights = self.heights[:, :, cells]
+            positions = self.positions[:, :, cells]
+            self.update_markers(heights, positions, x[updating], count[updating])
+            self.heights[:, :, cells] = heights
+            self.positions[:, :, cells] = positions
+
+    def update_markers(self, q, n, x, count):
+        """
+        P-square update of marker heights q and positions n (in place) with
+        observations x, count being the number of observations including x
+        """
+        q[:, 0] = np.minimum(q[:, 0], x)
+        q[:, 4] = np.maximum(q[:, 4], x)
+        cell = np.clip((x >= q[:, 1:4]).sum(axis = 1), 0, 3)
+        for i in range(1, MARKERS):
+            n[:, i] += cell < i
+
+        desired = 1 + (count - 1) * self.increments
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            for i in (1, 2, 3):
+                d = desired[:, i] - n[:, i]
+                step = np.where(
+                    (d >= 1) & (n[:, i + 1] - n[:, i] > 1), 1,
+                    np.where((d <= -1) & (n[:, i - 1] - n[:, i] < -1), -1, 0))
+
+                parabolic = q[:, i] + step / (n[:, i + 1] - n[:, i - 1]) * (
+                    (n[:, i] - n[:, i - 1] + step) * (q[:, i + 1] - q[:, i]) / (n[:, i + 1] - n[:, i])
+                    + (n[:, i + 1] - n[:, i] - step) * (q[:, i] - q[:, i - 1]) / (n[:, i] - n[:, i - 1]))
+                neighbor_q = np.where(step > 0, q[:, i + 1], q[:, i - 1])
+                neighbor_n = np.where(step > 0, n[:, i + 1], n[:, i - 1])
+                linear = q[:, i] + step * (neighbor_q - q[:, i]) / (neighbor_n - n[:, i])
+
+                within = (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1])
+                moved = step != 0
+                q[:, i] = np.where(moved, np.where(within, parabolic, linear), q[:, i])
+                n[:, i] += step
+
+    def reshape(self, values):
+        return values.reshape(values.shape[:-1] + self.shape)
+
+    def get_count(self):
+        return self.reshape(self.count)
+
+    def get_mean(self):
+        """
+        Returns the mean of every element (nan without observations)
+        """
+        return self.reshape(np.where(self.count > 0, self.mean, np.nan))
+
+    def get_variance(self):
+        """
+        Returns the sample variance of every element (nan with fewer than
+        two observations)
+        """
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            return self.reshape(np.where(self.count > 1, self.m2 / (self.count - 1), np.nan))
+
+    def get_std(self):
+        return np.sqrt(self.get_variance())
+
+    def get_quantile(self, quantile):
+        """
+        Returns the estimate of a tracked quantile of every element (exact
+        while an element has at most 5 observations)
+        """
+        if quantile not in self.quantiles:
+            raise ValueError("Untracked quantile: %s (tracked: %s)" % (quantile, self.quantiles))
+
+        estimate = self.heights[self.quantiles.index(quantile), 2].copy()
+        starting = (self.count > 0) & (self.count <= MARKERS)
+        if starting.any():
+            with np.errstate(invalid = "ignore"):
+                estimate[starting] = np.nanquantile(self.first[:, starting], quantile, axis = 0)
+        estimate[self.count == 0] = np.nan
+        return self.reshape(estimate)
+
+    def to_dict(self):
+        return {
+            "count": self.get_count().tolist(),
+            "mean": self.get_mean().tolist(),
+            "std": self.get_std().tolist(),
+            "quantiles": {str(quantile): self.get_quantile(quantile).tolist() for quantile in self.quantiles},
+        }
+
+class EnsembleStatistics:
+    """
+    EnsembleStatistics aggregates the SEIR counts and summary peaks of
+    replicates over a horizon of steps.
+
+    Properties:
+        steps: Horizon; observations after it are ignored
+        series: RunningStatistics of the SEIR counts, (steps + 1, 7, 4)
+            (district1, ..., district6, total; S, E, I, R)
+        peaks: RunningStatistics of the peak heights, (7, 2) (see PEAKS)
+        peak_times: Histogram of the peak steps, (7, 2, steps + 1)
+        replicates: Number of summaries added
+    """
+
+    def __init__(self, steps, quantiles = QUANTILES):
+        self.steps = steps
+        self.series = RunningStatistics((steps + 1, len(RECORDED_DISTRICTS), len(COMPARTMENTS)), quantiles)
+        self.peaks = RunningStatistics((len(RECORDED_DISTRICTS), len(PEAKS)), quantiles)
+        self.peak_times = np.zeros((len(RECORDED_DISTRICTS), len(PEAKS), steps + 1), dtype = np.int64)
+        self.replicates = 0
+
+    def add_step(self, step, counts):
+        """
+        Adds the (7, 4) SEIR counts of one replicate at a step, e.g. from
+        covid_19_model.replicates.record(model) while the replicate runs
+        """
+        if step <= self.steps:
+            self.series.add(counts, step)
+
+    def add_history(self, history):
+        """
+        Adds the SEIR history of a finished replicate (see
+        covid_19_model.replicates.run_model). A replicate that stopped
+        before the horizon is held at its last counts, which no longer
+        change once the epidemic has died out.
+        """
+        history = np.asarray(history)[:self.steps + 1]
+        padding = np.repeat(history[-1:], self.steps + 1 - len(history), axis = 0)
+        self.series.add(np.concatenate([history, padding]))
+
+    def add_summary(self, summary):
+        """
+        Adds the peak heights and steps of a replicate's summary
+        """
+        heights = [[summary[district][peak][0] for peak in PEAKS] for district in RECORDED_DISTRICTS]
+        steps = np.array([[summary[district][peak][1] for peak in PEAKS] for district in RECORDED_DISTRICTS])
+        self.peaks.add(heights)
+
+        rows, columns = np.indices(steps.shape)
+        np.add.at(self.peak_times, (rows, columns, np.clip(steps, 0, self.steps)), 1)
+        self.replicates += 1
+
+    def add_result(self, result):
+        """
+        Adds a result of run_model (history and summary)
+        """
+        self.add_history(result["history"])
+        self.add_summary(result["summary"])
+
+    def band(self, district, compartment, lower = QUANTILES[0], upper = QUANTILES[-1]):
+        """
+        Returns the mean, lower and upper quantiles of a compartment of a
+        district at every step
+        """
+        row = RECORDED_DISTRICTS.index(district)
+        column = COMPARTMENTS.index(compartment)
+        return {
+            "mean": self.series.get_mean()[:, row, column],
+            "lower": self.series.get_quantile(lower)[:, row, column],
+            "upper": self.series.get_quantile(upper)[:, row, column],
+        }
+
+    def peak_time_quantile(self, district, peak, quantile):
+        """
+        Returns a quantile of the peak step of a district (exact)
+        """
+        histogram = self.peak_times[RECORDED_DISTRICTS.index(district), PEAKS.index(peak)]
+        cumulative = np.cumsum(histogram)
+        if cumulative[-1] == 0:
+            return None
+        return int(np.searchsorted(cumulative, quantile * cumulative[-1]))
+
+    def to_dict(self):
+        return {
+            "steps": self.steps,
+            "replicates": self.replicates,
+            "districts": RECORDED_DISTRICTS,
+            "compartments": COMPARTMENTS,
+            "peaks": PEAKS,
+            "series": self.series.to_dict(),
+            "peak_heights": self.peaks.to_dict(),
+            "peak_times": self.peak_times.tolist(),
+        }
+
+    def to_json(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.to_dict(), file)
+
+def run_ensemble(
+    variable_params,
+    fixed_params,
+    replicates,
+    steps,
+    engine = "object",
+    seed = None,
+    processes = None,
+    quantiles = QUANTILES,
+    callback = None,
+):
+    """
+    Runs replicates as covid_19_model.replicates.run_replicates does and
+    folds each one into an EnsembleStatistics as soon as it finishes,
+    calling callback(ensemble, result) after every replicate. Returns the
+    EnsembleStatistics.
+    """
+    ensemble = EnsembleStatistics(steps, quantiles)
+    for result in iterate_replicates(variable_params, fixed_params, replicates, steps, engine, seed, processes):
+        ensemble.add_result(result)
+        if callback is not None:
+            callback(ensemble, result)
+    return ensemble
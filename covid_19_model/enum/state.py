@@ -4,4 +4,15 @@ class State:
     SUSCEPTIBLE = "S"
     EXPOSED = "E"
     INFECTED = "I"
-    REMOVED = "R"
\ No newline at end of file
+    REMOVED = "R"
+
+class StateCode:
+    """
+    Integer codes of the states, used by the array-based engines.
+    A code is the index of its state in StateCode.STATES.
+    """
+    SUSCEPTIBLE = 0
+    EXPOSED = 1
+    INFECTED = 2
+    REMOVED = 3
+    STATES = "SEIR"
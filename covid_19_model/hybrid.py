@@ -0,0 +1,306 @@
+# hybrid.py
+
+"""
+Hybrid aggregate/agent engine of Covid19Model.
+
+Exposed and infected persons are individual agents (the arrays of
+VectorizedPopulation), while susceptible persons are held as counts per
+spatial cell, district, age band and behavior flags (wearing_mask,
+physical_distancing, mobile_worker). Select it with
+Covid19Model(..., engine = "hybrid").
+
+Cells are squares at least as wide as agent_exposure_distance and as the
+longest move of a step, so that everyone an agent can reach, and everyone
+who can move next to it, lies in the 3x3 cells around the agent's cell
+(the active cells). Every step, after the status phase, refresh:
+    - drops removed agents (they only remain in the model's SEIR counts),
+    - collapses the susceptible agents outside the active cells back into
+      the counts of their cell,
+    - materializes the counts of the active cells into susceptible agents.
+
+The model's SEIR counts, summary and recorder stay exact since every
+S -> E -> I -> R transition still goes through Covid19Model.transfer, and
+materializing or collapsing never changes them. Memory and step time scale
+with the number of agents near the epidemic (plus a fixed count grid of the
+city's bounding box), not with the total population.
+
+Differences with the vectorized engine:
+    - Aggregated susceptible persons do not move: their counts are a
+      stationary density field, which is what the symmetric random walk of
+      the move phase preserves on average. Susceptible agents whose move
+      would leave the active cells stay put, so that the active cells keep
+      that density instead of leaking agents they get none back for.
+    - A materialized person gets a uniform position inside the part of its
+      cell that lies in its district (see positions) and an age drawn
+      inside its age band (consistently with its mobile_worker flag).
+      Behavior flags are kept through collapses.
+    - The counts neither leave the city nor mix with the persons around
+      the epidemic the way walking agents do, so hybrid ensembles run a
+      little hot: at about 5k persons (variable_parameters.json with 20
+      times the susceptible persons), the mean exposed and infected counts
+      of step 30 are about 10% above the vectorized engine's with
+      city_boundary "none" and about 5% above with "clamp". Keeping every
+      cell active removes the difference. benchmarks/engines.py checks
+      the ensembles of both engines against each other.
+"""
+
+from covid_19_model.population import synthesize_population, AGE_GROUPS
+from covid_19_model.space import QuezonCity
+from covid_19_model.vectorized import VectorizedPopulation, SUSCEPTIBLE, EXPOSED, INFECTED, REMOVED, NEVER
+from shapely.geometry import box
+import numpy as np
+
+# Ages allowed to be mobile workers (see covid_19_model.population)
+MOBILE_WORKER_AGES = (18, 65)
+
+class HybridPopulation(VectorizedPopulation):
+    """
+    HybridPopulation holds the exposed and infected persons (and the
+    susceptible persons near them) as agents, and every other susceptible
+    person as counts.
+
+    Properties:
+        counts: (cells, districts, age bands, flags) counts of aggregated
+            susceptible persons; cell = column * height + row and
+            flags = 4 * wearing_mask + 2 * physical_distancing + mobile_worker
+        origin, width, height: Lower-left corner and size (in cells) of the
+            count grid, which covers the districts' bounding box
+        cell_size: Side of a cell
+        active: Boolean mask of the active cells of the current step
+        materialized, collapsed: Counters of the last refresh
+    """
+
+    # Phases of a step, in order
+    PHASES = ("status", "refresh", "interact", "move")
+
+    # Combinations of the three behavior flags
+    FLAGS = 8
+
+    # Lower bound of the cell size, which bounds the count grid
+    # (about 8000 cells over Quezon City)
+    MIN_CELL_SIZE = 200
+
+    # Susceptible persons positioned per batch while building the counts
+    CHUNK_SIZE = 2 ** 20
+
+    # Draws of a materialized position before it is snapped into its district
+    MAX_DRAWS = 16
+
+    def __init__(self, model, variable_params):
+        """
+        Initializes the exposed and infected agents and the counts of the
+        susceptible persons from variable_params
+        """
+        grid = model.grid
+        rng = model.streams["population"]
+        self.cell_size = max(
+            model.agent_exposure_distance,
+            2 * model.agent_mobility_range,
+            self.MIN_CELL_SIZE)
+
+        bounds = np.array([grid.districts[district].shape.bounds for district in QuezonCity.DISTRICTS])
+        self.origin = bounds[:, :2].min(axis = 0)
+        self.width = int(np.ceil((bounds[:, 2].max() - self.origin[0]) / self.cell_size))
+        self.height = int(np.ceil((bounds[:, 3].max() - self.origin[1]) / self.cell_size))
+
+        agents = dict(variable_params)
+        agents["susceptible"] = np.zeros_like(variable_params["susceptible"]).tolist()
+        super().__init__(model, synthesize_population(
+            agents,
+            grid,
+            rng,
+            model.wearing_mask_percentage,
+            model.physical_distancing_percentage,
+            model.mobile_worker_percentage))
+
+        # Draws every susceptible person as synthesize_population would,
+        # a chunk at a time, and keeps only its counts
+        cells = self.width * self.height
+        self.counts = np.zeros((cells, len(QuezonCity.DISTRICTS), len(AGE_GROUPS), self.FLAGS), dtype = np.int32)
+        susceptible = np.array(variable_params["susceptible"], dtype = np.int64)
+        for age_group, district in zip(*np.nonzero(susceptible)):
+            name = QuezonCity.DISTRICTS[district]
+            remaining = int(susceptible[age_group, district])
+            while remaining:
+                n = min(remaining, self.CHUNK_SIZE)
+                age = AGE_GROUPS[age_group][0] + rng.integers(0, 10, n)
+                flags = self.flags(
+                    rng.random(n) < model.wearing_mask_percentage,
+                    rng.random(n) < model.physical_distancing_percentage,
+                    (rng.random(n) < model.mobile_worker_percentage)
+                    & (MOBILE_WORKER_AGES[0] <= age) & (age <= MOBILE_WORKER_AGES[1]))
+                xs, ys = grid.random_positions(name, n, rng)
+                self.counts[:, district, age_group] += np.bincount(
+                    self.cell(xs, ys) * self.FLAGS + flags,
+                    minlength = cells * self.FLAGS).reshape(cells, self.FLAGS).astype(np.int32)
+                remaining -= n
+
+        self.age_distribution = self.conditional_age_distribution(model.mobile_worker_percentage)
+        self.active = np.zeros(cells, dtype = bool)
+        self.materialized = self.collapsed = 0
+
+    def flags(self, wearing_mask, physical_distancing, mobile_worker):
+        """
+        Packs behavior flags into a flags index
+        """
+        return 4 * wearing_mask.astype(np.int64) + 2 * physical_distancing + mobile_worker
+
+    def conditional_age_distribution(self, mobile_worker_percentage):
+        """
+        Returns the cumulative distribution of the ages of each age band
+        (uniform), given the mobile_worker flag: (age bands, 2, 10)
+        """
+        ages = np.array([low for low, _ in AGE_GROUPS])[:, None] + np.arange(10)
+        eligible = (MOBILE_WORKER_AGES[0] <= ages) & (ages <= MOBILE_WORKER_AGES[1])
+        weights = np.stack([1 - mobile_worker_percentage * eligible, eligible.astype(float)], axis = 1)
+        totals = weights.sum(axis = 2, keepdims = True)
+        return np.cumsum(weights / np.where(totals > 0, totals, 1), axis = 2)
+
+    def cell(self, x, y):
+        """
+        Returns the cells of positions (clipped to the count grid)
+        """
+        cx = np.clip(np.floor((x - self.origin[0]) / self.cell_size).astype(np.int64), 0, self.width - 1)
+        cy = np.clip(np.floor((y - self.origin[1]) / self.cell_size).astype(np.int64), 0, self.height - 1)
+        return cx * self.height + cy
+
+    def aggregated(self):
+        """
+        Returns the centers (xs, ys) of the cells holding aggregated
+        susceptible persons and their counts
+        """
+        totals = self.counts.sum(axis = (1, 2, 3))
+        cells = np.flatnonzero(totals)
+        cx, cy = np.divmod(cells, self.height)
+        return (
+            self.origin[0] + (cx + 0.5) * self.cell_size,
+            self.origin[1] + (cy + 0.5) * self.cell_size,
+            totals[cells])
+
+    def active_cells(self):
+        """
+        Returns a boolean mask of the 3x3 cells around every exposed or
+        infected agent
+        """
+        carriers = np.flatnonzero((self.state == EXPOSED) | (self.state == INFECTED))
+        cells = self.cell(self.x[carriers], self.y[carriers])
+        cx, cy = np.divmod(np.unique(cells), self.height)
+
+        active = np.zeros((self.width, self.height), dtype = bool)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                active[np.clip(cx + dx, 0, self.width - 1), np.clip(cy + dy, 0, self.height - 1)] = True
+        return active.ravel()
+
+    def refresh(self):
+        """
+        Drops removed agents, collapses the susceptible agents outside the
+        active cells and materializes the counts of the active cells
+        """
+        self.keep(self.state != REMOVED)
+        self.active = active = self.active_cells()
+
+        # Collapse
+        cells = self.cell(self.x, self.y)
+        inactive = (self.state == SUSCEPTIBLE) & ~active[cells]
+        age_group = np.minimum(self.age[inactive] // 10, len(AGE_GROUPS) - 1)
+        flags = self.flags(
+            self.wearing_mask[inactive],
+            self.physical_distancing[inactive],
+            self.mobile_worker[inactive])
+        np.add.at(self.counts, (cells[inactive], self.district[inactive], age_group, flags), 1)
+        self.collapsed = int(inactive.sum())
+        self.keep(~inactive)
+
+        # Materialization
+        active = np.flatnonzero(active)
+        block = self.counts[active]
+        cell, district, age_group, flags = np.nonzero(block)
+        n = block[cell, district, age_group, flags]
+        self.counts[active] = 0
+        self.materialized = int(n.sum())
+        if self.materialized:
+            self.extend(self.synthesize(active[cell], district, age_group, flags, n))
+
+    def displace(self):
+        """
+        Agents move as in the vectorized engine, except that susceptible
+        agents whose move would leave the active cells stay put
+        """
+        x, y = self.x.copy(), self.y.copy()
+        movable, district = super().displace()
+
+        leaving = (self.state == SUSCEPTIBLE) & ~self.active[self.cell(self.x, self.y)]
+        self.x[leaving] = x[leaving]
+        self.y[leaving] = y[leaving]
+        self.moved -= int(leaving.sum())
+        if district is not None:
+            # Back at their origin, in their own district
+            district[leaving[movable]] = -1
+        return movable, district
+
+    def synthesize(self, cells, district, age_group, flags, n):
+        """
+        Returns the columns of susceptible agents: n[k] agents of the given
+        cell, district, age group and flags for every k
+        """
+        rng = self.model.streams["population"]
+        total = int(n.sum())
+        district = np.repeat(district, n)
+        age_group = np.repeat(age_group, n)
+        flags = np.repeat(flags, n)
+        wearing_mask = flags & 4 > 0
+        physical_distancing = flags & 2 > 0
+        mobile_worker = flags & 1 > 0
+
+        cumulative = self.age_distribution[age_group, mobile_worker.astype(np.int64)]
+        offset = np.minimum((rng.random(total)[:, None] >= cumulative).sum(axis = 1), 9)
+        x, y = self.positions(np.repeat(cells, n), district, rng)
+
+        return {
+            "x": x,
+            "y": y,
+            "district": district,
+            "state": np.full(total, SUSCEPTIBLE),
+            "age": np.array([low for low, _ in AGE_GROUPS])[age_group] + offset,
+            "wearing_mask": wearing_mask,
+            "physical_distancing": physical_distancing,
+            "mobile_worker": mobile_worker,
+            "days_incubating": np.zeros(total),
+            "days_infected": np.zeros(total),
+            "susceptibility": self.compute_susceptibility(district, wearing_mask, physical_distancing),
+            "transition_step": np.full(total, NEVER),
+        }
+
+    def positions(self, cells, district, rng):
+        """
+        Returns uniform positions (xs, ys) inside the given cells and
+        districts: uniform in the cell, redrawn while it lies in another
+        district or outside the city. After MAX_DRAWS draws, the positions
+        still outside their district (cells that barely overlap it) are
+        snapped to a point of the cell within the district.
+        """
+        grid = self.model.grid
+        cx, cy = np.divmod(cells, self.height)
+        x = np.empty(len(cells))
+        y = np.empty(len(cells))
+
+        pending = np.arange(len(cells))
+        for _ in range(self.MAX_DRAWS):
+            x[pending] = self.origin[0] + (cx[pending] + rng.random(len(pending))) * self.cell_size
+            y[pending] = self.origin[1] + (cy[pending] + rng.random(len(pending))) * self.cell_size
+            pending = pending[grid.locate(x[pending], y[pending]) != district[pending]]
+            if len(pending) == 0:
+                return x, y
+
+        for k in pending:
+            low_x = self.origin[0] + cx[k] * self.cell_size
+            low_y = self.origin[1] + cy[k] * self.cell_size
+            part = grid.districts[QuezonCity.DISTRICTS[district[k]]].shape.intersection(
+                box(low_x, low_y, low_x + self.cell_size, low_y + self.cell_size))
+            # Persons collapsed outside the city (city_boundary "none") keep
+            # their last draw
+            if not part.is_empty:
+                point = part.representative_point()
+                x[k], y[k] = point.x, point.y
+        return x, y
@@ -0,0 +1,188 @@
+# instrumentation.py
+
+"""
+Opt-in phase timing and counters of Covid19Model.step.
+
+Enable with model.instrument(). While enabled, Covid19Model.step delegates
+to Instrumentation.step, which runs the same step with timers and counters
+around each phase. When it is not enabled the model's step is untouched.
+
+Per-step records:
+    seconds: wall time of the status, interact and move phases (interact
+        and move summed over agents for the object engine; plus refresh for
+        the hybrid engine), of the SEIR collection
+        ("collect") and of the end of step ("output"), and the total
+    neighbor_queries: neighbor queries made by infected agents
+    candidates_examined: susceptible agents in the spatial hash cells (of
+        side agent_exposure_distance) queried by infected agents, i.e. the
+        infected-susceptible pairs tested for distance
+    infections_attempted: contacts between an infected and a susceptible agent
+    infections_succeeded: S -> E transitions
+    agents_moved: agents that took a move step
+    agents_removed: I -> R transitions
+"""
+
+from covid_19_model.agents import PersonAgent
+from covid_19_model.enum.state import State
+import logging
+import time
+import json
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("collect", "status", "interact", "move", "output")
+COUNTERS = (
+    "neighbor_queries",
+    "candidates_examined",
+    "infections_attempted",
+    "infections_succeeded",
+    "agents_moved",
+    "agents_removed",
+)
+
+class Instrumentation:
+    """
+    Instrumentation records the timings and counters of every step.
+
+    Properties:
+        records: One dictionary per step: {"step", "seconds": {...}, counters...}
+        log_every: Logs a summary line every log_every steps (never if 0)
+        json_path: Dumps the records to this file every log_every steps
+    """
+
+    def __init__(self, model, log_every = 0, json_path = None):
+        self.model = model
+        self.log_every = log_every
+        self.json_path = json_path
+        self.records = []
+
+    def step(self):
+        """
+        Advances the model by one step, recording timings and counters
+        """
+        model = self.model
+        record = {"step": model.steps + 1, "seconds": dict.fromkeys(PHASES, 0.0)}
+        record.update(dict.fromkeys(COUNTERS, 0))
+        seconds = record["seconds"]
+        before = model.SEIR["total"].copy()
+        start = time.perf_counter()
+
+        model.steps += 1
+        model.recorder.collect()
+        seconds["collect"] = time.perf_counter() - start
+
+        if model.population is not None:
+            self.step_population(record)
+        else:
+            self.step_agents(record)
+
+        end = time.perf_counter()
+        model.end_step()
+        seconds["output"] = time.perf_counter() - end
+        seconds["total"] = time.perf_counter() - start
+
+        after = model.SEIR["total"]
+        record["infections_succeeded"] = before["S"] - after["S"]
+        record["agents_removed"] = after["R"] - before["R"]
+        self.records.append(record)
+
+        if self.log_every and len(self.records) % self.log_every == 0:
+            self.log()
+
+    def step_population(self, record):
+        """
+        Runs the phases of the vectorized and hybrid engines under timers
+        """
+        population = self.model.population
+        seconds = record["seconds"]
+
+        for phase in population.PHASES:
+            start = time.perf_counter()
+            getattr(population, phase)()
+            seconds[phase] = time.perf_counter() - start
+
+        record["neighbor_queries"] = population.interacting
+        record["candidates_examined"] = population.candidates_examined
+        record["infections_attempted"] = population.contacts
+        record["agents_moved"] = population.moved
+
+    def step_agents(self, record):
+        """
+        Runs the due status transitions and the schedule of the object
+        engine, counting the neighbor queries made through the grid and
+        timing the phases of PersonAgent.step
+        """
+        model = self.model
+        grid = model.grid
+        query = grid.get_neighbors_within_distance
+
+        def counting_query(agent, distance, **kwargs):
+            record["neighbor_queries"] += 1
+            record["candidates_examined"] += grid.count_candidates(agent, distance, State.SUSCEPTIBLE)
+            for neighbor in query(agent, distance, **kwargs):
+                if getattr(neighbor, "state", None) == State.SUSCEPTIBLE:
+                    record["infections_attempted"] += 1
+                yield neighbor
+
+        interact, move = PersonAgent.interact, PersonAgent.move
+
+        def timed_interact(agent):
+            start = time.perf_counter()
+            interact(agent)
+            record["seconds"]["interact"] += time.perf_counter() - start
+
+        def timed_move(agent):
+            start = time.perf_counter()
+            moved = move(agent)
+            record["seconds"]["move"] += time.perf_counter() - start
+            record["agents_moved"] += moved
+            return moved
+
+        # Shadows the grid's query method and the agents' phases for this
+        # step only, so that PersonAgent.step itself carries no hooks
+        grid.get_neighbors_within_distance = counting_query
+        PersonAgent.interact, PersonAgent.move = timed_interact, timed_move
+        try:
+            start = time.perf_counter()
+            model.process_transitions()
+            record["seconds"]["status"] = time.perf_counter() - start
+            model.schedule.step()
+        finally:
+            del grid.get_neighbors_within_distance
+            PersonAgent.interact, PersonAgent.move = interact, move
+
+    def totals(self):
+        """
+        Returns the timings and counters summed over every recorded step
+        """
+        totals = {"steps": len(self.records), "seconds": {}}
+        for record in self.records:
+            for phase, seconds in record["seconds"].items():
+                totals["seconds"][phase] = totals["seconds"].get(phase, 0.0) + seconds
+            for counter in COUNTERS:
+                totals[counter] = totals.get(counter, 0) + record[counter]
+        return totals
+
+    def log(self):
+        """
+        Logs a summary line of the last log_every steps and dumps the records
+        """
+        recent = self.records[-self.log_every:]
+        total = sum(record["seconds"]["total"] for record in recent)
+        phases = " ".join(
+            "%s=%.4fs" % (phase, sum(record["seconds"][phase] for record in recent) / len(recent))
+            for phase in recent[-1]["seconds"] if phase != "total")
+        counters = " ".join(
+            "%s=%d" % (counter, sum(record[counter] for record in recent))
+            for counter in COUNTERS)
+        logger.info("step %d: %.4fs/step %s %s", self.records[-1]["step"], total / len(recent), phases, counters)
+
+        if self.json_path:
+            self.to_json(self.json_path)
+
+    def to_json(self, filename):
+        """
+        Dumps the records and totals to a JSON file
+        """
+        with open(filename, "w") as file:
+            json.dump({"totals": self.totals(), "records": self.records}, file)
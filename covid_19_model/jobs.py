@@ -0,0 +1,487 @@
+# jobs.py
+
+"""
+Asynchronous simulation job API.
+
+An HTTP/JSON service (tornado, on asyncio) where clients submit parameter
+sets as jobs, poll or stream their per-step SEIR counts and cancel them.
+Jobs wait in a bounded queue and at most `workers` of them run at a time,
+each in its own forked process, so a long simulation never blocks the
+event loop. Progress comes back over a pipe, one message per step, and a
+running job is cancelled by terminating its process.
+
+Endpoints:
+    POST /api/jobs: submits a job; the body is a JSON object with optional
+        "variable_params", "fixed_params" (default: the service's
+        parameter files), "overrides" (keys of covid_19_model.batch's sweep
+        spec), "engine", "seed" and "steps". Returns the job (202), 400 for
+        an invalid spec, or 503 when the queue is full.
+    GET /api/jobs: lists the jobs
+    GET /api/jobs/<id>: returns a job; ?history=1 adds its SEIR history
+    GET /api/jobs/cache: hits and misses of the result cache
+    GET /api/jobs/<id>/stream: streams the job's steps so far and then its
+        new ones as newline-delimited JSON, until it ends
+    DELETE /api/jobs/<id>: cancels a queued or running job
+
+A job is {"id", "status", "engine", "seed", "steps", "step", "SEIR",
+"summary", "cached", "error", "submitted", "started", "finished"}, status
+being one of queued, running, done, failed or cancelled, and SEIR the
+counts of covid_19_model.recorder.RECORDED_DISTRICTS at the last step.
+With a result cache (covid_19_model.cache.ResultCache), seeded jobs already
+run with the same inputs are replayed from disk.
+
+The dashboard (covid_19_model.server) serves the same endpoints. Standalone:
+    python -m covid_19_model.jobs --port 8522 --workers 4
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.cache import ResultCache
+from covid_19_model.recorder import RECORDED_DISTRICTS
+from covid_19_model.replicates import record, extinct
+from covid_19_model.utils import parse_json, apply_overrides
+import tornado.iostream
+import tornado.ioloop
+import tornado.web
+import multiprocessing
+import collections
+import traceback
+import itertools
+import argparse
+import asyncio
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a job that has ended
+ENDED = ("done", "failed", "cancelled")
+
+def _run_job(connection, variable_params, fixed_params, engine, seed, steps, result_cache):
+    """
+    Runs a job in a worker process, sending ("step", step, SEIR) after the
+    initial counts and every step, then ("done", summary, cached) or
+    ("failed", traceback). Seeded runs are replayed from and stored in the
+    result cache, if any.
+    """
+    try:
+        key = None
+        if result_cache is not None and seed is not None:
+            key = result_cache.key(variable_params, fixed_params, engine, seed, steps)
+            result = result_cache.load(key)
+            if result is not None:
+                for step, counts in enumerate(result["history"].tolist()):
+                    connection.send(("step", step, counts))
+                connection.send(("done", result["summary"], True))
+                return
+
+        model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed)
+        history = [record(model)]
+        connection.send(("step", model.steps, history[-1]))
+        for _ in range(steps):
+            if not model.running or extinct(model):
+                break
+            model.step()
+            history.append(record(model))
+            connection.send(("step", model.steps, history[-1]))
+
+        if key is not None:
+            result_cache.store(key, {"history": history, "summary": model.summary})
+        connection.send(("done", model.summary, False))
+    except Exception:
+        connection.send(("failed", traceback.format_exc()))
+    finally:
+        connection.close()
+
+async def receive(connection):
+    """
+    Returns the next message of a worker, or None once it has exited,
+    waiting on the event loop until the pipe is readable
+    """
+    loop = asyncio.get_event_loop()
+    while not connection.poll():
+        readable = loop.create_future()
+        loop.add_reader(connection.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(connection.fileno())
+
+    try:
+        return connection.recv()
+    except (EOFError, OSError):
+        return None
+
+class Job:
+    """
+    Job is one simulation submitted to a JobManager.
+
+    Properties:
+        id: Job number
+        variable_params, fixed_params, engine, seed, steps: Model inputs
+        status: queued, running, done, failed or cancelled
+        history: SEIR counts of every step so far (see RECORDED_DISTRICTS)
+        summary: Summary peaks of the model, once done
+        cached: Whether the result came from the result cache, once done
+        error: Traceback of a failed job
+        process: Worker process of a running job
+        listeners: asyncio.Queues of the streams following the job
+    """
+
+    def __init__(self, id, variable_params, fixed_params, engine, seed, steps):
+        self.id = id
+        self.variable_params = variable_params
+        self.fixed_params = fixed_params
+        self.engine = engine
+        self.seed = seed
+        self.steps = steps
+        self.status = "queued"
+        self.history = []
+        self.summary = None
+        self.cached = None
+        self.error = None
+        self.process = None
+        self.listeners = set()
+        self.submitted = time.time()
+        self.started = self.finished = None
+
+    def publish(self, event):
+        """
+        Passes an event (a step's counts, or None once the job has ended)
+        to every stream
+        """
+        for listener in self.listeners:
+            listener.put_nowait(event)
+
+    def step_event(self, step):
+        return {"id": self.id, "step": step, "SEIR": dict(zip(RECORDED_DISTRICTS, self.history[step]))}
+
+    def to_dict(self, history = False):
+        job = {
+            "id": self.id,
+            "status": self.status,
+            "engine": self.engine,
+            "seed": self.seed,
+            "steps": self.steps,
+            "step": len(self.history) - 1 if self.history else None,
+            "SEIR": dict(zip(RECORDED_DISTRICTS, self.history[-1])) if self.history else None,
+            "summary": self.summary,
+            "cached": self.cached,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if history:
+            job["history"] = self.history
+        return job
+
+def integer(spec, name, default):
+    """
+    Returns an integer entry of a job spec, raising ValueError (rather than
+    TypeError or OverflowError) for a value that is not one
+    """
+    value = spec.get(name, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("%s must be an integer" % name)
+
+class JobManager:
+    """
+    JobManager queues jobs and runs at most `workers` of them at a time in
+    forked processes.
+
+    Properties:
+        variable_params, fixed_params: Default parameters of the jobs
+        workers: Number of jobs run at a time (one per CPU by default)
+        max_queued: Number of queued jobs beyond which submit refuses
+        keep_ended: Number of ended jobs kept for polling; older ones are
+            forgotten
+        max_steps: Largest horizon of a job
+        result_cache: covid_19_model.cache.ResultCache of the seeded jobs
+            (None to always simulate)
+        hits, misses: Ended jobs read from and stored in the result cache
+        jobs: Jobs by id, in submission order
+    """
+
+    def __init__(
+        self,
+        variable_params,
+        fixed_params,
+        workers = None,
+        max_queued = 1000,
+        keep_ended = 1000,
+        max_steps = 100000,
+        result_cache = None,
+    ):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("JobManager requires the fork start method")
+
+        self.variable_params = variable_params
+        self.fixed_params = fixed_params
+        self.workers = workers or os.cpu_count()
+        self.max_queued = max_queued
+        self.keep_ended = keep_ended
+        self.max_steps = max_steps
+        self.result_cache = result_cache
+        self.hits = self.misses = 0
+        self.jobs = collections.OrderedDict()
+        self.ids = itertools.count(1)
+        self.context = multiprocessing.get_context("fork")
+        self.queue = None
+        self.tasks = []
+
+    def start(self):
+        """
+        Starts the workers on the running event loop (done by the first
+        submit)
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    def submit(self, spec):
+        """
+        Queues a job from a spec (see POST /api/jobs) and returns it. Raises
+        ValueError for an invalid spec and OverflowError when the queue is
+        full.
+        """
+        self.start()
+        if self.queue.qsize() >= self.max_queued:
+            raise OverflowError("The job queue is full (%d jobs)" % self.max_queued)
+
+        engine = spec.get("engine", "object")
+        if engine not in Covid19Model.ENGINES:
+            raise ValueError("Unknown engine: %s" % engine)
+        steps = integer(spec, "steps", 100)
+        if not 0 <= steps <= self.max_steps:
+            raise ValueError("steps must be between 0 and %d" % self.max_steps)
+        seed = integer(spec, "seed", None)
+
+        variable_params = spec.get("variable_params", self.variable_params)
+        fixed_params = spec.get("fixed_params", self.fixed_params)
+        overrides = spec.get("overrides", {})
+        for name, value in (("variable_params", variable_params), ("fixed_params", fixed_params), ("overrides", overrides)):
+            if not isinstance(value, dict):
+                raise ValueError("%s must be a JSON object" % name)
+
+        try:
+            fixed_params = apply_overrides(fixed_params, overrides)
+        except KeyError as error:
+            raise ValueError(error.args[0])
+        except TypeError:
+            raise ValueError("Per-district overrides need a per-district parameter")
+
+        job = Job(
+            next(self.ids),
+            variable_params,
+            fixed_params,
+            engine,
+            seed,
+            steps)
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        self.forget()
+        return job
+
+    def cancel(self, job):
+        """
+        Cancels a queued job, or terminates a running one. Returns False if
+        the job had already ended.
+        """
+        if job.status in ENDED:
+            return False
+        if job.status == "running":
+            job.process.terminate()
+        self.end(job, "cancelled")
+        return True
+
+    def end(self, job, status):
+        job.status = status
+        job.finished = time.time()
+        job.publish(None)
+
+    def forget(self):
+        """
+        Drops the oldest ended jobs beyond keep_ended
+        """
+        ended = [job.id for job in self.jobs.values() if job.status in ENDED]
+        for id in ended[:max(0, len(ended) - self.keep_ended)]:
+            del self.jobs[id]
+
+    async def work(self):
+        """
+        Runs the queued jobs one after the other
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self.queue.get()
+            if job.status != "queued":
+                continue
+
+            receiver, sender = self.context.Pipe(duplex = False)
+            job.process = self.context.Process(
+                target = _run_job,
+                args = (
+                    sender, job.variable_params, job.fixed_params,
+                    job.engine, job.seed, job.steps, self.result_cache),
+                daemon = True)
+            job.process.start()
+            sender.close()
+            job.status = "running"
+            job.started = time.time()
+
+            try:
+                while True:
+                    message = await receive(receiver)
+                    if message is None or job.status != "running":
+                        break
+                    if message[0] == "step":
+                        job.history.append(message[2])
+                        job.publish(job.step_event(message[1]))
+                    elif message[0] == "done":
+                        job.summary, job.cached = message[1], message[2]
+                        if self.result_cache is not None and job.seed is not None:
+                            if job.cached:
+                                self.hits += 1
+                            else:
+                                self.misses += 1
+                        self.end(job, "done")
+                    else:
+                        job.error = message[1]
+                        self.end(job, "failed")
+            finally:
+                receiver.close()
+                await loop.run_in_executor(None, job.process.join)
+                if job.status == "running":
+                    job.error = "The worker exited with code %s" % job.process.exitcode
+                    self.end(job, "failed")
+                job.process = None
+
+class JobHandler(tornado.web.RequestHandler):
+    """
+    Base handler of the job API
+    """
+
+    def initialize(self, manager):
+        self.manager = manager
+
+    def write_json(self, data, status = 200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+    def get_job(self, id):
+        job = self.manager.jobs.get(int(id))
+        if job is None:
+            raise tornado.web.HTTPError(404, reason = "Unknown job: %s" % id)
+        return job
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({"error": self._reason})
+
+class JobsHandler(JobHandler):
+
+    def get(self):
+        self.write_json([job.to_dict() for job in self.manager.jobs.values()])
+
+    def post(self):
+        try:
+            spec = json.loads(self.request.body or b"{}")
+            if not isinstance(spec, dict):
+                raise ValueError("The job spec must be a JSON object")
+            job = self.manager.submit(spec)
+        except ValueError as error:
+            raise tornado.web.HTTPError(400, reason = str(error))
+        except OverflowError as error:
+            raise tornado.web.HTTPError(503, reason = str(error))
+        self.write_json(job.to_dict(), 202)
+
+class CacheHandler(JobHandler):
+
+    def get(self):
+        self.write_json({"hits": self.manager.hits, "misses": self.manager.misses})
+
+class JobDetailHandler(JobHandler):
+
+    def get(self, id):
+        history = self.get_argument("history", "0") not in ("0", "false", "")
+        self.write_json(self.get_job(id).to_dict(history))
+
+    def delete(self, id):
+        job = self.get_job(id)
+        self.manager.cancel(job)
+        self.write_json(job.to_dict())
+
+class JobStreamHandler(JobHandler):
+
+    async def get(self, id):
+        job = self.get_job(id)
+        self.set_header("Content-Type", "application/x-ndjson")
+
+        # The steps so far are written from the history and the later ones
+        # from the events, which start right after it
+        listener = asyncio.Queue()
+        job.listeners.add(listener)
+        ended = job.status in ENDED
+        for step in range(len(job.history)):
+            self.write(json.dumps(job.step_event(step)) + "\n")
+
+        try:
+            await self.flush()
+            while not ended:
+                event = await listener.get()
+                if event is None:
+                    break
+                self.write(json.dumps(event) + "\n")
+                await self.flush()
+            self.write(json.dumps(job.to_dict()) + "\n")
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            job.listeners.discard(listener)
+        self.finish()
+
+def job_handlers(manager, prefix = "/api/jobs"):
+    """
+    Returns the tornado handlers of the job API of a JobManager
+    """
+    options = {"manager": manager}
+    return [
+        (prefix, JobsHandler, options),
+        (prefix + "/cache", CacheHandler, options),
+        (prefix + r"/(\d+)", JobDetailHandler, options),
+        (prefix + r"/(\d+)/stream", JobStreamHandler, options),
+    ]
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Simulation job API of the COVID-19 model")
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--port", type = int, default = 8522)
+    parser.add_argument("--address", default = "127.0.0.1")
+    parser.add_argument("--workers", type = int)
+    parser.add_argument("--max-queued", type = int, default = 1000)
+    parser.add_argument("--result-cache", help = "directory of the run result cache (seeded jobs only)")
+    parser.add_argument("--result-cache-mb", type = float, default = 2048, help = "size budget of the result cache")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO)
+    manager = JobManager(
+        parse_json(args.variable),
+        parse_json(args.fixed),
+        workers = args.workers,
+        max_queued = args.max_queued,
+        result_cache = ResultCache(args.result_cache, int(args.result_cache_mb * 1024 ** 2))
+            if args.result_cache else None)
+    app = tornado.web.Application(job_handlers(manager))
+    app.listen(args.port, args.address)
+    logger.info("Job API listening at http://%s:%d/api/jobs", args.address, args.port)
+    tornado.ioloop.IOLoop.current().start()
+
+if __name__ == "__main__":
+    main()
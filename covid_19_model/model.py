@@ -1,14 +1,19 @@
 # model.py
 
 from mesa import Model
-from mesa.time import RandomActivation
-from mesa.datacollection import DataCollector
-from covid_19_model.enum.immunity import Immunity
-from covid_19_model.enum.state import State
+from covid_19_model.enum.state import StateCode
 from covid_19_model.agents import PersonAgent
 from covid_19_model.space import QuezonCity
-from covid_19_model.data_collectors import *
-from covid_19_model.utils import coin_toss
+from covid_19_model.vectorized import VectorizedPopulation
+from covid_19_model.hybrid import HybridPopulation
+from covid_19_model.compartmental import CompartmentalPopulation
+from covid_19_model.parallel import ParallelPopulation
+from covid_19_model.population import synthesize_population
+from covid_19_model.recorder import SEIRRecorder
+from covid_19_model.output import StreamingOutput
+from covid_19_model.schedule import ActiveSetActivation, TimingWheel
+from covid_19_model.instrumentation import Instrumentation
+from covid_19_model.utils import RandomStreams
 from shapely.geometry import Point
 import numpy as np
 import random
@@ -18,10 +23,46 @@ class Covid19Model(Model):
     Covid19 Agent-Based Model
     """
 
-    def __init__(self, variable_params, fixed_params):
+    ENGINES = ("object", "vectorized", "hybrid", "compartmental")
+
+    def __init__(
+        self,
+        variable_params,
+        fixed_params,
+        engine = "object",
+        seed = None,
+        population = None,
+        population_cache = None,
+    ):
         """
         Initializes the model
+
+        engine: "object" steps one PersonAgent at a time through the mesa
+        scheduler; "vectorized" keeps the population in NumPy arrays (see
+        covid_19_model.vectorized) and is meant for large populations;
+        "hybrid" also keeps the susceptible persons far from the epidemic as
+        counts per cell (see covid_19_model.hybrid) and is meant for the
+        whole city; "compartmental" keeps only SEIR counts per district and
+        advances them by tau-leaping (see covid_19_model.compartmental),
+        for screening parameters without agents.
+        seed: Seed of every random number generator of the model (an int,
+        a numpy SeedSequence, or None for a fresh one)
+        population: Columns of an already synthesized population (see
+        covid_19_model.population), e.g. from a checkpoint; synthesized
+        from variable_params if None
+        population_cache: covid_19_model.cache.PopulationCache reused
+        across launches with identical inputs and seed (ignored without
+        a seed)
         """
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown engine: %s" % engine)
+        self.engine = engine
+        self.variable_params = variable_params
+        self.fixed_params = fixed_params
+
+        # Random number generators owned by this model
+        self.reseed(seed)
+
         # SEIR Values
         self.SEIR = self.initialize_SEIR_dictionary(variable_params)
 
@@ -60,37 +101,55 @@ class Covid19Model(Model):
         self.agent_exposure_distance = fixed_params["agent_exposure_distance"]
         self.agent_mobility_range = fixed_params["agent_mobility_range"]
 
-        # Instantiates scheduler and space for model
-        self.schedule = RandomActivation(self)
+        # District tracking of moving agents and policy at the city boundary
+        # (off in parameter files that predate them)
+        self.track_districts = fixed_params.get("track_districts", False)
+        self.city_boundary = fixed_params.get("city_boundary", "none")
+        if self.city_boundary not in QuezonCity.BOUNDARIES:
+            raise ValueError("Unknown city boundary policy: %s" % self.city_boundary)
+
+        # Instantiates scheduler, status transition events and space for model
+        self.schedule = ActiveSetActivation(self)
+        self.events = TimingWheel()
         self.grid = QuezonCity(self)
+        self.steps = 0
 
-        # Instantiates PersonAgents
-        for compartment, state in (
-            ("susceptible", State.SUSCEPTIBLE),
-            ("exposed", State.EXPOSED),
-            ("infected", State.INFECTED)
-        ):
+        # Instantiates the population
+        if self.engine == "hybrid":
+            if population is not None:
+                raise ValueError("The hybrid engine does not take a synthesized population")
+            self.population = HybridPopulation(self, variable_params)
+        elif self.engine == "compartmental":
+            if population is not None:
+                raise ValueError("The compartmental engine does not take a synthesized population")
+            self.population = CompartmentalPopulation(self)
+        elif self.engine == "vectorized":
+            self.population = VectorizedPopulation(self, self.initial_population(population, population_cache))
+        else:
+            self.population = None
             self.instantiate_person_agents(
-                variable_params[compartment],
-                state,
+                self.initial_population(population, population_cache),
                 self.schedule,
-                self.grid,
-                self.wearing_mask_percentage,
-                self.physical_distancing_percentage,
-                self.mobile_worker_percentage)
-
-        # Instantiates data collectors
-        self.data_collector_1 = self.instantiate_data_collector("district1")
-        self.data_collector_2 = self.instantiate_data_collector("district2")
-        self.data_collector_3 = self.instantiate_data_collector("district3")
-        self.data_collector_4 = self.instantiate_data_collector("district4")
-        self.data_collector_5 = self.instantiate_data_collector("district5")
-        self.data_collector_6 = self.instantiate_data_collector("district6")
-        self.data_collector_total = self.instantiate_data_collector("total")
+                self.grid)
+
+        # Instantiates the SEIR recorder, with a DataCollector-like view of
+        # each district for the SEIRCharts
+        self.recorder = SEIRRecorder(self)
+        self.data_collector_1 = self.recorder.view("district1")
+        self.data_collector_2 = self.recorder.view("district2")
+        self.data_collector_3 = self.recorder.view("district3")
+        self.data_collector_4 = self.recorder.view("district4")
+        self.data_collector_5 = self.recorder.view("district5")
+        self.data_collector_6 = self.recorder.view("district6")
+        self.data_collector_total = self.recorder.view("total")
 
         # Sets summary-related variables
         self.summary = self.initialize_summary_dictionary()
-        self.steps = 0
+
+        # Optional on-disk output (see stream_output) and instrumentation
+        # (see instrument)
+        self.output = None
+        self.instrumentation = None
 
         # Sets the running state of model to True
         self.running = True
@@ -135,82 +194,184 @@ class Covid19Model(Model):
             }
         return summary
 
-    def instantiate_data_collector(self, district):
+    def initial_population(self, population, population_cache):
         """
-        Returns the datacollector for given district
+        Returns the given population columns, or the cached or freshly
+        synthesized ones if None
         """
-        return DataCollector(
-            model_reporters = {
-                "S": get_susceptible_function(district),
-                "E": get_exposed_function(district),
-                "I": get_infected_function(district),
-                "R": get_removed_function(district)
-            })
+        if population is None and population_cache is not None and self._seed is not None:
+            population = population_cache.population(self, self.variable_params)
+        if population is None:
+            population = synthesize_population(
+                self.variable_params,
+                self.grid,
+                self.streams["population"],
+                self.wearing_mask_percentage,
+                self.physical_distancing_percentage,
+                self.mobile_worker_percentage)
+        return population
 
-    def instantiate_person_agents(
-        self,
-        population,
-        state,
-        schedule,
-        grid,
-        wearing_mask_percentage,
-        physical_distancing_percentage,
-        mobile_worker_percentage,
-    ):
+    def instantiate_person_agents(self, population, schedule, grid):
         """
-        Instantiates PersonAgents
-        """
-        # Nine age groups: 0-9, 10-19, ..., 80-89
-        age_groups = [(i*10, i*10+9) for i in range(9)]
-
-        for i, age_group_pop in enumerate(population):
-            min_age, max_age = age_groups[i]
-
-            for j, district_pop in enumerate(age_group_pop):
-                district = "district" + str(j + 1)
-
-                for k in range(district_pop):
-                    # Agent's properties
-                    id = str(i) + str(j) + str(k) + state
-                    age = random.randint(min_age, max_age)
-                    wearing_mask = coin_toss(wearing_mask_percentage)
-                    physical_distancing = coin_toss(physical_distancing_percentage)
-                    mobile_worker = coin_toss(mobile_worker_percentage) if 18 <= age <= 65 else False
-
-                    # Generates a random point for agent's position
-                    pos_x, pos_y = self.grid.random_position(district)
-                    shape = Point(pos_x, pos_y)
-
-                    # Instantiates Agent
-                    agent = PersonAgent(
-                        unique_id = id,
-                        model = self,
-                        shape = shape,
-                        district = district,
-                        state = state,
-                        age = age,
-                        wearing_mask = wearing_mask,
-                        physical_distancing = physical_distancing,
-                        mobile_worker = mobile_worker)
-
-                    # Adds agent to grid and scheduler
-                    grid.add_agents(agent)
-                    schedule.add(agent)
+        Instantiates PersonAgents from a synthesized population
+        (see covid_19_model.population)
+        """
+        agents = []
+        columns = zip(
+            population["unique_id"].tolist(),
+            population["x"].tolist(),
+            population["y"].tolist(),
+            population["district"].tolist(),
+            population["state"].tolist(),
+            population["age"].tolist(),
+            population["wearing_mask"].tolist(),
+            population["physical_distancing"].tolist(),
+            population["mobile_worker"].tolist())
+
+        for id, x, y, district, state, age, wearing_mask, physical_distancing, mobile_worker in columns:
+            agents.append(PersonAgent(
+                unique_id = id,
+                model = self,
+                shape = Point(x, y),
+                district = QuezonCity.DISTRICTS[district],
+                state = StateCode.STATES[state],
+                age = age,
+                wearing_mask = wearing_mask,
+                physical_distancing = physical_distancing,
+                mobile_worker = mobile_worker))
+
+        # Restores timers and grid insertion order (see covid_19_model.checkpoint)
+        if "days_incubating" in population:
+            for agent, days_incubating, days_infected in zip(
+                agents,
+                population["days_incubating"].tolist(),
+                population["days_infected"].tolist()
+            ):
+                agent.days_incubating = days_incubating
+                agent.days_infected = days_infected
+
+        # Adds agents to grid and scheduler
+        if "grid_order" in population:
+            grid.add_agents([agents[i] for i in population["grid_order"].tolist()])
+        else:
+            grid.add_agents(agents)
+        for agent in agents:
+            schedule.add(agent)
+
+        # Schedules the status transitions of the exposed and infected agents
+        if "transition_step" in population:
+            transition_step = population["transition_step"].tolist()
+            for i in population["event_order"].tolist():
+                self.events.schedule(agents[i], transition_step[i])
+        else:
+            for agent in agents:
+                agent.schedule_status(self.steps + 1)
 
     def step(self):
         """
         Advances the model by one step
         """
+        if self.instrumentation is not None:
+            self.instrumentation.step()
+            return
+
         self.steps += 1
-        self.data_collector_1.collect(self)
-        self.data_collector_2.collect(self)
-        self.data_collector_3.collect(self)
-        self.data_collector_4.collect(self)
-        self.data_collector_5.collect(self)
-        self.data_collector_6.collect(self)
-        self.data_collector_total.collect(self)
-        self.schedule.step()
-        self.grid._recreate_rtree()
+        self.recorder.collect()
+
+        if self.population is not None:
+            self.population.step()
+        else:
+            self.process_transitions()
+            self.schedule.step()
+
+        self.end_step()
+
+    def process_transitions(self):
+        """
+        Applies the status transitions of the object engine that are due at
+        this step, in random order (see covid_19_model.schedule)
+        """
+        agents = self.events.pop(self.steps)
+        self.random.shuffle(agents)
+        for agent in agents:
+            agent.status()
+
+    def end_step(self):
+        """
+        Writes the step's output
+        """
+        if self.output is not None:
+            self.output.collect()
+
+    def update_parameters(self):
+        """
+        Refreshes the values derived from the parameters (the agents'
+        susceptibility and the scheduler's set of agents allowed to move,
+        the population's per-district arrays) after
+        changing any of them on the model, and redraws the pending status
+        transitions with the new probabilities from the next step on
+        (exact, since their waiting times are memoryless)
+        """
+        if self.population is not None:
+            self.population.update_parameters()
+        else:
+            for agent in self.schedule.agents:
+                agent.update_susceptibility()
+                agent.schedule_status(self.steps + 1)
+            self.schedule.refresh()
+
+    def redraw_transitions(self):
+        """
+        Redraws the pending status transitions from the next step on with
+        the model's current streams, e.g. after reseed. Only the exposed and
+        infected agents are touched, so that a forked copy of the model
+        keeps sharing the pages of every other agent with its parent.
+        """
+        if self.population is not None:
+            self.population.redraw_transitions()
+        else:
+            for agent in sorted(self.events.agents(), key = lambda agent: agent.unique_id):
+                agent.schedule_status(self.steps + 1)
+
+    def instrument(self, log_every = 0, json_path = None):
+        """
+        Enables per-step phase timings and counters
+        (see covid_19_model.instrumentation)
+        """
+        self.instrumentation = Instrumentation(self, log_every, json_path)
+        return self.instrumentation
+
+    def parallelize(self, tiles = None):
+        """
+        Splits the vectorized population into spatial tiles stepped by
+        worker processes, one per CPU by default
+        (see covid_19_model.parallel)
+        """
+        self.population = ParallelPopulation(self, tiles)
+        return self.population
+
+    def stream_output(self, directory, flush_every = 100, snapshot_every = 0):
+        """
+        Streams the SEIR counts, summary peaks and optional agent snapshots
+        of the run to a directory (see covid_19_model.output)
+        """
+        self.output = StreamingOutput(self, directory, flush_every, snapshot_every)
+        self.output.collect()
+        return self.output
+
+    def reseed(self, seed):
+        """
+        Reseeds every random number generator used by the model: the numpy
+        streams of each phase (self.streams) and the random.Random used by
+        the scheduler's shuffles (self.random, per instance rather than
+        mesa's class-level one). The workers of a parallelized model get
+        streams spawned from the new ones.
+        """
+        self.streams = RandomStreams(seed)
+        self.random = random.Random(int(self.streams.seed_sequence.generate_state(1)[0]))
+        self._seed = seed
+        if isinstance(getattr(self, "population", None), ParallelPopulation):
+            self.population.reseed()
 
     def get_compartment(self, district, compartment):
         return self.SEIR[district][compartment]
@@ -234,16 +395,17 @@ class Covid19Model(Model):
     #     """
     #     return self.as_infection_expectation[district] * self.incubation_rate[district]
 
-    def compute_as_infection_probability(self, as_infection_expectation, incubation_rate):
+    @staticmethod
+    def compute_as_infection_probability(as_infection_expectation, incubation_rate):
         as_infection_probability = {}
 
         for key in incubation_rate:
-            as_infection_expectation[key] = as_infection_expectation[key] * incubation_rate[key]
+            as_infection_probability[key] = as_infection_expectation[key] * incubation_rate[key]
 
-        return as_infection_expectation
+        return as_infection_probability
 
+    @staticmethod
     def compute_localized_immunity(
-        self,
         district_poverty_score,
         natural_immunity,
         preexisting_conditions,
@@ -268,3 +430,23 @@ class Covid19Model(Model):
         self.SEIR[district][compartment] -= 1
         self.SEIR["total"][compartment] -= 1
 
+    def relocate(self, prev_district, next_district, compartment, count = 1):
+        """
+        Moves count agents of a compartment from one district to another;
+        the totals do not change
+        """
+        self.SEIR[prev_district][compartment] -= count
+        self.SEIR[next_district][compartment] += count
+        self.recorder.relocate(prev_district, compartment, -count)
+        self.recorder.relocate(next_district, compartment, count)
+
+    def transfer(self, district, prev_compartment, next_compartment, count):
+        """
+        Moves count agents of a district from one compartment to another
+        """
+        self.SEIR[district][prev_compartment] -= count
+        self.SEIR["total"][prev_compartment] -= count
+        self.SEIR[district][next_compartment] += count
+        self.SEIR["total"][next_compartment] += count
+
+
@@ -0,0 +1,177 @@
+# output.py
+
+"""
+Streaming on-disk output of a running Covid19Model.
+
+Records are buffered for flush_every steps and then appended to raw binary
+files of fixed-size records, which can be memory-mapped by a reader while
+the run is still in progress. A directory holds:
+    meta.json: layout and number of committed records ("steps")
+    seir.bin: int64 (steps, 7, 4) S, E, I, R of district1..6 and total
+    summary.bin: int64 (steps, 7, 4) max(E), t, max(I), t of the same rows
+    snapshots/step_<t>.npz: optional agent-level snapshots
+        (unique_id, x, y, district, state)
+
+Row t holds the state after t steps (row 0 is the initial state). meta.json
+is replaced atomically after the data of a flush is written, so a reader
+(or a crash) never sees a partially written record as committed.
+"""
+
+from covid_19_model.enum.state import StateCode
+from covid_19_model.recorder import RECORDED_DISTRICTS
+from covid_19_model.space import QuezonCity
+import numpy as np
+import json
+import os
+
+RECORD_SHAPE = (len(RECORDED_DISTRICTS), 4)
+
+class StreamingOutput:
+    """
+    StreamingOutput appends the model's SEIR counts and summary peaks to disk
+    every flush_every steps, and writes an agent-level snapshot every
+    snapshot_every steps (never if 0).
+    """
+
+    def __init__(self, model, directory, flush_every = 100, snapshot_every = 0):
+        self.model = model
+        self.directory = directory
+        self.flush_every = flush_every
+        self.snapshot_every = snapshot_every
+        self.committed = 0
+        self.buffered = 0
+        self.seir_buffer = np.zeros((flush_every,) + RECORD_SHAPE, dtype = np.int64)
+        self.summary_buffer = np.zeros((flush_every,) + RECORD_SHAPE, dtype = np.int64)
+
+        os.makedirs(os.path.join(directory, "snapshots"), exist_ok = True)
+        for name in ("seir.bin", "summary.bin"):
+            open(os.path.join(directory, name), "wb").close()
+        self.write_meta()
+
+    def collect(self):
+        """
+        Buffers the current records, flushing once the buffer is full or the
+        model stopped running
+        """
+        SEIR, summary = self.model.SEIR, self.model.summary
+        for i, district in enumerate(RECORDED_DISTRICTS):
+            counts = SEIR[district]
+            max_exposed, max_exposed_step = summary[district]["max_exposed"]
+            max_infected, max_infected_step = summary[district]["max_infected"]
+            self.seir_buffer[self.buffered, i] = (counts["S"], counts["E"], counts["I"], counts["R"])
+            self.summary_buffer[self.buffered, i] = (
+                max_exposed, max_exposed_step, max_infected, max_infected_step)
+        self.buffered += 1
+
+        step = self.committed + self.buffered - 1
+        if self.snapshot_every and step % self.snapshot_every == 0:
+            self.snapshot(step)
+
+        if self.buffered == self.flush_every or not self.model.running:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered records and commits them in meta.json
+        """
+        if self.buffered == 0:
+            return
+
+        for name, buffer in (("seir.bin", self.seir_buffer), ("summary.bin", self.summary_buffer)):
+            with open(os.path.join(self.directory, name), "ab") as file:
+                file.write(buffer[:self.buffered].tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+
+        self.committed += self.buffered
+        self.buffered = 0
+        self.write_meta()
+
+    def close(self):
+        self.flush()
+
+    def write_meta(self):
+        meta = {
+            "steps": self.committed,
+            "dtype": "int64",
+            "record_shape": RECORD_SHAPE,
+            "districts": RECORDED_DISTRICTS,
+            "seir_columns": ["S", "E", "I", "R"],
+            "summary_columns": ["max_exposed", "max_exposed_step", "max_infected", "max_infected_step"],
+        }
+        path = os.path.join(self.directory, "meta.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(path + ".tmp", path)
+
+    def snapshot(self, step):
+        """
+        Writes the agent-level state of the model
+        """
+        np.savez(
+            os.path.join(self.directory, "snapshots", "step_%06d.npz" % step),
+            **agent_columns(self.model))
+
+def agent_columns(model):
+    """
+    Returns the unique_id, x, y, district and state of every agent that is
+    still in the model, as arrays
+    """
+    if model.engine == "compartmental":
+        raise ValueError("The compartmental engine has no agents")
+
+    population = model.population
+    if population is not None:
+        return {
+            "unique_id": np.arange(len(population)),
+            "x": population.x,
+            "y": population.y,
+            "district": population.district,
+            "state": population.state,
+        }
+
+    agents = model.schedule.agents
+    return {
+        "unique_id": np.array([agent.unique_id for agent in agents]),
+        "x": np.array([agent.shape.x for agent in agents]),
+        "y": np.array([agent.shape.y for agent in agents]),
+        "district": np.array([QuezonCity.DISTRICTS.index(agent.district) for agent in agents], dtype = np.int8),
+        "state": np.array([StateCode.STATES.index(agent.state) for agent in agents], dtype = np.int8),
+    }
+
+def read_output(directory):
+    """
+    Returns the committed records of an output directory (possibly of a
+    run still in progress) as read-only memory maps:
+    {"steps": t, "seir": (t, 7, 4) array, "summary": (t, 7, 4) array,
+     "snapshots": sorted list of snapshot steps}
+    """
+    with open(os.path.join(directory, "meta.json")) as file:
+        meta = json.load(file)
+
+    steps = meta["steps"]
+    shape = (steps,) + tuple(meta["record_shape"])
+    output = {"steps": steps}
+
+    for name in ("seir", "summary"):
+        if steps == 0:
+            output[name] = np.zeros(shape, dtype = meta["dtype"])
+        else:
+            output[name] = np.memmap(
+                os.path.join(directory, name + ".bin"),
+                dtype = meta["dtype"],
+                mode = "r",
+                shape = shape)
+
+    output["snapshots"] = sorted(
+        int(name[len("step_"):-len(".npz")])
+        for name in os.listdir(os.path.join(directory, "snapshots"))
+        if name.endswith(".npz"))
+    return output
+
+def read_snapshot(directory, step):
+    """
+    Returns the agent-level snapshot of a step as a dictionary of arrays
+    """
+    with np.load(os.path.join(directory, "snapshots", "step_%06d.npz" % step)) as snapshot:
+        return dict(snapshot)
@@ -0,0 +1,332 @@
+# parallel.py
+
+"""
+Multi-process spatial domain decomposition of the vectorized engine.
+
+Enable with model.parallelize(tiles) on a model with engine = "vectorized".
+The city is cut into vertical strips holding equal shares of the initial
+population, and each strip (tile) is owned by a worker process forked from
+the model, which steps the agents inside it as a VectorizedPopulation with
+its own random streams. Every step:
+    status: each worker updates its agents and reports its E -> I and
+        I -> R transitions per district, along with its infected agents
+        within agent_exposure_distance of its borders (the halo)
+    interact: each worker receives the halo copies of its neighbors, so
+        that contacts across a border are resolved by the susceptible
+        agent's owner, and reports its S -> E transitions
+    move: each worker moves its agents, reports the changes of district of
+        its agents (see Covid19Model.track_districts) and hands over the
+        agents that left its strip, which migrate to the owner of their
+        new position
+
+The parent reduces the reported transitions into the model's SEIR and
+summary in the same order as the vectorized engine, so the recorder,
+output and charts work unchanged. Runs are reproducible for a given seed
+and number of tiles, but differ from a serial run of the same seed.
+Requires the "fork" start method (Linux, macOS). Model.reseed sends new
+streams to the workers. The workers are stopped by close, or when the
+population is garbage collected or the interpreter exits.
+"""
+
+from covid_19_model.enum.state import StateCode
+from covid_19_model.space import QuezonCity
+from covid_19_model.vectorized import VectorizedPopulation, report_transitions, report_relocations, SUSCEPTIBLE, EXPOSED, INFECTED, REMOVED
+import multiprocessing
+import numpy as np
+import weakref
+import os
+
+# Model attributes read by VectorizedPopulation, sent to the workers by
+# update_parameters
+PARAMETERS = (
+    "steps",
+    "transmission_rate",
+    "as_infection_probability",
+    "removal_rate",
+    "localized_immunity",
+    "wearing_mask_protection",
+    "physical_distancing_protection",
+    "min_age_restriction",
+    "max_age_restriction",
+    "agent_mobility_range",
+    "agent_exposure_distance",
+    "track_districts",
+    "city_boundary",
+)
+
+def district_counts(model, compartment):
+    """
+    Returns the count of a compartment in every district of a model
+    """
+    return np.array([model.SEIR[district][compartment] for district in QuezonCity.DISTRICTS])
+
+def seir_counts(model):
+    """
+    Returns the (4, 6) S, E, I, R counts of every district of a model
+    """
+    return np.array([district_counts(model, compartment) for compartment in StateCode.STATES])
+
+def select(columns, mask):
+    return {name: column[mask] for name, column in columns.items()}
+
+def concatenate(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in VectorizedPopulation.ARRAYS}
+
+class ParallelPopulation:
+    """
+    ParallelPopulation drives the worker processes of a parallelized model.
+
+    Properties:
+        model: Model which the population belongs to
+        edges: x coordinates of the borders between tiles (tile t owns
+            edges[t - 1] <= x < edges[t])
+        connections: Pipe to each worker
+        sizes: Number of agents of each tile
+        interacting, candidates_examined, contacts, moved: Counters of the
+            last step, summed over the workers (see VectorizedPopulation)
+    """
+
+    # Phases of a step, in order
+    PHASES = ("status", "interact", "move")
+
+    def __init__(self, model, tiles = None):
+        """
+        Splits the model's vectorized population into tiles (default: one
+        per CPU) and starts one worker per tile
+        """
+        if model.engine != "vectorized":
+            raise ValueError("Only the vectorized engine can be parallelized")
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("ParallelPopulation requires the fork start method")
+
+        self.model = model
+        tiles = tiles or os.cpu_count()
+        population = model.population
+        self.edges = np.quantile(population.x, np.arange(1, tiles) / tiles)
+        owner = self.owner(population.x)
+        bounds = np.concatenate([[-np.inf], self.edges, [np.inf]])
+        streams = model.streams.spawn(tiles)
+
+        context = multiprocessing.get_context("fork")
+        self.connections = []
+        self.workers = []
+        # Stops the workers started so far if the population is discarded
+        # without close, or if starting the others fails
+        self.finalizer = weakref.finalize(self, _stop, self.connections, self.workers)
+        for tile in range(tiles):
+            parent, child = context.Pipe()
+            worker = context.Process(
+                target = _work,
+                args = (child, model, np.flatnonzero(owner == tile), bounds[tile], bounds[tile + 1], streams[tile]),
+                daemon = True)
+            worker.start()
+            child.close()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+        self.sizes = np.bincount(owner, minlength = tiles)
+        self.halos = None
+        self.interacting = self.candidates_examined = self.contacts = self.moved = 0
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def __getattr__(self, name):
+        # Per-agent arrays are gathered from the workers on demand
+        if name in VectorizedPopulation.ARRAYS:
+            return np.concatenate(self.request("gather", [name] * len(self.connections)))
+        raise AttributeError(name)
+
+    def owner(self, x):
+        """
+        Returns the tile owning each position
+        """
+        return np.searchsorted(self.edges, x, side = "right")
+
+    def request(self, command, payloads):
+        """
+        Sends a command to every worker, then returns their replies
+        """
+        for connection, payload in zip(self.connections, payloads):
+            connection.send((command, payload))
+        return [connection.recv() for connection in self.connections]
+
+    def step(self):
+        """
+        Advances the population by a step
+        """
+        for phase in self.PHASES:
+            getattr(self, phase)()
+
+    def status(self):
+        """
+        E -> I and I -> R transitions of every tile
+        """
+        replies = self.request("status", [self.model.steps] * len(self.connections))
+        removals = sum(removed for removed, _, _ in replies)
+        onsets = sum(onset for _, onset, _ in replies)
+
+        # Same order as VectorizedPopulation.status
+        report_transitions(self.model, removals, INFECTED, REMOVED)
+        report_transitions(self.model, onsets, EXPOSED, INFECTED, "max_infected")
+
+        # Routes the halo copies to every other tile within reach
+        halos = [halo for _, _, halo in replies]
+        source = np.repeat(np.arange(len(halos)), [len(halo["x"]) for halo in halos])
+        halo = concatenate(halos)
+        distance = self.model.agent_exposure_distance
+        bounds = np.concatenate([[-np.inf], self.edges, [np.inf]])
+        self.halos = [
+            select(halo, (source != tile) & (bounds[tile] - distance <= halo["x"]) & (halo["x"] < bounds[tile + 1] + distance))
+            for tile in range(len(self.connections))
+        ]
+
+    def interact(self):
+        """
+        S -> E transitions of every tile, including contacts with the halo
+        """
+        replies = self.request("interact", self.halos)
+        self.halos = None
+        exposures = sum(exposed for exposed, _ in replies)
+        counters = np.sum([counters for _, counters in replies], axis = 0)
+        self.interacting, self.candidates_examined, self.contacts = (int(count) for count in counters)
+
+        report_transitions(self.model, exposures, SUSCEPTIBLE, EXPOSED, "max_exposed")
+
+    def move(self):
+        """
+        Moves the agents of every tile and migrates those that changed tile
+        """
+        replies = self.request("move", [None] * len(self.connections))
+        self.moved = sum(moved for _, moved, _, _ in replies)
+        report_relocations(self.model, sum(relocations for _, _, _, relocations in replies))
+
+        migrants = concatenate([emigrants for emigrants, _, _, _ in replies])
+        owner = self.owner(migrants["x"])
+        for tile, connection in enumerate(self.connections):
+            # No reply: the workers append the immigrants before their next command
+            connection.send(("receive", select(migrants, owner == tile)))
+
+        self.sizes = np.array([size for _, _, size, _ in replies]) + np.bincount(owner, minlength = len(self.connections))
+
+    def update_parameters(self):
+        """
+        Sends the parameters of the model to the workers.
+        Call again after changing any of them on the model.
+        """
+        parameters = {name: getattr(self.model, name) for name in PARAMETERS}
+        for connection in self.connections:
+            connection.send(("parameters", parameters))
+
+    def redraw_transitions(self):
+        """
+        Has the workers redraw the pending status transitions of their
+        agents from the next step on
+        """
+        for connection in self.connections:
+            connection.send(("redraw", self.model.steps))
+
+    def reseed(self):
+        """
+        Sends each worker its own stream of the model's (new) streams, as
+        spawned when the workers were started
+        """
+        streams = self.model.streams.spawn(len(self.connections))
+        for connection, stream in zip(self.connections, streams):
+            connection.send(("streams", stream))
+
+    def close(self):
+        """
+        Stops the workers
+        """
+        self.finalizer()
+
+def _stop(connections, workers, timeout = 5):
+    """
+    Stops the workers of a ParallelPopulation, terminating those that do
+    not exit within timeout seconds
+    """
+    for connection in connections:
+        try:
+            connection.send(("close", None))
+        except (OSError, ValueError):
+            pass
+    for connection, worker in zip(connections, workers):
+        worker.join(timeout)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+        connection.close()
+    connections.clear()
+    workers.clear()
+
+def _work(connection, model, indices, low, high, streams):
+    """
+    Serves the commands of a ParallelPopulation for the tile low <= x < high
+    """
+    parent_population = model.population
+    model.streams = streams
+    model.output = model.instrumentation = None
+    model.population = population = VectorizedPopulation(model, {
+        name: getattr(parent_population, name)[indices]
+        for name in VectorizedPopulation.ARRAYS
+    })
+    del parent_population
+    distance = model.agent_exposure_distance
+
+    while True:
+        command, payload = connection.recv()
+
+        if command == "status":
+            # Transitions fall due against the parent's step counter
+            model.steps = payload
+            removed = district_counts(model, "R")
+            exposed = district_counts(model, "E")
+            population.status()
+            removals = district_counts(model, "R") - removed
+            onsets = exposed - district_counts(model, "E")
+
+            border = (population.state == INFECTED) & (
+                (population.x < low + distance) | (population.x >= high - distance))
+            halo = {name: getattr(population, name)[border] for name in VectorizedPopulation.ARRAYS}
+            connection.send((removals, onsets, halo))
+
+        elif command == "interact":
+            # Halo copies are infected, so only the tile's own agents change state
+            susceptible = district_counts(model, "S")
+            size = len(population)
+            population.extend(payload)
+            population.interact()
+            population.keep(np.arange(len(population)) < size)
+            counters = (population.interacting, population.candidates_examined, population.contacts)
+            connection.send((susceptible - district_counts(model, "S"), counters))
+
+        elif command == "move":
+            counts = seir_counts(model)
+            population.move()
+            inside = (low <= population.x) & (population.x < high)
+            emigrants = {name: getattr(population, name)[~inside] for name in VectorizedPopulation.ARRAYS}
+            population.keep(inside)
+            connection.send((emigrants, population.moved, len(population), seir_counts(model) - counts))
+
+        elif command == "receive":
+            population.extend(payload)
+
+        elif command == "gather":
+            connection.send(getattr(population, payload))
+
+        elif command == "redraw":
+            model.steps = payload
+            population.redraw_transitions()
+
+        elif command == "streams":
+            model.streams = payload
+
+        elif command == "parameters":
+            for name, value in payload.items():
+                setattr(model, name, value)
+            population.update_parameters()
+
+        elif command == "close":
+            connection.close()
+            return
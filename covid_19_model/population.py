@@ -0,0 +1,74 @@
+# population.py
+
+"""
+Bulk synthesis of the initial population.
+
+Every person of the age group x district matrices of variable_parameters.json
+is drawn in a single vectorized pass: ages, behavior flags and positions
+(area-weighted triangle sampling of the district, see space.TriangleSampler).
+"""
+
+from covid_19_model.enum.state import StateCode
+from covid_19_model.space import QuezonCity
+import numpy as np
+
+# Nine age groups: 0-9, 10-19, ..., 80-89
+AGE_GROUPS = [(i*10, i*10+9) for i in range(9)]
+
+# Compartments of variable_parameters.json that hold agents
+COMPARTMENTS = (
+    ("susceptible", StateCode.SUSCEPTIBLE),
+    ("exposed", StateCode.EXPOSED),
+    ("infected", StateCode.INFECTED),
+)
+
+def synthesize_population(
+    variable_params,
+    grid,
+    rng,
+    wearing_mask_percentage,
+    physical_distancing_percentage,
+    mobile_worker_percentage,
+):
+    """
+    Returns the initial population as a dictionary of arrays:
+        unique_id: 0, 1, ..., n - 1 (also the row index)
+        x, y: Projected coordinates
+        district: District index (0 = district1, ..., 5 = district6)
+        state: State code (see StateCode)
+        age, wearing_mask, physical_distancing, mobile_worker
+
+    Agents are ordered by compartment, age group and district, in the
+    order of the input matrices.
+    """
+    # (compartment, age group, district) counts
+    counts = np.array([variable_params[compartment] for compartment, _ in COMPARTMENTS], dtype = np.int64)
+    n = int(counts.sum())
+    compartment_index, age_group, district = np.indices(counts.shape)
+
+    state = np.repeat(np.array([code for _, code in COMPARTMENTS])[compartment_index].ravel(), counts.ravel())
+    district = np.repeat(district.ravel(), counts.ravel())
+    min_age = np.repeat(np.array([low for low, _ in AGE_GROUPS])[age_group].ravel(), counts.ravel())
+    age = min_age + rng.integers(0, 10, n)
+
+    wearing_mask = rng.random(n) < wearing_mask_percentage
+    physical_distancing = rng.random(n) < physical_distancing_percentage
+    mobile_worker = (rng.random(n) < mobile_worker_percentage) & (18 <= age) & (age <= 65)
+
+    x = np.empty(n)
+    y = np.empty(n)
+    for j, name in enumerate(QuezonCity.DISTRICTS):
+        members = np.flatnonzero(district == j)
+        x[members], y[members] = grid.random_positions(name, len(members), rng)
+
+    return {
+        "unique_id": np.arange(n),
+        "x": x,
+        "y": y,
+        "district": district.astype(np.int8),
+        "state": state.astype(np.int8),
+        "age": age.astype(np.int8),
+        "wearing_mask": wearing_mask,
+        "physical_distancing": physical_distancing,
+        "mobile_worker": mobile_worker,
+    }
@@ -0,0 +1,190 @@
+# recorder.py
+
+"""
+SEIR recorder of Covid19Model.
+
+Replaces the seven per-district mesa DataCollectors with one preallocated
+(steps x districts x compartments) integer array that grows in chunks.
+"""
+
+from covid_19_model.space import QuezonCity
+import numpy as np
+
+# Rows of the recorded arrays: the six districts, then the city total
+RECORDED_DISTRICTS = QuezonCity.DISTRICTS + ["total"]
+
+COMPARTMENTS = "SEIR"
+TRANSITIONS = ("S_E", "E_I", "I_R")
+
+class SEIRRecorder:
+    """
+    SEIRRecorder stores the SEIR counts of every district at every step.
+
+    Properties:
+        counts: (steps, 7, 4) array of S, E, I, R per district and total
+        transitions: (steps, 7, 3) array of S->E, E->I and I->R counts
+            between the previous record and this one (zeros at step 0)
+        steps: Number of records
+        relocated: (7, 4) net S, E, I, R counts of the agents that moved into
+            each district since the last record (see relocate)
+
+    Since the model's only flows are S -> E -> I -> R, the transition counts
+    follow exactly from consecutive records, once the agents that changed
+    district are taken out of the differences (d):
+        S->E = -dS, E->I = S->E - dE, I->R = dR
+    """
+
+    def __init__(self, model, chunk_size = 256):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.steps = 0
+        self._counts = np.zeros((chunk_size, len(RECORDED_DISTRICTS), 4), dtype = np.int64)
+        self._transitions = np.zeros((chunk_size, len(RECORDED_DISTRICTS), 3), dtype = np.int64)
+        self.relocated = np.zeros((len(RECORDED_DISTRICTS), 4), dtype = np.int64)
+
+    @property
+    def counts(self):
+        return self._counts[:self.steps]
+
+    @property
+    def transitions(self):
+        return self._transitions[:self.steps]
+
+    def collect(self):
+        """
+        Records the current SEIR counts of the model
+        """
+        if self.steps == len(self._counts):
+            self._counts = self.grow(self._counts)
+            self._transitions = self.grow(self._transitions)
+
+        SEIR = self.model.SEIR
+        row = self._counts[self.steps]
+        for i, district in enumerate(RECORDED_DISTRICTS):
+            counts = SEIR[district]
+            row[i] = (counts["S"], counts["E"], counts["I"], counts["R"])
+
+        if self.steps > 0:
+            delta = row - self._counts[self.steps - 1] - self.relocated
+            exposures = -delta[:, 0]
+            transitions = np.stack([exposures, exposures - delta[:, 1], delta[:, 3]], axis = 1)
+            if (transitions < 0).any():
+                raise RuntimeError(
+                    "Negative transition counts at record %d: SEIR counts changed without "
+                    "a transition or a relocation" % self.steps)
+            self._transitions[self.steps] = transitions
+
+        self.relocated[:] = 0
+        self.steps += 1
+
+    def relocate(self, district, compartment, count):
+        """
+        Records that count agents of a compartment moved into a district
+        (out of it if negative), so that they are not taken for transitions
+        """
+        self.relocated[RECORDED_DISTRICTS.index(district), COMPARTMENTS.index(compartment)] += count
+
+    def restore(self, counts, transitions, relocated = None):
+        """
+        Replaces the records, e.g. with those of a checkpoint
+        """
+        self.relocated[:] = 0 if relocated is None else relocated
+        self.steps = len(counts)
+        size = (self.steps // self.chunk_size + 1) * self.chunk_size
+        self._counts = np.zeros((size,) + counts.shape[1:], dtype = np.int64)
+        self._transitions = np.zeros((size,) + transitions.shape[1:], dtype = np.int64)
+        self._counts[:self.steps] = counts
+        self._transitions[:self.steps] = transitions
+
+    def grow(self, array):
+        """
+        Returns a copy of array with chunk_size more rows
+        """
+        grown = np.zeros((len(array) + self.chunk_size,) + array.shape[1:], dtype = array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def series(self, district, compartment):
+        """
+        Returns the recorded series of a district's compartment (or transition)
+        """
+        i = RECORDED_DISTRICTS.index(district)
+        if compartment in TRANSITIONS:
+            return self.transitions[:, i, TRANSITIONS.index(compartment)]
+        return self.counts[:, i, COMPARTMENTS.index(compartment)]
+
+    def to_npz(self, filename):
+        """
+        Saves the records to a .npz file
+        """
+        np.savez_compressed(
+            filename,
+            counts = self.counts,
+            transitions = self.transitions,
+            districts = np.array(RECORDED_DISTRICTS),
+            compartments = np.array(list(COMPARTMENTS)),
+            transition_names = np.array(TRANSITIONS))
+
+    def to_dataframe(self):
+        """
+        Returns the records as a pandas DataFrame with one row per
+        (step, district) and one column per compartment and transition
+        """
+        import pandas as pd
+
+        steps, districts = self.steps, len(RECORDED_DISTRICTS)
+        data = {
+            "step": np.repeat(np.arange(steps), districts),
+            "district": np.tile(RECORDED_DISTRICTS, steps),
+        }
+        for k, compartment in enumerate(COMPARTMENTS):
+            data[compartment] = self.counts[:, :, k].ravel()
+        for k, transition in enumerate(TRANSITIONS):
+            data[transition] = self.transitions[:, :, k].ravel()
+
+        return pd.DataFrame(data)
+
+    def view(self, district):
+        """
+        Returns a DataCollector-like view of a district (see DistrictView)
+        """
+        return DistrictView(self, district)
+
+class DistrictView:
+    """
+    Read-only view of one district of an SEIRRecorder that quacks like a
+    mesa DataCollector, so that ChartModules (SEIRChart) can read it.
+    """
+
+    def __init__(self, recorder, district):
+        self.recorder = recorder
+        self.district = district
+
+    @property
+    def model_vars(self):
+        return {
+            compartment: RecordedSeries(self.recorder.series(self.district, compartment))
+            for compartment in COMPARTMENTS
+        }
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({
+            compartment: self.recorder.series(self.district, compartment)
+            for compartment in COMPARTMENTS
+        })
+
+class RecordedSeries:
+    """
+    Sequence over a recorded array that returns plain Python numbers,
+    which the visualization server can serialize to JSON
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return self.array[index].tolist()
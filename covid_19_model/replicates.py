@@ -0,0 +1,129 @@
+# replicates.py
+
+"""
+Monte Carlo replicates of a single configuration.
+
+The model is built once in the parent process. Every replicate then runs in
+a process forked from the parent, so the initialized population, district
+geometries and spatial index are shared copy-on-write instead of being
+rebuilt N times. Each replicate reseeds its random number generators and
+redraws only the pending transitions of its exposed and infected agents
+before stepping, leaving the pages of the other agents shared. Requires
+the "fork" start method (Linux, macOS).
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.recorder import RECORDED_DISTRICTS
+import multiprocessing
+import numpy as np
+import gc
+
+# Model shared with the forked workers
+_parent_model = None
+
+def seeds_for(seed, replicates):
+    """
+    Returns independent seeds for the replicates of a run
+    """
+    children = np.random.SeedSequence(seed).spawn(replicates)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+def record(model):
+    """
+    Returns the current SEIR counts as a (districts + total) x 4 array
+    """
+    return [model.get_SEIR(district) for district in RECORDED_DISTRICTS]
+
+def extinct(model):
+    """
+    Returns whether the epidemic of a model has died out (no exposed or
+    infected person left), after which its SEIR counts no longer change
+    """
+    return model.SEIR["total"]["E"] + model.SEIR["total"]["I"] == 0
+
+def run_model(model, steps):
+    """
+    Runs a model for at most the given number of steps (it stops early once
+    model.running is False or the epidemic is extinct) and returns its
+    results: the SEIR history as a (steps + 1) x 7 x 4 array (district1,
+    ..., district6, total; S, E, I, R) and the summary dictionary.
+    """
+    history = [record(model)]
+    for _ in range(steps):
+        if not model.running or extinct(model):
+            break
+        model.step()
+        history.append(record(model))
+
+    return {"history": np.array(history), "summary": model.summary}
+
+def _run_replicate(args):
+    """
+    Runs one replicate on the forked copy of the parent model
+    """
+    replicate, seed, steps = args
+    model = _parent_model
+    model.reseed(seed)
+
+    # The pending status transitions were drawn with the parent's seed
+    model.redraw_transitions()
+    result = run_model(model, steps)
+    result["replicate"] = replicate
+    result["seed"] = seed
+    return result
+
+def iterate_replicates(
+    variable_params,
+    fixed_params,
+    replicates,
+    steps,
+    engine = "object",
+    seed = None,
+    processes = None,
+):
+    """
+    Builds the model once, runs the replicates in forked workers and yields
+    the results of run_model as the replicates finish (in any order), each
+    with its "replicate" index and "seed".
+    """
+    global _parent_model
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("run_replicates requires the fork start method")
+
+    _parent_model = Covid19Model(variable_params, fixed_params, engine = engine, seed = seed)
+    tasks = [(i, s, steps) for i, s in enumerate(seeds_for(seed, replicates))]
+
+    # Moves the parent's objects out of the garbage collector's reach so that
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+    try:
+        # One task per worker: each replicate starts from a fresh fork of the
+        # untouched parent model
+        context = multiprocessing.get_context("fork")
+        with context.Pool(processes, maxtasksperchild = 1) as pool:
+            yield from pool.imap_unordered(_run_replicate, tasks, chunksize = 1)
+    finally:
+        gc.unfreeze()
+        _parent_model = None
+
+def run_replicates(
+    variable_params,
+    fixed_params,
+    replicates,
+    steps,
+    engine = "object",
+    seed = None,
+    processes = None,
+):
+    """
+    Builds the model once and runs the replicates in forked workers.
+
+    Returns the list of results of run_model, in replicate order, each with
+    its "replicate" index and "seed". See covid_19_model.ensemble to
+    aggregate many replicates without keeping their results.
+    """
+    results = iterate_replicates(variable_params, fixed_params, replicates, steps, engine, seed, processes)
+    return sorted(results, key = lambda result: result["replicate"])
@@ -0,0 +1,113 @@
+var AggregateMapModule = function (view, zoom, map_width, map_height, districts_url) {
+  // Create the map tag:
+  var map_tag = "<div style='width:" + map_width + "px; height:" + map_height + "px;border:1px dotted' id='aggregate-mapid'></div>"
+  // Append it to body:
+  var div = $(map_tag)[0]
+  $('#elements').append(div)
+
+  // Create Leaflet map, drawn on a canvas
+  var Lmap = L.map('aggregate-mapid', { preferCanvas: true }).setView(view, zoom)
+
+  // create the OSM tile layer with correct attribution
+  var osmUrl = 'http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png'
+  var osmAttrib = 'Map data © <a href="http://openstreetmap.org">OpenStreetMap</a> contributors'
+  var osm = new L.TileLayer(osmUrl, { minZoom: 0, maxZoom: 18, attribution: osmAttrib })
+  Lmap.addLayer(osm)
+
+  // District polygons are fetched once (and cached by the browser)
+  $.getJSON(districts_url, function (data) {
+    L.geoJSON(data, { style: { color: "Blue", fill: false, weight: 2 } }).addTo(Lmap)
+  })
+
+  var colors = ["Green", "Orange", "Red", "Grey"]
+  var cells = {}
+  var CellLayer = L.layerGroup().addTo(Lmap)
+  var SampleLayer = L.layerGroup().addTo(Lmap)
+  var frame = null
+
+  // Model coordinates are Web Mercator (EPSG:3857) meters
+  var toLatLng = function (x, y) {
+    return L.Projection.SphericalMercator.unproject(L.point(x, y))
+  }
+
+  var cellStyle = function (counts) {
+    // Colored by the most advanced active compartment of the cell
+    var state = counts[2] > 0 ? 2 : counts[1] > 0 ? 1 : counts[0] > 0 ? 0 : 3
+    var total = counts[0] + counts[1] + counts[2] + counts[3]
+    return {
+      color: colors[state],
+      weight: 0,
+      fillOpacity: Math.min(0.8, 0.15 + 0.1 * Math.log10(1 + total))
+    }
+  }
+
+  var renderHeatmap = function (data) {
+    if (data.base === null) {
+      CellLayer.clearLayers()
+      cells = {}
+    } else if (data.base !== frame) {
+      // Missed a delta: waits for the next keyframe
+      return
+    }
+    frame = data.frame
+
+    var grid = data.grid
+    for (var i = 0; i < data.cells.length; i++) {
+      var row = data.cells[i]
+      var key = row[0]
+      var counts = row.slice(1)
+      var empty = counts[0] + counts[1] + counts[2] + counts[3] === 0
+
+      if (key in cells) {
+        if (empty) {
+          CellLayer.removeLayer(cells[key])
+          delete cells[key]
+        } else {
+          cells[key].setStyle(cellStyle(counts))
+          cells[key].setPopupContent(popupContent(counts))
+        }
+      } else if (!empty) {
+        var cx = Math.floor(key / grid.height)
+        var cy = key % grid.height
+        var x = grid.x + cx * grid.size
+        var y = grid.y + cy * grid.size
+        var bounds = [toLatLng(x, y), toLatLng(x + grid.size, y + grid.size)]
+        cells[key] = L.rectangle(bounds, cellStyle(counts)).bindPopup(popupContent(counts))
+        CellLayer.addLayer(cells[key])
+      }
+    }
+  }
+
+  var renderSample = function (data) {
+    SampleLayer.clearLayers()
+    for (var i = 0; i < data.x.length; i++) {
+      SampleLayer.addLayer(L.circleMarker(toLatLng(data.x[i], data.y[i]), {
+        radius: 1, color: colors[data.state[i]]
+      }))
+    }
+  }
+
+  this.render = function (data) {
+    // null: nothing new to draw this step
+    if (data === null) return
+    if (data.mode === "heatmap") renderHeatmap(data)
+    else renderSample(data)
+  }
+
+  this.reset = function () {
+    CellLayer.clearLayers()
+    SampleLayer.clearLayers()
+    cells = {}
+    frame = null
+  }
+}
+
+function popupContent(counts) {
+  var popupContent = '<table>'
+  var labels = ["S", "E", "I", "R"]
+  for (var i = 0; i < labels.length; i++) {
+    popupContent += '<tr><td>' + labels[i] + '</td><td>' + counts[i] + '</td></tr>'
+  }
+  popupContent += '</table>'
+  return popupContent
+}
@@ -0,0 +1,168 @@
+# schedule.py
+
+"""
+Event scheduling of the object engine.
+
+The E -> I and I -> R transitions of a PersonAgent happen after geometric
+waiting times (one coin toss per step until the first success). Instead of
+tossing every step, the step of an agent's next transition is drawn once,
+when it enters E or I (RandomStreams.waiting_time), and the agent is put in
+the bucket of that step of a TimingWheel. Each step only the agents of the
+current bucket are processed.
+
+The interact and move phases of PersonAgent.step only do something for
+infected agents and for agents allowed to move. ActiveSetActivation keeps
+both sets up to date and steps only their union, in random order.
+"""
+
+from covid_19_model.enum.state import State
+from covid_19_model.utils import RandomStreams
+from mesa.time import RandomActivation
+
+NEVER = RandomStreams.NEVER
+
+class TimingWheel:
+    """
+    Buckets of agents keyed by the step at which their next status
+    transition is due (agent.transition_step). Buckets keep insertion
+    order, so runs are reproducible.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def schedule(self, agent, step):
+        """
+        Schedules the agent's next transition at a step (NEVER for none),
+        replacing any transition scheduled before
+        """
+        self.cancel(agent)
+        if step < NEVER:
+            agent.transition_step = step
+            self.buckets.setdefault(step, {})[agent] = None
+
+    def cancel(self, agent):
+        """
+        Cancels the agent's scheduled transition
+        """
+        step = agent.transition_step
+        bucket = self.buckets.get(step)
+        if bucket is not None:
+            bucket.pop(agent, None)
+            if not bucket:
+                del self.buckets[step]
+        agent.transition_step = NEVER
+
+    def pop(self, step):
+        """
+        Removes and returns the agents whose transition is due at a step
+        (their transition_step is kept until they reschedule)
+        """
+        return list(self.buckets.pop(step, ()))
+
+    def agents(self):
+        """
+        Returns every scheduled agent, bucket by bucket in insertion order
+        """
+        return [agent for bucket in self.buckets.values() for agent in bucket]
+
+class ActiveSetActivation(RandomActivation):
+    """
+    RandomActivation that only steps the active agents: the agents allowed
+    to move and the infected agents. Every other agent's step would do
+    nothing, so the activation order of the active agents is the one
+    RandomActivation would give them.
+
+    Properties:
+        movable: Agents allowed to move (see PersonAgent.allowed_to_move)
+        infected: Infected agents
+        buffer: Activation order of the current step (None between steps)
+        position: Index in buffer of the next agent to step
+
+    Dictionaries with None values are used as insertion-ordered sets, so
+    that runs are reproducible.
+    """
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.movable = {}
+        self.infected = {}
+        self.buffer = None
+        self.position = 0
+
+    def add(self, agent):
+        super().add(agent)
+        if agent.allowed_to_move():
+            self.movable[agent] = None
+        if agent.state == State.INFECTED:
+            self.infected[agent] = None
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.movable.pop(agent, None)
+        self.infected.pop(agent, None)
+
+    def update(self, agent):
+        """
+        Updates the sets after a change of the agent's state. An agent that
+        was skipped in the current step and becomes infected is inserted at
+        a random position of the rest of the step, where RandomActivation
+        would have stepped it.
+        """
+        if agent.state != State.INFECTED:
+            self.infected.pop(agent, None)
+            return
+
+        self.infected[agent] = None
+        if self.buffer is not None and agent not in self.movable:
+            self.buffer.insert(self.model.random.randint(self.position, len(self.buffer)), agent)
+
+    def refresh(self):
+        """
+        Rebuilds the set of agents allowed to move, after a change of the
+        age restriction policy
+        """
+        self.movable = {agent: None for agent in self._agents.values() if agent.allowed_to_move()}
+
+    def activated(self, agent):
+        """
+        Returns whether the agent has been stepped in the current step. A
+        skipped agent lies at a uniformly random position of the activation
+        order, so it counts as stepped with the share of the order done.
+        """
+        steps = self.model.steps
+        if self.buffer is None or agent in self.movable or agent.activated_step == steps:
+            return agent.activated_step == steps
+        return self.model.random.random() * (len(self.buffer) + 1) < self.position
+
+    def active_buffer(self):
+        """
+        Yields the active agents in random order, including the agents
+        inserted while stepping
+        """
+        # Infected agents that may not move are ordered by unique_id, so
+        # that restored checkpoints shuffle the same list
+        immobile = sorted(
+            (agent for agent in self.infected if agent not in self.movable),
+            key = lambda agent: agent.unique_id)
+        self.buffer = buffer = list(self.movable) + immobile
+        self.model.random.shuffle(buffer)
+        self.position = 0
+
+        try:
+            while self.position < len(buffer):
+                agent = buffer[self.position]
+                self.position += 1
+                if agent.unique_id in self._agents:
+                    yield agent
+        finally:
+            self.buffer = None
+
+    def step(self):
+        for agent in self.active_buffer():
+            agent.step()
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,239 @@
+# screening.py
+
+"""
+Scenario screening with the compartmental engine, and its validation
+against the ABM.
+
+screen_scenarios advances every (run, replicate) pair of a sweep as one
+batch of covid_19_model.compartmental.CompartmentalSEIR, so thousands of
+parameter sets take seconds; the promising ones can then be sent to
+covid_19_model.batch. The sweep spec is the one of covid_19_model.batch.
+
+validate_compartmental runs ensembles of the same configuration with an ABM
+engine and with the compartmental engine and compares their curves:
+    rmse, max_difference: between the mean curves of every district and
+        compartment
+    coverage: fraction of the steps at which the compartmental mean lies
+        within the ABM's 5%-95% band
+    peaks: mean heights and median steps of the summary peaks of both
+
+Output directory:
+    runs.json: parameter overrides of every run
+    screening.csv: run, district, means over the replicates of the summary
+        peaks and of the final S, E, I, R counts
+    validation.json: with --validate, the comparison and both ensembles
+        (see covid_19_model.ensemble)
+
+Usage:
+    python -m covid_19_model.screening --sweep sweep.json --replicates 10 --steps 120
+    python -m covid_19_model.screening --validate --replicates 100 --steps 120 --engine vectorized
+"""
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.compartmental import CompartmentalSEIR, run_seir
+from covid_19_model.ensemble import EnsembleStatistics, PEAKS, QUANTILES, run_ensemble
+from covid_19_model.recorder import RECORDED_DISTRICTS, COMPARTMENTS
+from covid_19_model.utils import RandomStreams, parse_json, apply_overrides, expand_sweep
+import numpy as np
+import argparse
+import logging
+import types
+import json
+import csv
+import os
+
+logger = logging.getLogger(__name__)
+
+def scenario_parameters(fixed_params):
+    """
+    Returns a namespace with the fixed parameters and the values that
+    Covid19Model derives from them
+    """
+    params = types.SimpleNamespace(**fixed_params)
+    params.as_infection_probability = Covid19Model.compute_as_infection_probability(
+        params.as_infection_expectation,
+        params.incubation_rate)
+    params.localized_immunity = Covid19Model.compute_localized_immunity(
+        params.district_poverty_score,
+        params.natural_immunity,
+        params.preexisting_conditions,
+        params.exercise)
+    return params
+
+def initial_counts(variable_params):
+    """
+    Returns the (6, 4) initial S, E, I, R counts of the districts
+    """
+    return np.array(
+        [np.array(variable_params[compartment]).sum(axis = 0) for compartment in
+            ("susceptible", "exposed", "infected", "removed")],
+        dtype = np.int64).T
+
+def simulate(variable_params, fixed_params_list, replicates, steps, seed = None, history = False):
+    """
+    Runs replicates of every fixed parameter set as one CompartmentalSEIR
+    batch and returns the results of run_seir, with runs ordered by
+    parameter set then replicate
+    """
+    # The districts are the ones of any model; a model is only built for them
+    grid = Covid19Model(variable_params, fixed_params_list[0], engine = "compartmental", seed = seed).grid
+    scenarios = [scenario_parameters(fixed_params) for fixed_params in fixed_params_list]
+    params = [scenario for scenario in scenarios for _ in range(replicates)]
+    seir = CompartmentalSEIR(initial_counts(variable_params), params, grid, RandomStreams(seed))
+    return run_seir(seir, steps, history)
+
+def screen_scenarios(variable_params, fixed_params, sweep, replicates, steps, seed = None):
+    """
+    Screens every run of a sweep and returns the overrides of the runs and
+    the means over their replicates of:
+        peaks, peak_steps: (runs, 7, 2) summary peaks (see PEAKS)
+        counts: (runs, 7, 4) final S, E, I, R counts
+    """
+    runs = expand_sweep(sweep)
+    result = simulate(
+        variable_params,
+        [apply_overrides(fixed_params, overrides) for overrides in runs],
+        replicates,
+        steps,
+        seed)
+
+    means = {
+        name: result[name].reshape((len(runs), replicates) + result[name].shape[1:]).mean(axis = 1)
+        for name in ("peaks", "peak_steps", "counts")
+    }
+    return runs, means
+
+def write_screening(output, runs, means):
+    """
+    Writes runs.json and screening.csv to an output directory
+    """
+    os.makedirs(output, exist_ok = True)
+    with open(os.path.join(output, "runs.json"), "w") as file:
+        json.dump([dict(overrides, run = run) for run, overrides in enumerate(runs)], file, indent = 2)
+
+    with open(os.path.join(output, "screening.csv"), "w", newline = "") as file:
+        writer = csv.writer(file)
+        writer.writerow([
+            "run", "district",
+            "max_exposed", "max_exposed_step", "max_infected", "max_infected_step",
+            "S", "E", "I", "R"])
+        for run in range(len(runs)):
+            for i, district in enumerate(RECORDED_DISTRICTS):
+                peaks = [
+                    value for peak in range(len(PEAKS))
+                    for value in (means["peaks"][run, i, peak], means["peak_steps"][run, i, peak])]
+                writer.writerow([run, district] + peaks + means["counts"][run, i].tolist())
+
+def compartmental_ensemble(variable_params, fixed_params, replicates, steps, seed = None, quantiles = QUANTILES):
+    """
+    Returns the EnsembleStatistics of replicates of the compartmental engine
+    """
+    result = simulate(variable_params, [fixed_params], replicates, steps, seed, history = True)
+    ensemble = EnsembleStatistics(steps, quantiles)
+    for replicate in range(replicates):
+        ensemble.add_history(result["history"][replicate])
+        ensemble.add_summary({
+            district: {
+                peak: (int(result["peaks"][replicate, i, k]), int(result["peak_steps"][replicate, i, k]))
+                for k, peak in enumerate(PEAKS)
+            }
+            for i, district in enumerate(RECORDED_DISTRICTS)
+        })
+    return ensemble
+
+def compare_ensembles(abm, compartmental, lower = QUANTILES[0], upper = QUANTILES[-1]):
+    """
+    Returns the comparison of the curves and peaks of two EnsembleStatistics
+    (see above)
+    """
+    comparison = {}
+    for district in RECORDED_DISTRICTS:
+        comparison[district] = {}
+        for compartment in COMPARTMENTS:
+            reference = abm.band(district, compartment, lower, upper)
+            mean = compartmental.band(district, compartment, lower, upper)["mean"]
+            difference = mean - reference["mean"]
+            comparison[district][compartment] = {
+                "rmse": float(np.sqrt(np.mean(difference ** 2))),
+                "max_difference": float(np.max(np.abs(difference))),
+                "coverage": float(np.mean((reference["lower"] <= mean) & (mean <= reference["upper"]))),
+            }
+
+        comparison[district]["peaks"] = {
+            peak: {
+                name: {
+                    "mean_height": float(ensemble.peaks.get_mean()[RECORDED_DISTRICTS.index(district), k]),
+                    "median_step": ensemble.peak_time_quantile(district, peak, 0.5),
+                }
+                for name, ensemble in (("abm", abm), ("compartmental", compartmental))
+            }
+            for k, peak in enumerate(PEAKS)
+        }
+    return comparison
+
+def validate_compartmental(
+    variable_params,
+    fixed_params,
+    replicates,
+    steps,
+    engine = "vectorized",
+    seed = None,
+    processes = None,
+):
+    """
+    Runs ensembles of an ABM engine and of the compartmental engine with
+    the same parameters and returns the comparison and both ensembles
+    """
+    abm = run_ensemble(variable_params, fixed_params, replicates, steps, engine, seed, processes)
+    compartmental = compartmental_ensemble(variable_params, fixed_params, replicates, steps, seed)
+    return {
+        "engine": engine,
+        "comparison": compare_ensembles(abm, compartmental),
+        "abm": abm.to_dict(),
+        "compartmental": compartmental.to_dict(),
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Compartmental screening of the COVID-19 model")
+    parser.add_argument("--variable", default = "variable_parameters.json")
+    parser.add_argument("--fixed", default = "fixed_parameters.json")
+    parser.add_argument("--sweep", help = "JSON sweep spec (see covid_19_model.batch); omit for a single run")
+    parser.add_argument("--replicates", type = int, default = 1)
+    parser.add_argument("--steps", type = int, default = 100)
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--output", default = "screening")
+    parser.add_argument("--validate", action = "store_true",
+        help = "compare the ensemble curves with the ABM's instead of screening")
+    parser.add_argument("--engine", choices = [engine for engine in Covid19Model.ENGINES if engine != "compartmental"], default = "vectorized",
+        help = "ABM engine of --validate")
+    parser.add_argument("--workers", type = int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO)
+    variable_params = parse_json(args.variable)
+    fixed_params = parse_json(args.fixed)
+
+    if args.validate:
+        validation = validate_compartmental(
+            variable_params, fixed_params, args.replicates, args.steps, args.engine, args.seed, args.workers)
+        os.makedirs(args.output, exist_ok = True)
+        with open(os.path.join(args.output, "validation.json"), "w") as file:
+            json.dump(validation, file)
+        for compartment in COMPARTMENTS:
+            metrics = validation["comparison"]["total"][compartment]
+            logger.info(
+                "total %s: rmse=%.1f max_difference=%.1f coverage=%.2f",
+                compartment, metrics["rmse"], metrics["max_difference"], metrics["coverage"])
+        return
+
+    runs, means = screen_scenarios(
+        variable_params,
+        fixed_params,
+        parse_json(args.sweep) if args.sweep else {},
+        args.replicates,
+        args.steps,
+        args.seed)
+    write_screening(args.output, runs, means)
+
+if __name__ == "__main__":
+    main()
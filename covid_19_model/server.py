@@ -1,31 +1,58 @@
 # server.py
 
-from mesa_geo.visualization.ModularVisualization import ModularServer
+"""
+Dashboard server of Covid19Model.
+
+make_server builds the visualization and reads the parameter files when it
+is called, not when this module is imported. Start the dashboard with
+`mesa runserver` (see run.py) or `python -m covid_19_model.server`.
+"""
+
 from mesa.visualization.UserParam import UserSettableParameter
-from covid_19_model.visualization import Covid19ModelVisualization
-from covid_19_model.space import QuezonCity
+from covid_19_model.visualization import Covid19ModelVisualization, Covid19ModularServer
 from covid_19_model.model import Covid19Model
+from covid_19_model.jobs import JobManager, job_handlers
+from covid_19_model.cache import ResultCache
 from covid_19_model.utils import parse_json
 
-# Visualization
-model_visualization = Covid19ModelVisualization()
-visualization_elements = model_visualization.get_modules()
-model_name = model_visualization.MODEL_NAME
-model_description = model_visualization.MODEL_DESCRIPTION
-
-# Model inputs
-model_params = {
-    "model_desc": UserSettableParameter('static_text', value = model_description),
-    "variable_params": parse_json("variable_parameters.json"),
-    "fixed_params": parse_json("fixed_parameters.json"),
-}
-
-# Instantiates ModularServer
-server = ModularServer(
-    model_cls = Covid19Model,
-    visualization_elements = visualization_elements,
-    name = model_name,
-    model_params = model_params)
-
-# Sets the server port
-server.port = 8521
\ No newline at end of file
+def make_server(variable = "variable_parameters.json", fixed = "fixed_parameters.json", port = 8521):
+    """
+    Returns the dashboard server (a ModularServer rendering the map per
+    connection) of the given parameter files, serving the simulation job
+    API alongside the dashboard
+    """
+    # Visualization
+    model_visualization = Covid19ModelVisualization()
+    visualization_elements = model_visualization.get_modules()
+    model_name = model_visualization.MODEL_NAME
+    model_description = model_visualization.MODEL_DESCRIPTION
+
+    # Model inputs
+    model_params = {
+        "model_desc": UserSettableParameter('static_text', value = model_description),
+        "variable_params": parse_json(variable),
+        "fixed_params": parse_json(fixed),
+    }
+
+    server = Covid19ModularServer(
+        model_cls = Covid19Model,
+        visualization_elements = visualization_elements,
+        name = model_name,
+        model_params = model_params)
+
+    # Serves the simulation job API alongside the dashboard
+    # (see covid_19_model.jobs); seeded jobs are replayed from the result cache
+    server.add_handlers(r".*", job_handlers(JobManager(
+        model_params["variable_params"],
+        model_params["fixed_params"],
+        result_cache = ResultCache(".cache/results"))))
+
+    # Sets the server port
+    server.port = port
+    return server
+
+def main():
+    make_server().launch()
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,327 @@
 
 from mesa_geo import GeoSpace, GeoAgent, AgentCreator
 from shapely.geometry import Point
-import random
+from shapely.prepared import prep
+from shapely import wkb
+import numpy as np
+import hashlib
+import math
+import json
+import os
+
+try:
+    from shapely import contains_xy
+except ImportError:
+    # Shapely < 2
+    from shapely.vectorized import contains as contains_xy
+
+def triangulate(polygon):
+    """
+    Ear-clipping triangulation of a Polygon or MultiPolygon without holes.
+    Unlike shapely.ops.triangulate (Delaunay), the triangles exactly cover
+    concave polygons. Returns an (n, 3, 2) array of triangle vertices.
+    """
+    polygons = getattr(polygon, "geoms", [polygon])
+    triangles = []
+
+    for part in polygons:
+        if len(part.interiors):
+            raise ValueError("triangulate does not support polygons with holes")
+
+        ring = np.asarray(part.exterior.coords)[:-1]
+        # Drops repeated vertices and orients the ring counter-clockwise
+        ring = ring[np.any(ring != np.roll(ring, 1, axis = 0), axis = 1)]
+        x, y = ring[:, 0], ring[:, 1]
+        if np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y) < 0:
+            ring = ring[::-1]
+
+        triangles.extend(clip_ears(ring))
+
+    return np.array(triangles)
+
+def clip_ears(ring):
+    """
+    Triangulates a counter-clockwise ring of vertices by clipping ears
+    """
+    remaining = list(range(len(ring)))
+    triangles = []
+    i = 0
+    misses = 0
+
+    while len(remaining) > 3:
+        n = len(remaining)
+        a, b, c = ring[remaining[(i - 1) % n]], ring[remaining[i % n]], ring[remaining[(i + 1) % n]]
+        cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+        if cross > 0:
+            # b is an ear if no other vertex lies inside or on triangle abc
+            others = ring[[remaining[k % n] for k in range(i + 2, i + n - 1)]]
+            d1 = (b[0] - a[0]) * (others[:, 1] - a[1]) - (b[1] - a[1]) * (others[:, 0] - a[0])
+            d2 = (c[0] - b[0]) * (others[:, 1] - b[1]) - (c[1] - b[1]) * (others[:, 0] - b[0])
+            d3 = (a[0] - c[0]) * (others[:, 1] - c[1]) - (a[1] - c[1]) * (others[:, 0] - c[0])
+            is_ear = not np.any((d1 >= 0) & (d2 >= 0) & (d3 >= 0))
+        else:
+            is_ear = False
+
+        if is_ear or (misses >= n and cross == 0):
+            # Collinear vertices are dropped without a triangle once no ear is left
+            if is_ear:
+                triangles.append((a, b, c))
+            remaining.pop(i % n)
+            misses = 0
+        else:
+            i += 1
+            misses += 1
+            if misses > 2 * n:
+                raise ValueError("triangulate could not find an ear (self-intersecting polygon?)")
+
+    triangles.append(tuple(ring[remaining]))
+    return triangles
+
+class TriangleSampler:
+    """
+    Uniform sampler of points inside a polygon: picks a triangle of its
+    triangulation with probability proportional to its area, then a uniform
+    point inside that triangle. No rejection loop is needed.
+    """
+
+    def __init__(self, polygon, triangles = None):
+        """
+        triangles: Triangulation of the polygon (see triangulate), if
+        already computed
+        """
+        self.triangles = triangulate(polygon) if triangles is None else triangles
+        a, b, c = self.triangles[:, 0], self.triangles[:, 1], self.triangles[:, 2]
+        areas = np.abs(
+            (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1])
+            - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])) / 2
+        self.cumulative_area = np.cumsum(areas)
+
+    def sample(self, n, rng):
+        """
+        Returns n uniform points (xs, ys) drawn with a numpy Generator
+        """
+        total = self.cumulative_area[-1]
+        chosen = np.searchsorted(self.cumulative_area, rng.uniform(0, total, n), side = "right")
+        chosen = np.minimum(chosen, len(self.triangles) - 1)
+        return self.points(chosen, rng.random(n), rng.random(n))
+
+    def sample_one(self, rand):
+        """
+        Returns one uniform point (x, y) drawn with a random.Random-like source
+        """
+        u = rand.uniform(0, self.cumulative_area[-1])
+        chosen = min(int(np.searchsorted(self.cumulative_area, u, side = "right")), len(self.triangles) - 1)
+        xs, ys = self.points(np.array([chosen]), np.array([rand.random()]), np.array([rand.random()]))
+        return (float(xs[0]), float(ys[0]))
+
+    def points(self, chosen, r1, r2):
+        """
+        Maps pairs of uniform numbers to points of the chosen triangles
+        """
+        # Folds the unit square onto the unit triangle
+        folded = r1 + r2 > 1
+        r1 = np.where(folded, 1 - r1, r1)
+        r2 = np.where(folded, 1 - r2, r2)
+
+        a = self.triangles[chosen, 0]
+        b = self.triangles[chosen, 1]
+        c = self.triangles[chosen, 2]
+        xs = a[:, 0] + r1 * (b[:, 0] - a[:, 0]) + r2 * (c[:, 0] - a[:, 0])
+        ys = a[:, 1] + r1 * (b[:, 1] - a[:, 1]) + r2 * (c[:, 1] - a[:, 1])
+        return xs, ys
+
+class DistrictIndex:
+    """
+    Lookup of the district containing points.
+
+    The districts' bounding box is cut into square cells of cell_size. A
+    cell that lies inside a single district or outside the city answers
+    every lookup of its points; only the points of the cells crossed by a
+    district border are tested against the polygons. A cell is a border
+    cell if a point sampled along a border, at most half a cell from the
+    next one, lies in it or in one of its 8 neighbors, so that no border
+    crosses the other cells.
+
+    Properties:
+        shapes: District polygons, in the order of QuezonCity.DISTRICTS
+        cells: (width, height) district index of every cell, OUTSIDE or
+            BORDER
+        rows: cells as nested lists, for scalar lookups (see locate_one)
+        x0, y0: Origin of the cells
+    """
+
+    OUTSIDE = -1
+    BORDER = -2
+
+    def __init__(self, shapes, cell_size = 50, cells = None):
+        """
+        cells: Labels of the cells, if already computed for these shapes
+        and cell_size
+        """
+        self.shapes = shapes
+        self.prepared = [prep(shape) for shape in shapes]
+        self.cell_size = cell_size
+
+        bounds = np.array([shape.bounds for shape in shapes])
+        self.x0 = bounds[:, 0].min() - cell_size
+        self.y0 = bounds[:, 1].min() - cell_size
+        self.width = int(np.ceil((bounds[:, 2].max() - self.x0) / cell_size)) + 2
+        self.height = int(np.ceil((bounds[:, 3].max() - self.y0) / cell_size)) + 2
+        self.cells = cells if cells is not None else self.label_cells()
+        self.rows = self.cells.tolist()
+
+    def label_cells(self):
+        """
+        Returns the labels of the cells
+        """
+        cell_size = self.cell_size
+
+        # Labels the cells by their centers
+        cx, cy = np.meshgrid(np.arange(self.width), np.arange(self.height), indexing = "ij")
+        cells = self.test(self.x0 + (cx.ravel() + 0.5) * cell_size, self.y0 + (cy.ravel() + 0.5) * cell_size)
+        cells = cells.reshape(self.width, self.height)
+
+        # Marks the cells around the border samples
+        for x, y in self.border_samples(cell_size / 2):
+            bx, by = self.cell(x, y)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    cells[bx + dx, by + dy] = self.BORDER
+        return cells
+
+    def border_samples(self, spacing):
+        """
+        Yields arrays (xs, ys) of points along every ring of the districts,
+        at most spacing apart
+        """
+        for shape in self.shapes:
+            for polygon in getattr(shape, "geoms", [shape]):
+                for ring in [polygon.exterior] + list(polygon.interiors):
+                    coords = np.asarray(ring.coords)
+                    start, end = coords[:-1], coords[1:]
+                    n = np.maximum(np.ceil(np.hypot(*(end - start).T) / spacing).astype(np.int64), 1)
+                    segment = np.repeat(np.arange(len(n)), n)
+                    t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(n, n)
+                    points = start[segment] + t[:, None] * (end - start)[segment]
+                    yield points[:, 0], points[:, 1]
+
+    def cell(self, x, y):
+        return (
+            np.floor((x - self.x0) / self.cell_size).astype(np.int64),
+            np.floor((y - self.y0) / self.cell_size).astype(np.int64))
+
+    def test(self, x, y):
+        """
+        Returns the district index of each point (OUTSIDE if none) from the
+        polygons
+        """
+        district = np.full(len(x), self.OUTSIDE, dtype = np.int8)
+        for i, shape in enumerate(self.shapes):
+            unknown = np.flatnonzero(district == self.OUTSIDE)
+            district[unknown[contains_xy(shape, x[unknown], y[unknown])]] = i
+        return district
+
+    def locate(self, x, y):
+        """
+        Returns the district index of each point (OUTSIDE if none)
+        """
+        x = np.asarray(x, dtype = float)
+        y = np.asarray(y, dtype = float)
+        cx, cy = self.cell(x, y)
+        within = (cx >= 0) & (cx < self.width) & (cy >= 0) & (cy < self.height)
+        district = np.full(len(x), self.OUTSIDE, dtype = np.int8)
+        district[within] = self.cells[cx[within], cy[within]]
+
+        border = np.flatnonzero(district == self.BORDER)
+        if len(border):
+            district[border] = self.test(x[border], y[border])
+        return district
+
+    def locate_one(self, x, y):
+        """
+        Returns the district index of a point (OUTSIDE if none), without
+        NumPy overhead
+        """
+        cx = math.floor((x - self.x0) / self.cell_size)
+        cy = math.floor((y - self.y0) / self.cell_size)
+        if not (0 <= cx < self.width and 0 <= cy < self.height):
+            return self.OUTSIDE
+
+        district = self.rows[cx][cy]
+        if district != self.BORDER:
+            return district
+
+        point = Point(x, y)
+        for i, prepared in enumerate(self.prepared):
+            if prepared.contains(point):
+                return i
+        return self.OUTSIDE
+
+# Version of the district geometry file format (see write_district_geometry)
+GEOMETRY_VERSION = 1
+
+def write_district_geometry(filename, source, geometry):
+    """
+    Writes district geometry to an .npz file, tagged with the hash of the
+    source it was derived from:
+        districts: (unique_id, attributes, shape) of every district, the
+            shapes as projected WKB
+        triangles: Triangulation of every district (see triangulate)
+        cell_size, cells: Labels of the cells of a DistrictIndex
+    The file is written aside and renamed into place, so that concurrent
+    processes never read a partial file.
+    """
+    districts = geometry["districts"]
+    blobs = [wkb.dumps(shape) for _, _, shape in districts]
+    temporary = "%s.tmp.%d" % (filename, os.getpid())
+    with open(temporary, "wb") as file:
+        np.savez(
+            file,
+            version = GEOMETRY_VERSION,
+            source = source,
+            unique_id = [unique_id for unique_id, _, _ in districts],
+            attributes = json.dumps([attributes for _, attributes, _ in districts]),
+            wkb = np.frombuffer(b"".join(blobs), dtype = np.uint8),
+            wkb_offsets = np.cumsum([0] + [len(blob) for blob in blobs]),
+            triangles = np.concatenate(geometry["triangles"]),
+            triangle_offsets = np.cumsum([0] + [len(triangles) for triangles in geometry["triangles"]]),
+            cell_size = geometry["cell_size"],
+            cells = geometry["cells"])
+    os.replace(temporary, filename)
+
+def read_district_geometry(filename, source):
+    """
+    Returns the district geometry of a file written by
+    write_district_geometry, or None if it is missing or was not written
+    from this source by this version
+    """
+    try:
+        data = np.load(filename, allow_pickle = False)
+    except (OSError, ValueError):
+        return None
+
+    with data:
+        if int(data["version"]) != GEOMETRY_VERSION or str(data["source"]) != source:
+            return None
+
+        blob = data["wkb"].tobytes()
+        offsets = data["wkb_offsets"]
+        attributes = json.loads(str(data["attributes"]))
+        triangles = data["triangles"]
+        triangle_offsets = data["triangle_offsets"]
+        return {
+            "districts": [
+                (str(unique_id), attributes[i], wkb.loads(blob[offsets[i]:offsets[i + 1]]))
+                for i, unique_id in enumerate(data["unique_id"])
+            ],
+            "triangles": [
+                triangles[triangle_offsets[i]:triangle_offsets[i + 1]]
+                for i in range(len(triangle_offsets) - 1)
+            ],
+            "cell_size": float(data["cell_size"]),
+            "cells": data["cells"],
+        }
 
 class DistrictAgent(GeoAgent):
     """District GeoAgent"""
@@ -14,28 +334,51 @@ class DistrictAgent(GeoAgent):
         return "District " + str(self.unique_id)
 
 class QuezonCity(GeoSpace):
-    """Quezon City GeoSpace"""
+    """
+    Quezon City GeoSpace
+
+    Polygon agents (the districts) are kept in mesa_geo's R-tree. Point
+    agents (the persons) are kept in a uniform-grid spatial hash whose cells
+    are agent_exposure_distance wide (insertion-ordered, so that neighbor
+    queries are reproducible), so that neighbor queries only look at
+    the 3x3 cells around the agent and a moving agent only updates its own
+    bucket instead of the whole R-tree being rebuilt every step.
+    """
 
     MAP_COORDS = [14.676208, 121.043861] # Quezon City
     quezon_city_districts_geojson = "covid_19_model/res/quezon_city_districts.geojson"
     quezon_city_geojson = "covid_19_model/res/quezon_city.geojson"
+    quezon_city_districts_geometry = "covid_19_model/res/quezon_city_districts.npz"
+    DISTRICTS = ["district" + str(i + 1) for i in range(6)]
+
+    # Policies at the city boundary of moving agents (see confine)
+    BOUNDARIES = ("none", "clamp", "reflect")
+
+    # (unique_id, attributes, shape) of the districts, shared by every
+    # model of the process (see district_geometry)
+    geometry = None
+
+    # TriangleSamplers and DistrictIndex of the districts, shared by every
+    # model of the process (see district_geometry)
+    samplers = {}
+    district_index = None
 
     def __init__(self, model):
         super().__init__()
         self.model = model
+        self.cell_size = model.agent_exposure_distance
+        self.buckets = {}
         self.districts = self.instantiate_district_agents()
 
     def instantiate_district_agents(self):
         """Instantiates DistrictAgents"""
-        # Instantiates an agent creator for DistrictAgent
-        agent_creator = AgentCreator(
-            DistrictAgent,
-            {"model": self.model})
-
         # Instantiates DistrictAgents for the 6 districts
-        district_agents = agent_creator.from_file(
-            self.quezon_city_districts_geojson,
-            unique_id = "DISTRICT")
+        district_agents = []
+        for unique_id, attributes, shape in self.district_geometry():
+            agent = DistrictAgent(unique_id, self.model, shape)
+            for name, value in attributes.items():
+                setattr(agent, name, value)
+            district_agents.append(agent)
 
         # Adds DistrictAgents to grid
         self.add_agents(district_agents)
@@ -43,35 +386,247 @@ class QuezonCity(GeoSpace):
         # Formats output as a dictionary
         return dict([("district" + str(i+1), district_agents[i]) for i in range(6)])
 
+    def district_geometry(self):
+        """
+        Returns the (unique_id, attributes, shape) districts, loaded once
+        per process from quezon_city_districts_geometry along with their
+        TriangleSamplers and DistrictIndex. The GeoJSON is only parsed and
+        reprojected by mesa_geo, and the districts triangulated and
+        indexed, when that file is missing or stale; the file is then
+        rebuilt if writable.
+        """
+        if QuezonCity.geometry is None:
+            with open(self.quezon_city_districts_geojson, "rb") as file:
+                source = hashlib.sha256(file.read()).hexdigest()
+            geometry = read_district_geometry(self.quezon_city_districts_geometry, source)
+
+            if geometry is None:
+                geometry = self.build_district_geometry()
+                try:
+                    write_district_geometry(self.quezon_city_districts_geometry, source, geometry)
+                except OSError:
+                    pass
+
+            shapes = [shape for _, _, shape in geometry["districts"]]
+            QuezonCity.samplers = {
+                district: TriangleSampler(shape, triangles)
+                for district, shape, triangles in zip(self.DISTRICTS, shapes, geometry["triangles"])
+            }
+            QuezonCity.district_index = DistrictIndex(shapes, geometry["cell_size"], geometry["cells"])
+            QuezonCity.geometry = geometry["districts"]
+        return QuezonCity.geometry
+
+    def build_district_geometry(self):
+        """
+        Parses the districts from the GeoJSON with mesa_geo and derives
+        their triangulations and index (see write_district_geometry)
+        """
+        agent_creator = AgentCreator(DistrictAgent, {"model": self.model})
+        districts = []
+        for agent in agent_creator.from_file(self.quezon_city_districts_geojson, unique_id = "DISTRICT"):
+            # The GeoJSON properties set by AgentCreator
+            own = vars(DistrictAgent(agent.unique_id, self.model, agent.shape))
+            attributes = {name: value for name, value in vars(agent).items() if name not in own}
+            districts.append((agent.unique_id, attributes, agent.shape))
+
+        shapes = [shape for _, _, shape in districts]
+        index = DistrictIndex(shapes)
+        return {
+            "districts": districts,
+            "triangles": [triangulate(shape) for shape in shapes],
+            "cell_size": index.cell_size,
+            "cells": index.cells,
+        }
+
+    def sampler(self, district):
+        """
+        Returns the TriangleSampler of a district (see district_geometry)
+        """
+        return self.samplers[district]
+
+    def index(self):
+        """
+        Returns the DistrictIndex of the districts (see district_geometry)
+        """
+        return self.district_index
+
     def random_position(self, district):
         """
-        Picks a random position inside the bounds of a given district.
+        Picks a uniformly random position inside a given district
+        (area-weighted sampling of the district's triangulation).
+        """
+        return self.sampler(district).sample_one(self.model.random)
 
-        OPTIONAL: Refactor this code to implement an algorithm that has a
-        better randomization strategy. (See: triangularization of polygons)
+    def random_positions(self, district, n, rng):
         """
-        polygon = self.districts[district].shape
-        x_min, y_min, x_max, y_max = polygon.bounds
+        Picks n uniformly random positions inside a given district with a
+        numpy Generator. Returns two arrays (xs, ys).
+        """
+        return self.sampler(district).sample(n, rng)
 
-        random_pos = ()
-        flag = True
-        while flag:
-            # Picks a random point baed on polygon bounds
-            random_pos = (random.uniform(x_min, x_max), random.uniform(y_min, y_max))
+    def add_agents(self, agents):
+        """
+        Adds an agent or a list of agents. Point agents go to the spatial
+        hash and every other agent goes to the R-tree.
+        """
+        if not isinstance(agents, list):
+            agents = [agents]
+
+        others = []
+        for agent in agents:
+            if isinstance(agent.shape, Point):
+                self.buckets.setdefault(self.cell(agent.shape), {})[agent] = None
+            else:
+                others.append(agent)
 
-            # Checks if random point is inside the polygon
-            if polygon.contains(Point(random_pos[0], random_pos[1])):
-                flag = False
+        if others:
+            super().add_agents(others)
 
-        return random_pos
+    def remove_agent(self, agent):
+        """
+        Removes an agent from the space
+        """
+        if isinstance(agent.shape, Point):
+            cell = self.cell(agent.shape)
+            bucket = self.buckets[cell]
+            del bucket[agent]
+            if not bucket:
+                del self.buckets[cell]
+        else:
+            super().remove_agent(agent)
+
+    def move_agent(self, agent, shape):
+        """
+        Moves a point agent to a new shape, updating its bucket only if it
+        changed cells
+        """
+        old_cell = self.cell(agent.shape)
+        new_cell = self.cell(shape)
+        agent.shape = shape
+
+        if old_cell != new_cell:
+            bucket = self.buckets[old_cell]
+            del bucket[agent]
+            if not bucket:
+                del self.buckets[old_cell]
+            self.buckets.setdefault(new_cell, {})[agent] = None
+
+    def cell(self, point):
+        """
+        Returns the spatial hash cell of a point
+        """
+        return (math.floor(point.x / self.cell_size), math.floor(point.y / self.cell_size))
+
+    def get_neighbors_within_distance(self, agent, distance, center = False, relation = "intersects"):
+        """
+        Yields the point agents within distance of agent (excluding itself).
+
+        Only the cells within distance of the agent's cell are examined, i.e.
+        the 3x3 surrounding cells when distance <= cell_size. Polygon agents
+        (the districts) are never returned.
+        """
+        x, y = agent.shape.x, agent.shape.y
+        cx, cy = self.cell(agent.shape)
+        reach = max(1, math.ceil(distance / self.cell_size))
+        squared_distance = distance * distance
+
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for other in self.buckets.get((i, j), ()):
+                    dx = other.shape.x - x
+                    dy = other.shape.y - y
+                    if other is not agent and dx * dx + dy * dy <= squared_distance:
+                        yield other
+
+    def count_candidates(self, agent, distance, state):
+        """
+        Returns the number of point agents in a state in the cells examined
+        by a neighbor query of agent
+        """
+        cx, cy = self.cell(agent.shape)
+        reach = max(1, math.ceil(distance / self.cell_size))
+        return sum(
+            other.state == state
+            for i in range(cx - reach, cx + reach + 1)
+            for j in range(cy - reach, cy + reach + 1)
+            for other in self.buckets.get((i, j), ()))
+
+    def reindex(self):
+        """
+        Rebuilds the spatial hash, e.g. after agent_exposure_distance changed
+        """
+        agents = [agent for bucket in self.buckets.values() for agent in bucket]
+        self.cell_size = self.model.agent_exposure_distance
+        self.buckets = {}
+        self.add_agents(agents)
+
+    @property
+    def agents(self):
+        return super().agents + [agent for bucket in self.buckets.values() for agent in bucket]
 
     def get_district(self, point, current_district):
-        output = current_district
+        """
+        Returns the district containing a point, or current_district if the
+        point lies outside the city
+        """
+        district = self.index().locate_one(point.x, point.y)
+        return self.DISTRICTS[district] if district >= 0 else current_district
+
+    def locate(self, xs, ys):
+        """
+        Returns the indices (in DISTRICTS) of the districts containing
+        points, -1 for the points outside the city
+        """
+        return self.index().locate(xs, ys)
+
+    def confine(self, x0, y0, x, y, boundary, locate = False):
+        """
+        Applies a city boundary policy (see BOUNDARIES) to moves from
+        (x0, y0) to (x, y) and returns the arrays of the destinations:
+        "none" lets agents leave the city, "clamp" keeps the agents whose
+        move would leave it at their origin, and "reflect" moves them by
+        the opposite displacement instead, or keeps them at their origin if
+        that also leaves the city.
+
+        Also returns the district indices of the destinations found on the
+        way (-1 outside the city and for the agents kept at their origin),
+        or None when the policy needed no lookup and locate is False
+        """
+        if boundary == "none":
+            return x, y, self.locate(x, y) if locate else None
+
+        x, y = x.copy(), y.copy()
+        district = self.locate(x, y)
+        leaving = np.flatnonzero(district < 0)
+        if boundary == "reflect" and len(leaving):
+            reflected_x = 2 * x0[leaving] - x[leaving]
+            reflected_y = 2 * y0[leaving] - y[leaving]
+            reflected = self.locate(reflected_x, reflected_y)
+            inside = reflected >= 0
+            x[leaving[inside]] = reflected_x[inside]
+            y[leaving[inside]] = reflected_y[inside]
+            district[leaving[inside]] = reflected[inside]
+            leaving = leaving[~inside]
 
-        for i in range(6):
-            district = self.districts["district" + str(i + 1)]
-            if district.shape.contains(point):
-                output = "district" + district.unique_id
-                break
+        x[leaving] = x0[leaving]
+        y[leaving] = y0[leaving]
+        return x, y, district
+
+    def confine_one(self, x0, y0, x, y, boundary, locate = False):
+        """
+        Applies a city boundary policy to a single move (see confine) and
+        returns its destination and district index (-1 outside the city or
+        at the origin, None if not looked up)
+        """
+        if boundary == "none" and not locate:
+            return x, y, None
 
-        return output
\ No newline at end of file
+        index = self.index()
+        district = index.locate_one(x, y)
+        if boundary == "none" or district >= 0:
+            return x, y, district
+        if boundary == "reflect":
+            district = index.locate_one(2 * x0 - x, 2 * y0 - y)
+            if district >= 0:
+                return 2 * x0 - x, 2 * y0 - y, district
+        return x0, y0, index.OUTSIDE
@@ -1,12 +1,143 @@
-import random
+import numpy as np
+import itertools
+import math
+import copy
 import json
 
-def coin_toss(ptrue):
+def susceptibility(
+    localized_immunity,
+    wearing_mask,
+    wearing_mask_protection,
+    physical_distancing,
+    physical_distancing_protection,
+):
     """
-    Generates a pseudo-random choice
+    Probability that a contact with transmission rate 1 exposes a person:
+    low immunity, and not protected by a mask nor by physical distancing
+    (independent events). Takes scalars or NumPy arrays.
     """
-    if ptrue == 0: return False
-    return random.uniform(0.0, 1.0) <= ptrue
+    return (
+        (1 - localized_immunity)
+        * (1 - wearing_mask * wearing_mask_protection)
+        * (1 - physical_distancing * physical_distancing_protection))
+
+class RandomStreams:
+    """
+    Seeded numpy random number generators owned by a model.
+
+    Each phase of the model draws from its own independent stream, spawned
+    from a single SeedSequence, so runs are reproducible from one seed and
+    the number of draws of one phase does not shift the others. Models do
+    not share any global generator, so they can run side by side in threads.
+
+    Batched draws (bernoulli) take one numpy call for a whole phase. Scalar
+    draws (uniform, coin_toss) used by per-agent code are served from blocks
+    of BLOCK_SIZE numbers drawn in one call.
+    """
+
+    PHASES = ("population", "status", "interact", "move")
+    BLOCK_SIZE = 4096
+
+    # Waiting time of an event that never happens
+    NEVER = 2 ** 62
+
+    def __init__(self, seed = None):
+        """
+        seed: int, None (fresh entropy) or numpy.random.SeedSequence
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+
+        self.seed_sequence = seed
+        children = seed.spawn(len(self.PHASES))
+        self.generators = dict(zip(self.PHASES, [np.random.default_rng(child) for child in children]))
+        self.blocks = {phase: [] for phase in self.PHASES}
+        self.positions = {phase: 0 for phase in self.PHASES}
+
+    def __getitem__(self, phase):
+        return self.generators[phase]
+
+    def spawn(self, n):
+        """
+        Returns n independent RandomStreams, e.g. one per replicate
+        """
+        return [RandomStreams(child) for child in self.seed_sequence.spawn(n)]
+
+    def get_state(self):
+        """
+        Returns the state of every stream as a JSON-serializable dictionary
+        """
+        return {
+            "entropy": self.seed_sequence.entropy,
+            "spawn_key": list(self.seed_sequence.spawn_key),
+            "n_children_spawned": self.seed_sequence.n_children_spawned,
+            "generators": {phase: generator.bit_generator.state for phase, generator in self.generators.items()},
+            "blocks": self.blocks,
+            "positions": self.positions,
+        }
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state
+        """
+        self.seed_sequence = np.random.SeedSequence(
+            state["entropy"],
+            spawn_key = state["spawn_key"],
+            n_children_spawned = state["n_children_spawned"])
+        for phase, generator_state in state["generators"].items():
+            self.generators[phase].bit_generator.state = generator_state
+        self.blocks = {phase: list(block) for phase, block in state["blocks"].items()}
+        self.positions = dict(state["positions"])
+
+    def bernoulli(self, phase, ptrue):
+        """
+        Returns a boolean array of independent draws, True with probability
+        ptrue (an array, one probability per draw)
+        """
+        ptrue = np.asarray(ptrue)
+        return self.generators[phase].random(ptrue.shape) < ptrue
+
+    def uniform(self, phase):
+        """
+        Returns a single uniform number in [0, 1)
+        """
+        position = self.positions[phase]
+        block = self.blocks[phase]
+        if position == len(block):
+            block = self.blocks[phase] = self.generators[phase].random(self.BLOCK_SIZE).tolist()
+            position = 0
+        self.positions[phase] = position + 1
+        return block[position]
+
+    def coin_toss(self, phase, ptrue):
+        """
+        Generates a pseudo-random choice, True with probability ptrue
+        """
+        if ptrue == 0: return False
+        return self.uniform(phase) < ptrue
+
+    def waiting_time(self, phase, ptrue):
+        """
+        Returns the number of independent trials of probability ptrue up to
+        and including the first success (geometric distribution), or NEVER
+        """
+        if ptrue <= 0: return self.NEVER
+        if ptrue >= 1: return 1
+        # log1p keeps tiny probabilities away from log(1) == 0, as waiting_times
+        trials = 1 + math.log1p(-self.uniform(phase)) / math.log1p(-ptrue)
+        return self.NEVER if trials >= self.NEVER else int(trials)
+
+    def waiting_times(self, phase, ptrue):
+        """
+        Returns an int64 array of independent geometric waiting times (see
+        waiting_time), one per probability of the ptrue array
+        """
+        ptrue = np.asarray(ptrue, dtype = float)
+        uniform = self.generators[phase].random(ptrue.shape)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            trials = 1 + np.floor(np.log1p(-uniform) / np.log1p(-np.minimum(ptrue, 1)))
+        trials = np.where(ptrue >= 1, 1, np.where(ptrue <= 0, self.NEVER, trials))
+        return np.minimum(trials, self.NEVER).astype(np.int64)
 
 def parse_json(filename):
     content = None
@@ -23,4 +154,44 @@ def parse_json(filename):
     #     for entry in entries:
     #         for i, data in enumerate(virus_host_parameters[entry]):
     #             district = "district" + str(i+1)
-    #             virus_host_parameters_temp[entry][district] = data
\ No newline at end of file
+    #             virus_host_parameters_temp[entry][district] = data
+
+def sweep_values(spec):
+    """
+    Returns the list of values of a sweep entry
+    """
+    if isinstance(spec, dict):
+        return np.linspace(spec["start"], spec["stop"], spec["num"]).tolist()
+    if isinstance(spec, list):
+        return spec
+    return [spec]
+
+def expand_sweep(sweep):
+    """
+    Returns the cartesian product of a sweep spec as a list of overrides
+    """
+    keys = sorted(sweep)
+    values = [sweep_values(sweep[key]) for key in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def apply_overrides(fixed_params, overrides):
+    """
+    Returns a copy of fixed_params with the overrides of a run applied
+    ("key.districtN" sets one district of a per-district parameter, a
+    plain key all of them)
+    """
+    params = copy.deepcopy(fixed_params)
+
+    for key, value in overrides.items():
+        name, _, district = key.partition(".")
+        if name not in params:
+            raise KeyError("Unknown parameter: %s" % name)
+
+        if district:
+            params[name][district] = value
+        elif isinstance(params[name], dict):
+            params[name] = {d: value for d in params[name]}
+        else:
+            params[name] = value
+
+    return params
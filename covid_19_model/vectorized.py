@@ -0,0 +1,404 @@
+# vectorized.py
+
+"""
+Struct-of-arrays engine of Covid19Model.
+
+The PersonAgent population is held in NumPy arrays and each phase of
+PersonAgent.step (status, interact and move) is applied to every agent in a
+single batched operation. Select it with Covid19Model(..., engine = "vectorized").
+
+Differences with the object engine:
+    - Phases are synchronous: every agent updates its status, then every
+      infected agent interacts, then every agent moves. The object engine
+      interleaves the three phases agent by agent in random activation order.
+    - The k contacts of a susceptible agent are resolved with one draw
+      against 1 - prod(1 - p_c), which has the same distribution as the k
+      sequential coin tosses of PersonAgent.interact.
+    - Removed agents stay in the arrays with state R instead of being
+      deleted from the space and scheduler.
+
+As in the object engine, the step of an agent's next E -> I or I -> R
+transition is drawn once, when it enters E or I, and the status phase only
+applies the transitions that are due. The due steps are a per-agent array
+rather than a TimingWheel, since keep and extend reorder the agents.
+"""
+
+from covid_19_model.enum.state import StateCode
+from covid_19_model.space import QuezonCity
+from covid_19_model.utils import RandomStreams, susceptibility
+import numpy as np
+
+SUSCEPTIBLE = StateCode.SUSCEPTIBLE
+EXPOSED = StateCode.EXPOSED
+INFECTED = StateCode.INFECTED
+REMOVED = StateCode.REMOVED
+
+NEVER = RandomStreams.NEVER
+
+def district_array(params):
+    """
+    Converts a {"district1": ..., "district6": ...} dictionary to an array
+    """
+    return np.array([params[district] for district in QuezonCity.DISTRICTS], dtype = float)
+
+class VectorizedPopulation:
+    """
+    VectorizedPopulation holds every person of the model as parallel arrays.
+
+    Properties:
+        model: Model which the population belongs to
+        x, y: Agents' projected coordinates
+        district: Agents' district index (0 = district1, ..., 5 = district6)
+        state: Agents' state codes (see StateCode)
+        age: Agents' ages
+        wearing_mask, physical_distancing, mobile_worker: Agents' behavior flags
+        days_incubating, days_infected: Number of steps spent as E and as I
+        susceptibility: Probability that a contact with transmission rate 1
+            exposes the agent (see covid_19_model.utils.susceptibility)
+        transition_step: Step at which the agent's next status transition
+            is due (NEVER if none)
+        interacting, candidates_examined, contacts, moved: Counters of the
+            last step (infected agents, candidate pairs examined, infected-
+            susceptible pairs within agent_exposure_distance, moved agents)
+    """
+
+    # Upper bound of (infected, susceptible) candidate pairs held in memory
+    MAX_PAIRS = 2 ** 22
+
+    # Per-agent arrays
+    ARRAYS = (
+        "x", "y", "district", "state", "age",
+        "wearing_mask", "physical_distancing", "mobile_worker",
+        "days_incubating", "days_infected", "susceptibility", "transition_step",
+    )
+
+    # Phases of a step, in order
+    PHASES = ("status", "interact", "move")
+
+    def __init__(self, model, population):
+        """
+        Initializes the population from synthesized columns
+        (see covid_19_model.population)
+        """
+        self.model = model
+        self.x = population["x"].astype(np.float64)
+        self.y = population["y"].astype(np.float64)
+        self.district = population["district"].astype(np.int8)
+        self.state = population["state"].astype(np.int8)
+        self.age = population["age"].astype(np.int8)
+        self.wearing_mask = population["wearing_mask"].astype(bool)
+        self.physical_distancing = population["physical_distancing"].astype(bool)
+        self.mobile_worker = population["mobile_worker"].astype(bool)
+        self.days_incubating = np.zeros(len(self.x), dtype = np.int32)
+        self.days_infected = np.zeros(len(self.x), dtype = np.int32)
+        if "days_incubating" in population:
+            self.days_incubating[:] = population["days_incubating"]
+            self.days_infected[:] = population["days_infected"]
+        self.transition_step = np.full(len(self.x), NEVER, dtype = np.int64)
+        if "transition_step" in population:
+            self.transition_step[:] = population["transition_step"]
+        self.interacting = self.candidates_examined = self.contacts = self.moved = 0
+
+        self.update_parameters(reschedule = "transition_step" not in population)
+
+    def __len__(self):
+        return len(self.state)
+
+    def update_parameters(self, reschedule = True):
+        """
+        Reads the per-district parameters of the model into arrays and
+        redraws the pending status transitions from the next step on.
+        Call again after changing any of them on the model.
+        """
+        model = self.model
+        self.transmission_rate = np.minimum(district_array(model.transmission_rate), 1.0)
+        self.as_infection_probability = district_array(model.as_infection_probability)
+        self.removal_rate = district_array(model.removal_rate)
+        self.localized_immunity = district_array(model.localized_immunity)
+        self.susceptibility = self.compute_susceptibility(
+            self.district, self.wearing_mask, self.physical_distancing)
+        if reschedule:
+            self.redraw_transitions()
+
+    def redraw_transitions(self):
+        """
+        Redraws the pending status transitions from the next step on
+        """
+        self.schedule_status(
+            np.flatnonzero((self.state == EXPOSED) | (self.state == INFECTED)),
+            self.model.steps + 1)
+
+    def schedule_status(self, indices, first_step):
+        """
+        Draws the step of the next status transition of the given exposed
+        or infected agents: the first success of one coin toss per step,
+        from first_step on (see PersonAgent.schedule_status)
+        """
+        district = self.district[indices]
+        ptrue = np.where(
+            self.state[indices] == EXPOSED,
+            self.as_infection_probability[district],
+            self.removal_rate[district])
+        waiting_times = self.model.streams.waiting_times("status", ptrue)
+        self.transition_step[indices] = np.minimum(first_step - 1 + waiting_times, NEVER)
+
+    def step(self):
+        """
+        Advances the population by a step
+        """
+        for phase in self.PHASES:
+            getattr(self, phase)()
+
+    def keep(self, mask):
+        """
+        Keeps only the agents selected by a boolean mask
+        """
+        for name in self.ARRAYS:
+            setattr(self, name, getattr(self, name)[mask])
+
+    def extend(self, columns):
+        """
+        Appends agents given as a dictionary of ARRAYS columns
+        """
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, columns[name].astype(array.dtype)]))
+
+    def status(self):
+        """
+        E -> I and I -> R transitions of every agent
+        """
+        exposed = np.flatnonzero(self.state == EXPOSED)
+        infected = np.flatnonzero(self.state == INFECTED)
+        self.days_incubating[exposed] += 1
+        self.days_infected[infected] += 1
+
+        steps = self.model.steps
+        onset = exposed[self.transition_step[exposed] <= steps]
+        removal = infected[self.transition_step[infected] <= steps]
+
+        # Removals are applied first so that the max_infected peak is not
+        # inflated by agents that the object engine would remove in between
+        self.transition(removal, INFECTED, REMOVED)
+        self.transition_step[removal] = NEVER
+        self.transition(onset, EXPOSED, INFECTED, "max_infected")
+        self.schedule_status(onset, steps + 1)
+
+    def interact(self):
+        """
+        Susceptible agents near infected agents become exposed
+        """
+        infected = np.flatnonzero(self.state == INFECTED)
+        susceptible = np.flatnonzero(self.state == SUSCEPTIBLE)
+        self.interacting = len(infected)
+        self.candidates_examined = self.contacts = 0
+        if len(infected) == 0 or len(susceptible) == 0:
+            return
+
+        log_escape = self.contact_log_escape(infected, susceptible)
+        contacted = np.flatnonzero(log_escape < 0)
+        infection_probability = -np.expm1(log_escape[contacted])
+        exposed = contacted[self.model.streams.bernoulli("interact", infection_probability)]
+
+        self.transition(susceptible[exposed], SUSCEPTIBLE, EXPOSED, "max_exposed")
+        self.schedule_status(susceptible[exposed], self.model.steps + 1)
+
+    def move(self):
+        """
+        Agents allowed to go outside move to a random nearby position
+        """
+        self.settle(*self.displace())
+
+    def displace(self):
+        """
+        Moves the agents allowed to go outside, within the city boundary
+        policy of the model, and returns their indices and the districts
+        of their destinations (see QuezonCity.confine; None if districts
+        are not tracked)
+        """
+        movable = np.flatnonzero(
+            (self.state != REMOVED)
+            & (self.age >= self.model.min_age_restriction)
+            & (self.age <= self.model.max_age_restriction))
+        self.moved = len(movable)
+
+        mobility_range = np.where(
+            self.mobile_worker[movable],
+            self.model.agent_mobility_range * 2,
+            self.model.agent_mobility_range)
+
+        rng = self.model.streams["move"]
+        x = self.x[movable] + rng.integers(-mobility_range, mobility_range + 1)
+        y = self.y[movable] + rng.integers(-mobility_range, mobility_range + 1)
+        self.x[movable], self.y[movable], district = self.model.grid.confine(
+            self.x[movable], self.y[movable], x, y, self.model.city_boundary, self.model.track_districts)
+        return movable, district
+
+    def settle(self, moved, district):
+        """
+        Relocates the moved agents that entered another district (district:
+        their destinations' district indices, -1 to stay), if the model
+        tracks districts
+        """
+        if not self.model.track_districts:
+            return
+
+        changed = (district >= 0) & (district != self.district[moved])
+        self.relocate(moved[changed], district[changed])
+
+    def relocate(self, indices, districts):
+        """
+        Moves the given agents to other districts, whose immunity and rates
+        apply to them from now on, and updates the model's counters
+        """
+        if len(indices) == 0:
+            return
+
+        counts = relocation_counts(self.district[indices], districts, self.state[indices])
+        self.district[indices] = districts
+        self.susceptibility[indices] = self.compute_susceptibility(
+            districts, self.wearing_mask[indices], self.physical_distancing[indices])
+
+        state = self.state[indices]
+        self.schedule_status(indices[(state == EXPOSED) | (state == INFECTED)], self.model.steps + 1)
+        report_relocations(self.model, counts)
+
+    def compute_susceptibility(self, district, wearing_mask, physical_distancing):
+        """
+        Returns the susceptibility of agents with the given district
+        indices and behavior flags
+        """
+        model = self.model
+        return susceptibility(
+            self.localized_immunity[district],
+            wearing_mask,
+            model.wearing_mask_protection,
+            physical_distancing,
+            model.physical_distancing_protection)
+
+    def contact_log_escape(self, infected, susceptible):
+        """
+        Returns, for each susceptible agent, the log-probability of escaping
+        every infected agent within agent_exposure_distance.
+
+        Susceptible agents are bucketed in square cells of side
+        agent_exposure_distance so that each infected agent only examines
+        the 3x3 cells around its own.
+        """
+        distance = self.model.agent_exposure_distance
+        sus_x, sus_y = self.x[susceptible], self.y[susceptible]
+        inf_x, inf_y = self.x[infected], self.y[infected]
+
+        sus_cx = np.floor(sus_x / distance).astype(np.int64)
+        sus_cy = np.floor(sus_y / distance).astype(np.int64)
+        inf_cx = np.floor(inf_x / distance).astype(np.int64)
+        inf_cy = np.floor(inf_y / distance).astype(np.int64)
+
+        x0 = min(sus_cx.min(), inf_cx.min()) - 1
+        y0 = min(sus_cy.min(), inf_cy.min()) - 1
+        height = max(sus_cy.max(), inf_cy.max()) - y0 + 2
+
+        sus_key = (sus_cx - x0) * height + (sus_cy - y0)
+        order = np.argsort(sus_key, kind = "stable")
+        sorted_key = sus_key[order]
+
+        # Keys of the 3x3 cells around each infected agent
+        offsets = np.array([dx * height + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        inf_key = (inf_cx - x0) * height + (inf_cy - y0)
+        cell_keys = (inf_key[:, None] + offsets).ravel()
+        starts = np.searchsorted(sorted_key, cell_keys, side = "left")
+        counts = np.searchsorted(sorted_key, cell_keys, side = "right") - starts
+
+        transmission = self.transmission_rate[self.district[infected]]
+        susceptibility = self.susceptibility[susceptible]
+        log_escape = np.zeros(len(susceptible))
+
+        # Processes the infected agents in chunks of at most MAX_PAIRS candidates
+        pairs = np.cumsum(counts.reshape(-1, 9).sum(axis = 1))
+        first = 0
+        while first < len(infected):
+            done = pairs[first - 1] if first > 0 else 0
+            last = max(np.searchsorted(pairs, done + self.MAX_PAIRS, side = "right"), first + 1)
+            rows = slice(first * 9, last * 9)
+            first = last
+
+            row_counts = counts[rows]
+            total = int(row_counts.sum())
+            if total == 0:
+                continue
+
+            row_starts = np.cumsum(row_counts) - row_counts
+            offset = np.arange(total) - np.repeat(row_starts, row_counts)
+            candidate = order[np.repeat(starts[rows], row_counts) + offset]
+            infector = np.repeat(np.arange(rows.start, rows.stop) // 9, row_counts)
+
+            dx = sus_x[candidate] - inf_x[infector]
+            dy = sus_y[candidate] - inf_y[infector]
+            near = dx * dx + dy * dy <= distance * distance
+            candidate = candidate[near]
+            infector = infector[near]
+            self.candidates_examined += total
+            self.contacts += len(candidate)
+
+            with np.errstate(divide = "ignore"):
+                weights = np.log1p(-transmission[infector] * susceptibility[candidate])
+            log_escape += np.bincount(candidate, weights = weights, minlength = len(susceptible))
+
+        return log_escape
+
+    def transition(self, indices, prev_state, next_state, summary_key = ""):
+        """
+        Changes the state of the given agents and updates the model's counters
+        """
+        if len(indices) == 0:
+            return
+
+        self.state[indices] = next_state
+        counts = np.bincount(self.district[indices], minlength = len(QuezonCity.DISTRICTS))
+        report_transitions(self.model, counts, prev_state, next_state, summary_key)
+
+def report_transitions(model, counts, prev_state, next_state, summary_key = ""):
+    """
+    Moves counts[j] agents of the j-th district from one compartment of the
+    model to another and updates the summary peaks of summary_key
+    """
+    prev_compartment = StateCode.STATES[prev_state]
+    next_compartment = StateCode.STATES[next_state]
+
+    for j in np.flatnonzero(counts):
+        district = QuezonCity.DISTRICTS[j]
+        model.transfer(district, prev_compartment, next_compartment, int(counts[j]))
+        if summary_key:
+            model.update_summary(district, summary_key, next_compartment)
+
+    if summary_key and np.any(counts):
+        model.update_summary("total", summary_key, next_compartment)
+
+def relocation_counts(old_district, new_district, state):
+    """
+    Returns the (4, 6) changes of the S, E, I, R counts of every district
+    when agents in the given states move from old_district to new_district
+    """
+    size = len(StateCode.STATES) * len(QuezonCity.DISTRICTS)
+    cell = state.astype(np.int64) * len(QuezonCity.DISTRICTS)
+    counts = (
+        np.bincount(cell + new_district, minlength = size)
+        - np.bincount(cell + old_district, minlength = size))
+    return counts.reshape(len(StateCode.STATES), len(QuezonCity.DISTRICTS))
+
+def report_relocations(model, counts):
+    """
+    Applies (4, 6) changes of the S, E, I, R counts of every district (see
+    relocation_counts) to the model and updates the summary peaks of the
+    districts that gained exposed or infected agents. The totals do not
+    change.
+    """
+    for state, compartment in enumerate(StateCode.STATES):
+        for j in np.flatnonzero(counts[state]):
+            district = QuezonCity.DISTRICTS[j]
+            model.SEIR[district][compartment] += int(counts[state, j])
+            model.recorder.relocate(district, compartment, int(counts[state, j]))
+
+    for state, summary_key in ((EXPOSED, "max_exposed"), (INFECTED, "max_infected")):
+        for j in np.flatnonzero(counts[state] > 0):
+            model.update_summary(QuezonCity.DISTRICTS[j], summary_key, StateCode.STATES[state])
@@ -2,8 +2,12 @@
 
 from covid_19_model.agents import PersonAgent
 from covid_19_model.space import DistrictAgent, QuezonCity
+from covid_19_model.output import agent_columns
 from mesa_geo.visualization.MapModule import MapModule
+from mesa_geo.visualization.ModularVisualization import ModularServer, SocketHandler, VisualizationElement
 from mesa.visualization.modules import ChartModule, TextElement
+import numpy as np
+import time
 
 class SEIRChart(ChartModule):
     """
@@ -41,6 +45,235 @@ class SEIRLabel(TextElement):
             max_infected_time)
         return "District %i | max(E) = %i, t = %i | max(I) = %i, t = %i" % params
 
+class AggregateMapModule(VisualizationElement):
+    """
+    Leaflet map of the population that stays cheap at city scale.
+
+    Modes:
+        heatmap: S/E/I/R counts of square cells of cell_size (projected
+            units), aggregated on the server. Only the cells whose counts
+            changed since the last render are sent (deltas), with a full
+            keyframe every keyframe_every renders so that late or lagging
+            clients resynchronize.
+        sample: Positions and states of at most sample_size agents drawn at
+            random (with a generator of the module's own, so the model's
+            random streams are untouched).
+
+    The district polygons are fetched once by the client as a static file
+    and cached there, instead of being sent with every step. The map is
+    rendered at most every render_every steps and min_interval seconds
+    (and always on the first and last step); in between, render returns
+    None and the client keeps its current map.
+
+    The throttle, delta base and sample generator are kept per browser
+    connection (see MapView and Covid19ModularServer), so that clients
+    sharing the server do not throttle each other or receive deltas
+    against frames they never saw.
+    """
+
+    package_includes = ["leaflet.js"]
+    local_includes = ["covid_19_model/res/AggregateMapModule.js"]
+
+    def __init__(
+        self,
+        mode = "heatmap",
+        cell_size = 250,
+        sample_size = 2000,
+        render_every = 1,
+        min_interval = 0.0,
+        keyframe_every = 50,
+        view = QuezonCity.MAP_COORDS,
+        zoom = 12,
+        map_height = 600,
+        map_width = 600,
+    ):
+        if mode not in ("heatmap", "sample"):
+            raise ValueError("Unknown map mode: %s" % mode)
+        self.mode = mode
+        self.cell_size = cell_size
+        self.sample_size = sample_size
+        self.render_every = render_every
+        self.min_interval = min_interval
+        self.keyframe_every = keyframe_every
+        self.views = {}
+
+        new_element = "new AggregateMapModule({}, {}, {}, {}, \"/local/{}\")".format(
+            view, zoom, map_width, map_height, QuezonCity.quezon_city_districts_geojson)
+        self.js_code = "elements.push(" + new_element + ");"
+
+    def render(self, model, connection = None):
+        """
+        Returns the map payload of the model for a connection, or None if
+        it is not time to render yet
+        """
+        # The compartmental engine has no agents to map; its charts and
+        # labels still update
+        if model.engine == "compartmental":
+            return None
+
+        view = self.views.get(connection)
+        if view is None:
+            view = self.views[connection] = MapView()
+
+        now = time.monotonic()
+        reset = model is not view.model
+        due = (
+            model.steps - view.rendered_step >= self.render_every
+            and now - view.rendered_time >= self.min_interval)
+        if not (reset or due or not model.running):
+            return None
+
+        if reset:
+            view.model = model
+            view.frame = 0
+            view.counts = None
+            view.grid = self.cell_grid(model)
+        view.rendered_step = model.steps
+        view.rendered_time = now
+
+        if self.mode == "sample":
+            return self.render_sample(model, view)
+        return self.render_heatmap(model, view)
+
+    def forget(self, connection):
+        """
+        Drops the view of a closed connection
+        """
+        self.views.pop(connection, None)
+
+    def cell_grid(self, model):
+        """
+        Returns the origin and size (in cells) of the heatmap grid, which
+        covers the districts' bounding box
+        """
+        bounds = np.array([model.grid.districts[district].shape.bounds for district in QuezonCity.DISTRICTS])
+        origin = bounds[:, :2].min(axis = 0)
+        width = int(np.ceil((bounds[:, 2].max() - origin[0]) / self.cell_size))
+        height = int(np.ceil((bounds[:, 3].max() - origin[1]) / self.cell_size))
+        return {"x": float(origin[0]), "y": float(origin[1]), "width": width, "height": height, "size": self.cell_size}
+
+    def render_heatmap(self, model, view):
+        """
+        Returns the cells whose counts changed since the view's last render
+        (or every occupied cell in a keyframe)
+        """
+        grid = view.grid
+        columns = agent_columns(model)
+        xs, ys, states = columns["x"], columns["y"], columns["state"]
+        weights = np.ones(len(xs), dtype = np.int64)
+
+        # Susceptible persons held as counts by the hybrid engine
+        aggregated = getattr(model.population, "aggregated", None)
+        if aggregated is not None:
+            sus_x, sus_y, sus_count = aggregated()
+            xs = np.concatenate([xs, sus_x])
+            ys = np.concatenate([ys, sus_y])
+            states = np.concatenate([states, np.zeros(len(sus_x), dtype = states.dtype)])
+            weights = np.concatenate([weights, sus_count])
+
+        cx = np.clip(np.floor((xs - grid["x"]) / self.cell_size).astype(np.int64), 0, grid["width"] - 1)
+        cy = np.clip(np.floor((ys - grid["y"]) / self.cell_size).astype(np.int64), 0, grid["height"] - 1)
+        cells = cx * grid["height"] + cy
+        counts = np.bincount(
+            cells * 4 + states,
+            weights = weights,
+            minlength = grid["width"] * grid["height"] * 4).astype(np.int64).reshape(-1, 4)
+
+        keyframe = view.counts is None or view.frame % self.keyframe_every == 0
+        if keyframe:
+            changed = np.flatnonzero(counts.any(axis = 1))
+        else:
+            changed = np.flatnonzero((counts != view.counts).any(axis = 1))
+        view.counts = counts
+        view.frame += 1
+
+        return {
+            "mode": "heatmap",
+            "frame": view.frame,
+            "base": None if keyframe else view.frame - 1,
+            "grid": grid,
+            "cells": np.column_stack([changed, counts[changed]]).tolist(),
+        }
+
+    def render_sample(self, model, view):
+        """
+        Returns the rounded positions and the states of a random sample of
+        the agents
+        """
+        columns = agent_columns(model)
+        n = len(columns["x"])
+        chosen = np.sort(view.rng.choice(n, min(n, self.sample_size), replace = False))
+        view.frame += 1
+
+        return {
+            "mode": "sample",
+            "frame": view.frame,
+            "total": n,
+            "x": np.round(columns["x"][chosen]).astype(np.int64).tolist(),
+            "y": np.round(columns["y"][chosen]).astype(np.int64).tolist(),
+            "state": columns["state"][chosen].tolist(),
+        }
+
+class MapView:
+    """
+    Render state of an AggregateMapModule for one connection.
+
+    Properties:
+        model: Model last rendered (a new one restarts the frames)
+        frame: Number of frames sent
+        counts: Cell counts of the last heatmap frame (the delta base)
+        grid: Heatmap grid of the model (see AggregateMapModule.cell_grid)
+        rendered_step, rendered_time: Step and time of the last render
+        rng: Generator of the agent samples
+    """
+
+    def __init__(self):
+        self.model = None
+        self.frame = 0
+        self.counts = None
+        self.grid = None
+        self.rendered_step = 0
+        self.rendered_time = 0.0
+        self.rng = np.random.default_rng()
+
+class MapSocketHandler(SocketHandler):
+    """
+    Websocket handler that renders the map modules for its own connection
+    """
+
+    @property
+    def viz_state_message(self):
+        return {
+            "type": "viz_state",
+            "data": self.application.render_model(self)
+        }
+
+    def on_close(self):
+        self.application.forget(self)
+
+class Covid19ModularServer(ModularServer):
+    """
+    ModularServer that keeps the render state of AggregateMapModule per
+    browser connection
+    """
+
+    socket_handler = (r"/ws", MapSocketHandler)
+    handlers = [ModularServer.page_handler, socket_handler, ModularServer.static_handler, ModularServer.local_handler]
+
+    def render_model(self, connection = None):
+        return [
+            element.render(self.model, connection) if isinstance(element, AggregateMapModule) else element.render(self.model)
+            for element in self.visualization_elements
+        ]
+
+    def forget(self, connection):
+        """
+        Drops the render state of a closed connection
+        """
+        for element in self.visualization_elements:
+            if isinstance(element, AggregateMapModule):
+                element.forget(connection)
+
 class Covid19ModelVisualization:
 
     MODEL_NAME = "COVID-19 Agent-Based Model"
@@ -54,15 +287,28 @@ class Covid19ModelVisualization:
     MAP_WIDTH = 600
     MAP_HEIGHT = 600
 
-    def __init__(self):
-        self.modules = [
-            MapModule(
+    def __init__(self, map_mode = "heatmap", **map_options):
+        """
+        map_mode: "heatmap" or "sample" (see AggregateMapModule, which
+        takes map_options), or "agents" for one GeoJSON feature per agent
+        and district every step (small populations only)
+        """
+        if map_mode == "agents":
+            map_module = MapModule(
                 portrayal_method = self.agent_portrayal,
                 view = QuezonCity.MAP_COORDS,
                 zoom = self.MAP_ZOOM,
                 map_height = self.MAP_HEIGHT,
                 map_width = self.MAP_WIDTH)
-            ]
+        else:
+            map_module = AggregateMapModule(
+                mode = map_mode,
+                view = QuezonCity.MAP_COORDS,
+                zoom = self.MAP_ZOOM,
+                map_height = self.MAP_HEIGHT,
+                map_width = self.MAP_WIDTH,
+                **map_options)
+        self.modules = [map_module]
 
         for i in range(6):
             district = "District " + str(i + 1)
@@ -1,5 +1,5 @@
 # run.py
 
-from covid_19_model.server import server
+from covid_19_model.server import main
 
-server.launch()
+main()
@@ -0,0 +1,37 @@
+# conftest.py
+
+import os
+import sys
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.utils import parse_json
+import pytest
+
+@pytest.fixture
+def params():
+    """
+    Returns the variable and fixed parameters of the repository's JSON files
+    """
+    return (
+        parse_json(os.path.join(ROOT, "variable_parameters.json")),
+        parse_json(os.path.join(ROOT, "fixed_parameters.json")))
+
+@pytest.fixture
+def make_model(params):
+    """
+    Returns a factory of models of the repository's parameters; keyword
+    arguments override fixed parameters
+    """
+    variable_params, fixed_params = params
+
+    def make(engine = "object", seed = 1, **overrides):
+        return Covid19Model(variable_params, dict(fixed_params, **overrides), engine = engine, seed = seed)
+
+    return make
+
+def run(model, steps):
+    for _ in range(steps):
+        model.step()
+    return model
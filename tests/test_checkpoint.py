@@ -0,0 +1,41 @@
+# test_checkpoint.py
+
+from covid_19_model.checkpoint import save_checkpoint, load_checkpoint, population_columns
+from conftest import run
+import numpy as np
+import pytest
+
+@pytest.mark.parametrize("engine", ("object", "vectorized"))
+def test_round_trip_continues_run(make_model, tmp_path, engine):
+    model = run(make_model(engine, seed = 11, track_districts = True, city_boundary = "reflect"), 10)
+    filename = str(tmp_path / "checkpoint.npz")
+    save_checkpoint(model, filename)
+    restored = load_checkpoint(filename)
+
+    assert restored.SEIR == model.SEIR
+    assert restored.summary == model.summary
+    assert restored.steps == model.steps
+    saved, loaded = population_columns(model), population_columns(restored)
+    assert saved.keys() == loaded.keys()
+    for name in saved:
+        np.testing.assert_array_equal(saved[name], loaded[name], err_msg = name)
+
+    run(model, 10)
+    run(restored, 10)
+    assert restored.SEIR == model.SEIR
+    np.testing.assert_array_equal(restored.recorder.counts, model.recorder.counts)
+    np.testing.assert_array_equal(restored.recorder.transitions, model.recorder.transitions)
+
+def test_overrides_branch_scenario(make_model, tmp_path):
+    model = run(make_model("vectorized", seed = 11), 10)
+    filename = str(tmp_path / "checkpoint.npz")
+    save_checkpoint(model, filename)
+    restored = load_checkpoint(filename, min_age_restriction = 18)
+
+    assert restored.min_age_restriction == 18
+    assert restored.SEIR == model.SEIR
+
+@pytest.mark.parametrize("engine", ("hybrid", "compartmental"))
+def test_unsupported_engines(make_model, tmp_path, engine):
+    with pytest.raises(ValueError):
+        save_checkpoint(make_model(engine), str(tmp_path / "checkpoint.npz"))
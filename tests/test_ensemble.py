@@ -0,0 +1,41 @@
+# test_ensemble.py
+
+from covid_19_model.ensemble import RunningStatistics, QUANTILES
+import numpy as np
+import pytest
+
+@pytest.mark.parametrize("distribution", ("normal", "exponential", "poisson"))
+def test_p_square_quantiles(distribution):
+    rng = np.random.default_rng(5)
+    samples = {
+        "normal": lambda size: rng.normal(100, 15, size),
+        "exponential": lambda size: rng.exponential(20, size),
+        "poisson": lambda size: rng.poisson(30, size),
+    }[distribution]((5000, 3))
+    statistics = RunningStatistics((3,))
+    for observation in samples:
+        statistics.add(observation)
+
+    spread = np.quantile(samples, 0.95, axis = 0) - np.quantile(samples, 0.05, axis = 0)
+    for quantile in QUANTILES:
+        error = np.abs(statistics.get_quantile(quantile) - np.quantile(samples, quantile, axis = 0))
+        assert (error < 0.03 * spread).all(), (quantile, error)
+
+def test_exact_first_observations():
+    samples = np.array([[3.0], [1.0], [4.0], [1.0]])
+    statistics = RunningStatistics((1,))
+    for observation in samples:
+        statistics.add(observation)
+
+    for quantile in QUANTILES:
+        np.testing.assert_allclose(statistics.get_quantile(quantile), np.quantile(samples, quantile, axis = 0))
+
+def test_mean_and_variance():
+    samples = np.random.default_rng(6).normal(size = (500, 2, 2))
+    statistics = RunningStatistics((2, 2))
+    for observation in samples:
+        statistics.add(observation)
+
+    assert (statistics.get_count() == 500).all()
+    np.testing.assert_allclose(statistics.get_mean(), samples.mean(axis = 0))
+    np.testing.assert_allclose(statistics.get_variance(), samples.var(axis = 0, ddof = 1))
@@ -0,0 +1,58 @@
+# test_parallel.py
+
+from conftest import run
+import numpy as np
+import pytest
+
+STEPS = 15
+
+@pytest.fixture
+def parallel_model(make_model):
+    models = []
+
+    def make(seed, tiles = 2):
+        model = make_model("vectorized", seed = seed, track_districts = True)
+        model.parallelize(tiles)
+        models.append(model)
+        return model
+
+    yield make
+    for model in models:
+        model.population.close()
+
+def totals(model):
+    return [model.SEIR["total"][compartment] for compartment in "SEIR"]
+
+def test_parallel_conserves_population(make_model, parallel_model):
+    serial = make_model("vectorized", seed = 3, track_districts = True)
+    parallel = parallel_model(3)
+    population = sum(totals(serial))
+
+    for _ in range(STEPS):
+        serial.step()
+        parallel.step()
+        assert sum(totals(parallel)) == population
+        for compartment in "SEIR":
+            assert parallel.SEIR["total"][compartment] == sum(
+                seir[compartment] for district, seir in parallel.SEIR.items() if district != "total")
+
+def test_parallel_is_reproducible(parallel_model):
+    first = run(parallel_model(4), STEPS)
+    second = run(parallel_model(4), STEPS)
+
+    assert first.SEIR == second.SEIR
+    np.testing.assert_array_equal(first.recorder.counts, second.recorder.counts)
+
+def test_parallel_matches_serial_totals(make_model, parallel_model):
+    seeds = range(12)
+    serial = np.array([totals(run(make_model("vectorized", seed = seed, track_districts = True), STEPS)) for seed in seeds])
+    parallel = []
+    for seed in seeds:
+        model = run(parallel_model(seed), STEPS)
+        parallel.append(totals(model))
+        model.population.close()
+    parallel = np.array(parallel)
+
+    # Both runs use different random streams: compare the ensemble means
+    error = np.sqrt((serial.var(axis = 0) + parallel.var(axis = 0)) / len(seeds))
+    assert (np.abs(serial.mean(axis = 0) - parallel.mean(axis = 0)) <= 4 * error + 1).all()
@@ -0,0 +1,36 @@
+# test_reproducibility.py
+
+from covid_19_model.model import Covid19Model
+from covid_19_model.replicates import run_replicates
+from conftest import run
+import numpy as np
+import pytest
+
+@pytest.mark.parametrize("engine", Covid19Model.ENGINES)
+def test_same_seed_same_run(make_model, engine):
+    first = run(make_model(engine, seed = 7), 15)
+    second = run(make_model(engine, seed = 7), 15)
+
+    assert first.SEIR == second.SEIR
+    assert first.summary == second.summary
+    np.testing.assert_array_equal(first.recorder.counts, second.recorder.counts)
+    np.testing.assert_array_equal(first.recorder.transitions, second.recorder.transitions)
+
+@pytest.mark.parametrize("engine", Covid19Model.ENGINES)
+def test_other_seed_other_run(make_model, engine):
+    first = run(make_model(engine, seed = 7), 15)
+    second = run(make_model(engine, seed = 8), 15)
+
+    assert not np.array_equal(first.recorder.counts, second.recorder.counts)
+
+@pytest.mark.parametrize("engine", ("object", "vectorized"))
+def test_seeded_replicates_are_reproducible(params, engine):
+    variable_params, fixed_params = params
+    first = run_replicates(variable_params, fixed_params, 3, 15, engine, seed = 7, processes = 2)
+    second = run_replicates(variable_params, fixed_params, 3, 15, engine, seed = 7, processes = 2)
+
+    assert [result["seed"] for result in first] == [result["seed"] for result in second]
+    for left, right in zip(first, second):
+        np.testing.assert_array_equal(left["history"], right["history"])
+        assert left["summary"] == right["summary"]
+    assert not np.array_equal(first[0]["history"], first[1]["history"])